@@ -5,8 +5,6 @@ import shutil
 import json
 from datetime import datetime
 
-import redis
-
 from biomaj.mongo_connector import MongoConnector
 from biomaj.session import Session
 from biomaj.workflow import UpdateWorkflow
@@ -15,9 +13,11 @@ from biomaj.workflow import RepairWorkflow
 from biomaj.workflow import Workflow
 from biomaj.workflow import ReleaseCheckWorkflow
 from biomaj.notify import Notify
+from biomaj.cancel import CancelListener
+from biomaj.dependency import DependencyGraph
+from biomaj.scheduler import StepScheduler
 from biomaj_core.config import BiomajConfig
 from biomaj.options import Options
-from biomaj.process.processfactory import ProcessFactory
 from biomaj_core.bmajindex import BmajIndex
 
 import getpass
@@ -45,6 +45,9 @@ class Bank:
 
         self.name = name
         self.depends = []
+        self.dependency_graph = None
+        # Bank status writer of running workflow, see :class:`biomaj.progress.ProgressWriter`
+        self.progress = None
         self.no_log = no_log
 
         if no_log:
@@ -57,9 +60,6 @@ class Bank:
 
         self.config = BiomajConfig(self.name, options)
 
-        if self.config.get('bank.num.threads') is not None:
-            ProcessFactory.NB_THREAD = int(self.config.get('bank.num.threads'))
-
         if self.config.log_file is not None and self.config.log_file != 'none':
             logging.info("Log file: " + self.config.log_file)
 
@@ -145,6 +145,100 @@ class Bank:
             bank_list.append(bank_elt)
         return bank_list
 
+    @staticmethod
+    def dedup_productions(banks=None, max_workers=2, min_size=1, dry_run=False):
+        """
+        Replace identical files of production directories of banks by hard links
+
+        Production directories are scanned while banks can be updated or
+        removed, files are linked once banks are locked. Locked banks (update
+        or removal in progress) are skipped. Bytes reclaimed per bank are
+        recorded in history (dedup action).
+
+        :param banks: names of banks to scan, default all banks
+        :type banks: list
+        :param max_workers: max number of directories walked or files hashed at the same time
+        :type max_workers: int
+        :param min_size: minimal size of files to deduplicate, in bytes
+        :type min_size: int
+        :param dry_run: only find duplicates, do not link them
+        :type dry_run: bool
+        :return: dict of DedupScanner statistics, with bytes reclaimed per bank (banks)
+        """
+        from biomaj.dedup import DedupScanner
+        if MongoConnector.db is None:
+            MongoConnector(BiomajConfig.global_config.get('GENERAL', 'db.url'),
+                           BiomajConfig.global_config.get('GENERAL', 'db.name'))
+        start_time = time.mktime(datetime.now().timetuple())
+        # production directory => bank name
+        directories = {}
+        for b in MongoConnector.banks.find({}, {'name': 1, 'production': 1}):
+            if banks and b['name'] not in banks:
+                continue
+            for prod in b['production']:
+                if not prod.get('data_dir') or not prod.get('dir_version') or not prod.get('prod_dir'):
+                    continue
+                release_dir = os.path.join(prod['data_dir'], prod['dir_version'], prod['prod_dir'])
+                if os.path.isdir(release_dir):
+                    directories[release_dir] = b['name']
+        # bank name => lock file, in lock.dir of bank like Workflow.wf_init
+        lock_files = {}
+        options = Options()
+        options.no_log = True
+        for name in sorted(set(directories.values())):
+            try:
+                config = BiomajConfig(name, options)
+            except Exception as e:
+                logging.warn('Dedup:Bank %s configuration not available, skipping:%s' % (name, str(e)))
+                continue
+            lock_dir = config.get('lock.dir', default=config.get('data.dir'))
+            if os.path.exists(os.path.join(lock_dir, 'biomaj.lock')):
+                logging.error('Biomaj is in maintenance')
+                return None
+            lock_files[name] = os.path.join(lock_dir, name + '.lock')
+        directories = dict([(release_dir, name) for (release_dir, name) in directories.items() if name in lock_files])
+        scanner = DedupScanner(max_workers=max_workers, min_size=min_size, dry_run=dry_run)
+        duplicates = scanner.find(sorted(directories.keys()))
+        locked = []
+        skipped = set()
+        try:
+            for name in sorted(lock_files.keys()):
+                try:
+                    lock_fd = os.open(lock_files[name], os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                    os.write(lock_fd, b'1')
+                    os.close(lock_fd)
+                    locked.append(name)
+                except FileExistsError:
+                    logging.warn('Dedup:Bank %s is locked, skipping' % (name))
+                    skipped.add(name)
+            if skipped:
+                # Files of skipped banks may be removed, do not link them
+                duplicates = [[inode for inode in inodes if directories[inode[0]] not in skipped] for inodes in duplicates]
+                duplicates = [inodes for inodes in duplicates if len(inodes) > 1]
+            scanner.link(duplicates)
+        finally:
+            for name in locked:
+                os.remove(lock_files[name])
+        reclaimed = {}
+        for release_dir in scanner.reclaimed:
+            name = directories[release_dir]
+            reclaimed[name] = reclaimed.get(name, 0) + scanner.reclaimed[release_dir]
+        end_time = time.mktime(datetime.now().timetuple())
+        if not dry_run:
+            for name in reclaimed:
+                MongoConnector.history.insert({
+                    'bank': name,
+                    'error': False,
+                    'start': start_time,
+                    'end': end_time,
+                    'action': 'dedup',
+                    'updated': None,
+                    'reclaimed': reclaimed[name]
+                })
+        stats = dict(scanner.stats)
+        stats['banks'] = reclaimed
+        return stats
+
     def get_bank_release_info(self, full=False):
         """
         Get release info for the bank. Used with --status option from biomaj-cly.py
@@ -232,10 +326,35 @@ class Bank:
                             str(release), _bank['properties']['visibility'], last_update]
             return info
 
+    def _update_dependency(self, dep, no_log=False):
+        """
+        Update a bank dependency
+
+        :param dep: name of the bank to update
+        :type dep: str
+        :param no_log: do not create a log file for the dependency
+        :type no_log: bool
+        :return: tuple updated :class:`Bank` and update status
+        """
+        logging.info('Update:Depends:' + dep)
+        b = Bank(dep, no_log=no_log)
+        if self.options and hasattr(self.options, 'user') and self.options.user:
+            b.options.user = self.options.user
+        res = b.update()
+        logging.info('Update:Depends:' + dep + ':' + str(res))
+        return (b, res)
+
     def update_dependencies(self):
         """
         Update bank dependencies
 
+        If depends.parallel is set, dependencies not depending on each other
+        are updated concurrently (depends.num.threads at most), their logs
+        going to the bank log file. Updates run in threads of this process,
+        so they are run sequentially if a dependency can not be isolated
+        from the others: cluster processes share a single DRMAA session per
+        process.
+
         :return: status of updates
         """
         self.depends = []
@@ -248,21 +367,36 @@ class Bank:
         res = True
         for dep in depends:
             self.session._session['depends'][dep] = False
-        for dep in depends:
-            if self.session._session['depends'][dep]:
-                logging.debug('Update:Depends:' + dep + ':SKIP')
-                # Bank has been marked as depends multiple times, run only once
-                continue
-            logging.info('Update:Depends:' + dep)
-            b = Bank(dep)
-            if self.options and hasattr(self.options, 'user') and self.options.user:
-                b.options.user = self.options.user
-            res = b.update()
-            self.depends.append(b)
-            self.session._session['depends'][dep] = res
-            logging.info('Update:Depends:' + dep + ':' + str(res))
-            if not res:
-                break
+        parallel = len(depends) > 1 and self.config.get_bool('depends.parallel', default=False)
+        if parallel:
+            cluster_depends = [dep for dep in depends if self.dependency_graph.runs_on_cluster(dep)]
+            if cluster_depends:
+                logging.warn('Update:Depends:Parallel:Disabled, cluster processes in ' + ','.join(cluster_depends))
+                parallel = False
+        if parallel:
+            updated = {}
+
+            def update_dep(dep):
+                (updated[dep], dep_res) = self._update_dependency(dep, no_log=True)
+                return dep_res
+
+            dep_graph = {}
+            for dep in depends:
+                dep_graph[dep] = self.dependency_graph.get_depends(dep)
+            scheduler = StepScheduler(depends, dep_graph,
+                                      max_workers=int(self.config.get('depends.num.threads', default='2')))
+            (res, status) = scheduler.run(update_dep)
+            for dep in depends:
+                if dep in updated:
+                    self.depends.append(updated[dep])
+                    self.session._session['depends'][dep] = bool(status[dep])
+        else:
+            for dep in depends:
+                (b, res) = self._update_dependency(dep)
+                self.depends.append(b)
+                self.session._session['depends'][dep] = res
+                if not res:
+                    break
         if depends:
             # Revert logging config
             self.config.reset_logger()
@@ -280,25 +414,17 @@ class Bank:
         """
         Search all bank dependencies
 
-        :return: list of bank names to update
+        Dependencies are resolved once per bank instance.
+
+        :return: list of bank names to update, each bank after the banks it depends on
         """
         if bank is None:
-            deps = self.config.get('depends')
-        else:
-            deps = bank.config.get('depends')
-        if deps is None:
-            return []
-        # Mainn deps
-        deps = deps.split(',')
-        # Now search in deps if they themselves depend on other banks
-        for dep in deps:
-            sub_options = None
-            if self.options and hasattr(self.options, 'user') and self.options.user:
-                sub_options = Options()
-                sub_options.user = self.options.user
-            b = Bank(dep, options=sub_options, no_log=True)
-            deps = b.get_dependencies() + deps
-        return deps
+            bank = self
+        if self.dependency_graph is None:
+            self.dependency_graph = DependencyGraph(self.options)
+        if bank.name not in self.dependency_graph.depends:
+            self.dependency_graph.add(bank.name, bank.config.get('depends'))
+        return self.dependency_graph.get_dependencies(bank.name)
 
     def is_owner(self):
         """
@@ -666,13 +792,10 @@ class Bank:
                                     self.config.get('dir.version'),
                                     'current')
 
-        to_dir = os.path.join(self.config.get('data.dir'),
-                              self.config.get('dir.version'))
-
         if os.path.lexists(current_link):
             os.remove(current_link)
-        os.chdir(to_dir)
-        os.symlink(self.session.get_release_directory(), 'current')
+        # Link target is relative to link directory
+        os.symlink(self.session.get_release_directory(), current_link)
         self.bank['current'] = self.session._session['id']
         self.banks.update(
             {'name': self.name},
@@ -1017,6 +1140,30 @@ class Bank:
             return {}
         return self.bank['status']
 
+    def get_timing(self, release=None):
+        """
+        Get time spent in each task of a session
+
+        :param release: release or production directory, default current or last session
+        :type release: str
+        :return: dict with 'tasks', task name => dict of start, end, duration
+                 (and parent flow for steps), and 'files', task => list of
+                 dict of file name and duration if stats.files was set
+        """
+        session = None
+        if release:
+            session = self.get_session_from_release(release)
+        elif self.session is not None:
+            session = self.session._session
+        elif self.bank['sessions']:
+            session = self.bank['sessions'][len(self.bank['sessions']) - 1]
+        if session is None or 'stats' not in session:
+            return {'tasks': {}, 'files': {}}
+        return {
+            'tasks': session['stats'].get('timing', {}),
+            'files': session['stats'].get('files', {})
+        }
+
     def remove_pending(self, release=None):
         """
         Remove pending releases if 'release is None
@@ -1177,25 +1324,45 @@ class Bank:
         })
         return res
 
+    def _start_workflow(self, workflow):
+        """
+        Start a workflow, listening for cancel requests if redis is used
+
+        :param workflow: workflow to start
+        :type workflow: :class:`biomaj.workflow.Workflow`
+        :return: bool
+        """
+        if not self.options or not self.options.get_option('redis_host'):
+            return workflow.start()
+        import redis
+        redis_client = redis.StrictRedis(
+            host=self.options.get_option('redis_host'),
+            port=self.options.get_option('redis_port'),
+            db=self.options.get_option('redis_db'),
+            decode_responses=True
+        )
+        workflow.redis_client = redis_client
+        workflow.redis_prefix = self.options.get_option('redis_prefix')
+        if redis_client.get(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel'):
+            logging.warn('Cancel requested, stopping update')
+            redis_client.delete(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel')
+            return False
+        listener = CancelListener(redis_client, self.options.get_option('redis_prefix'), self.name,
+                                  interval=int(self.config.get('cancel.check.interval', default='5')))
+        workflow.cancel_listener = listener
+        workflow.cancel_event = listener.event
+        listener.start()
+        try:
+            return workflow.start()
+        finally:
+            listener.stop()
+
     def start_repair(self):
         """
         Start an repair workflow
         """
         workflow = RepairWorkflow(self)
-        if self.options and self.options.get_option('redis_host'):
-            redis_client = redis.StrictRedis(
-                host=self.options.get_option('redis_host'),
-                port=self.options.get_option('redis_port'),
-                db=self.options.get_option('redis_db'),
-                decode_responses=True
-            )
-            workflow.redis_client = redis_client
-            workflow.redis_prefix = self.options.get_option('redis_prefix')
-            if redis_client.get(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel'):
-                logging.warn('Cancel requested, stopping update')
-                redis_client.delete(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel')
-                return False
-        return workflow.start()
+        return self._start_workflow(workflow)
 
     def update(self, depends=False):
         """
@@ -1428,37 +1595,11 @@ class Bank:
         :return: bool
         """
         workflow = RemoveWorkflow(self, session)
-        if self.options and self.options.get_option('redis_host'):
-            redis_client = redis.StrictRedis(
-                host=self.options.get_option('redis_host'),
-                port=self.options.get_option('redis_port'),
-                db=self.options.get_option('redis_db'),
-                decode_responses=True
-            )
-            workflow.redis_client = redis_client
-            workflow.redis_prefix = self.options.get_option('redis_prefix')
-            if redis_client.get(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel'):
-                logging.warn('Cancel requested, stopping update')
-                redis_client.delete(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel')
-                return False
-        return workflow.start()
+        return self._start_workflow(workflow)
 
     def start_update(self):
         """
         Start an update workflow
         """
         workflow = UpdateWorkflow(self)
-        if self.options and self.options.get_option('redis_host'):
-            redis_client = redis.StrictRedis(
-                host=self.options.get_option('redis_host'),
-                port=self.options.get_option('redis_port'),
-                db=self.options.get_option('redis_db'),
-                decode_responses=True
-            )
-            workflow.redis_client = redis_client
-            workflow.redis_prefix = self.options.get_option('redis_prefix')
-            if redis_client.get(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel'):
-                logging.warn('Cancel requested, stopping update')
-                redis_client.delete(self.options.get_option('redis_prefix') + ':' + self.name + ':action:cancel')
-                return False
-        return workflow.start()
+        return self._start_workflow(workflow)
@@ -0,0 +1,99 @@
+import logging
+import threading
+import traceback
+
+
+class CancelListener(threading.Thread):
+    '''
+    Listen in background for a cancel request on a bank action.
+
+    A cancel request is the *prefix:bank:action:cancel* redis key. The
+    listener subscribes to a channel of the same name and to the keyspace
+    notifications of the key, if enabled on the redis server, and checks
+    the key itself every *interval* seconds otherwise. Once a request is
+    received, *event* is set and the listener exits.
+    '''
+
+    def __init__(self, redis_client, redis_prefix, bank_name, interval=5):
+        '''
+        Creates a listener
+
+        :param redis_client: redis client
+        :type redis_client: :class:`redis.StrictRedis`
+        :param redis_prefix: prefix of redis keys
+        :type redis_prefix: str
+        :param bank_name: name of the bank
+        :type bank_name: str
+        :param interval: max number of seconds between two checks of the cancel key
+        :type interval: int
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.redis_client = redis_client
+        self.key = redis_prefix + ':' + bank_name + ':action:cancel'
+        self.interval = interval
+        self.event = threading.Event()
+        self._stopped = threading.Event()
+
+    def get_channels(self):
+        '''
+        Gets the channels notifying a cancel request
+
+        :return: list of channel names
+        '''
+        db = self.redis_client.connection_pool.connection_kwargs.get('db', 0) or 0
+        return [self.key, '__keyspace@' + str(db) + '__:' + self.key]
+
+    def run(self):
+        pubsub = None
+        try:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*self.get_channels())
+        except Exception as e:
+            logging.warn('Cancel:Listener:Subscribe:Error:' + str(e))
+            pubsub = None
+        try:
+            while not self._stopped.is_set():
+                if self.redis_client.get(self.key):
+                    self.cancel()
+                    break
+                if pubsub is None:
+                    self._stopped.wait(self.interval)
+                    continue
+                message = pubsub.get_message(timeout=self.interval)
+                if message is None:
+                    continue
+                data = message['data']
+                if isinstance(data, bytes):
+                    data = data.decode('utf-8', 'ignore')
+                # Keyspace notifications also notify key deletion
+                if data not in ['del', 'expired']:
+                    self.cancel()
+                    break
+        except Exception as e:
+            logging.error('Cancel:Listener:Error:' + str(e))
+            logging.debug(traceback.format_exc())
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+
+    def cancel(self):
+        '''
+        Mark action as cancelled
+        '''
+        logging.warn('Cancel:Listener:Cancel requested')
+        self.event.set()
+
+    def is_cancelled(self):
+        '''
+        Checks if a cancel request was received
+
+        :return: bool
+        '''
+        return self.event.is_set()
+
+    def stop(self):
+        '''
+        Stop listening
+        '''
+        self._stopped.set()
@@ -0,0 +1,302 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChecksumCache:
+    '''
+    Persistent cache of file digests.
+
+    Digests are keyed by device, inode, size, modification time and status
+    change time (ns) of files, so a digest is reused only while the file is
+    unchanged. Status change time can not be set (utime), it detects files
+    replaced on a reused inode with the same size and modification time.
+    '''
+
+    def __init__(self, path):
+        '''
+        Creates a cache, loading previous digests if cache file exists
+
+        :param path: cache file path
+        :type path: str
+        '''
+        self.path = path
+        self._lock = threading.Lock()
+        # key => {'path': file path, algorithm: digest, ...}
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except Exception as e:
+                logging.warn('Checksum:Cache:Failed to load %s:%s' % (path, str(e)))
+                self.entries = {}
+
+    @staticmethod
+    def get_key(path):
+        '''
+        Gets the cache key of a file
+
+        :param path: file path
+        :type path: str
+        :return: str
+        '''
+        file_stat = os.stat(path)
+        return '%d:%d:%d:%d:%d' % (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns)
+
+    def get(self, key, algorithms):
+        '''
+        Gets cached digests
+
+        :param key: file key
+        :type key: str
+        :param algorithms: hashlib algorithm names
+        :type algorithms: list
+        :return: dict algorithm => hex digest, None if a digest is not cached
+        '''
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or any(algorithm not in entry for algorithm in algorithms):
+                return None
+            return dict([(algorithm, entry[algorithm]) for algorithm in algorithms])
+
+    def set(self, key, path, digests):
+        '''
+        Adds digests of a file
+
+        :param key: file key
+        :type key: str
+        :param path: file path
+        :type path: str
+        :param digests: dict algorithm => hex digest
+        :type digests: dict
+        '''
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.get('path') != path:
+                entry = {'path': path}
+                self.entries[key] = entry
+            entry.update(digests)
+
+    def remove(self, path):
+        '''
+        Drops digests of a file, for instance if file failed checksum verification
+
+        :param path: file path
+        :type path: str
+        '''
+        with self._lock:
+            for key in list(self.entries.keys()):
+                if self.entries[key].get('path') == path:
+                    del self.entries[key]
+
+    def save(self):
+        '''
+        Write cache file, dropping digests of removed or modified files
+        '''
+        with self._lock:
+            entries = {}
+            for key in self.entries:
+                try:
+                    if self.get_key(self.entries[key]['path']) == key:
+                        entries[key] = self.entries[key]
+                except OSError:
+                    pass
+            self.entries = entries
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as cache_file:
+                    json.dump(entries, cache_file)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logging.warn('Checksum:Cache:Failed to save %s:%s' % (self.path, str(e)))
+
+
+class ChecksumManifest:
+    '''
+    Checksum manifest, listing digests of the files of its directory
+    (MD5SUMS, SHA256SUMS, md5checksums.txt...).
+
+    Lines can use md5sum/sha256sum format (*digest  name*) or BSD tagged
+    format (*MD5 (name) = digest*). Algorithm is given by the tag, or else
+    by the length of the digest.
+    '''
+
+    DIGEST_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+    BSD_LINE = re.compile(r'^(\w+)\s*\((.+)\)\s*=\s*([0-9a-fA-F]+)\s*$')
+    GNU_LINE = re.compile(r'^([0-9a-fA-F]+)\s+\*?(.+?)\s*$')
+
+    @staticmethod
+    def get_algorithms(name):
+        '''
+        Guess the algorithms used by a manifest from its name
+
+        :param name: manifest file name
+        :type name: str
+        :return: list of algorithms
+        '''
+        name = os.path.basename(name).lower()
+        algorithms = [algorithm for algorithm in ['sha512', 'sha256', 'sha1', 'md5'] if algorithm in name]
+        if not algorithms:
+            algorithms = ['md5', 'sha256']
+        return algorithms
+
+    @staticmethod
+    def parse(path):
+        '''
+        Parse a manifest
+
+        :param path: manifest file path
+        :type path: str
+        :return: dict file path, relative to manifest directory => dict algorithm => digest
+        '''
+        checksums = {}
+        with open(path, 'r', errors='replace') as manifest:
+            for line in manifest:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                match = ChecksumManifest.BSD_LINE.match(line)
+                if match:
+                    algorithm = match.group(1).lower().replace('-', '')
+                    name = match.group(2)
+                    digest = match.group(3)
+                else:
+                    match = ChecksumManifest.GNU_LINE.match(line)
+                    if not match:
+                        continue
+                    digest = match.group(1)
+                    name = match.group(2)
+                    algorithm = ChecksumManifest.DIGEST_LENGTHS.get(len(digest))
+                    if algorithm is None:
+                        continue
+                checksums.setdefault(os.path.normpath(name), {})[algorithm] = digest.lower()
+        return checksums
+
+
+class ChecksumEngine:
+    '''
+    Compute file digests.
+
+    Each file is read once, whatever the number of requested algorithms,
+    with large read buffers. Several files can be hashed concurrently,
+    hashlib releasing the GIL while hashing. With a cache, digests of
+    unchanged files are not computed again.
+    '''
+
+    ALGORITHMS = ('md5', 'sha256')
+
+    def __init__(self, max_workers=2, buffer_size=1048576, cache=None):
+        '''
+        Creates an engine
+
+        :param max_workers: max number of files hashed at the same time
+        :type max_workers: int
+        :param buffer_size: size of read buffer, in bytes
+        :type buffer_size: int
+        :param cache: digests cache
+        :type cache: :class:`ChecksumCache`
+        '''
+        self.max_workers = max(1, int(max_workers))
+        self.buffer_size = max(4096, int(buffer_size))
+        self.cache = cache
+        self._lock = threading.Lock()
+        self.nb_files = 0
+        self.nb_cached = 0
+        self.nb_bytes = 0
+        # Wall clock time spent hashing, in seconds
+        self.duration = 0.0
+
+    def hash_file(self, path, algorithms):
+        '''
+        Computes digests of a file
+
+        :param path: file path
+        :type path: str
+        :param algorithms: hashlib algorithm names
+        :type algorithms: list
+        :return: dict algorithm => hex digest
+        '''
+        start = time.monotonic()
+        digests = self._hash_file(path, algorithms)
+        with self._lock:
+            self.duration += time.monotonic() - start
+        return digests
+
+    def _hash_file(self, path, algorithms):
+        key = None
+        if self.cache is not None:
+            key = ChecksumCache.get_key(path)
+            digests = self.cache.get(key, algorithms)
+            if digests is not None:
+                with self._lock:
+                    self.nb_cached += 1
+                return digests
+        hashes = {}
+        for algorithm in algorithms:
+            hashes[algorithm] = hashlib.new(algorithm)
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        size = 0
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                nb_read = f.readinto(buf)
+                if not nb_read:
+                    break
+                size += nb_read
+                for algorithm in hashes:
+                    hashes[algorithm].update(view[:nb_read])
+        with self._lock:
+            self.nb_files += 1
+            self.nb_bytes += size
+        digests = {}
+        for algorithm in hashes:
+            digests[algorithm] = hashes[algorithm].hexdigest()
+        if self.cache is not None:
+            self.cache.set(key, path, digests)
+        return digests
+
+    def hash_files(self, files):
+        '''
+        Computes digests of several files concurrently
+
+        :param files: list of tuples file path and list of algorithms
+        :type files: list
+        :return: list of dict algorithm => hex digest, in the order of files
+        '''
+        if not files:
+            return []
+        start = time.monotonic()
+        try:
+            if self.max_workers == 1 or len(files) == 1:
+                return [self._hash_file(path, algorithms) for (path, algorithms) in files]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._hash_file, path, algorithms) for (path, algorithms) in files]
+                return [future.result() for future in futures]
+        finally:
+            with self._lock:
+                self.duration += time.monotonic() - start
+
+    def get_stats(self):
+        '''
+        Gets hashing statistics
+
+        :return: dict with number of hashed files, bytes, duration (seconds), throughput (bytes/s) and number of files found in cache
+        '''
+        with self._lock:
+            throughput = 0
+            if self.duration > 0:
+                throughput = self.nb_bytes / self.duration
+            return {
+                'files': self.nb_files,
+                'bytes': self.nb_bytes,
+                'duration': self.duration,
+                'throughput': throughput,
+                'cached': self.nb_cached
+            }
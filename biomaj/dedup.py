@@ -0,0 +1,332 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from biomaj.checksum import ChecksumCache
+
+
+class DedupStore:
+    '''
+    Content addressed store of release files.
+
+    Files are keyed by their sha256 digest. A file whose content is already
+    in the store is replaced by a hard link to the stored file, so identical
+    files of several releases share the same data on disk. Stored files are
+    used only while they are unchanged (same device, inode, size and
+    modification time as when stored).
+    '''
+
+    ALGORITHM = 'sha256'
+
+    def __init__(self, path):
+        '''
+        Creates a store, loading previous files if store file exists
+
+        :param path: store file path
+        :type path: str
+        '''
+        self.path = path
+        self._lock = threading.Lock()
+        # digest => {'path': file path, 'key': file key (see ChecksumCache.get_key)}
+        self.entries = {}
+        self.nb_linked = 0
+        self.nb_bytes = 0
+        if os.path.exists(path):
+            try:
+                with open(path) as store_file:
+                    self.entries = json.load(store_file)
+            except Exception as e:
+                logging.warn('Dedup:Failed to load %s:%s' % (path, str(e)))
+                self.entries = {}
+
+    def get(self, digest):
+        '''
+        Gets the stored file with a content
+
+        :param digest: sha256 digest of content
+        :type digest: str
+        :return: file path, None if no unchanged file has this content
+        '''
+        with self._lock:
+            entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        try:
+            if ChecksumCache.get_key(entry['path']) == entry['key']:
+                return entry['path']
+        except OSError:
+            pass
+        return None
+
+    def add(self, digest, path):
+        '''
+        Adds a file to the store, unless a file with same content is already stored
+
+        :param digest: sha256 digest of file
+        :type digest: str
+        :param path: file path
+        :type path: str
+        '''
+        if self.get(digest) is not None:
+            return
+        with self._lock:
+            self.entries[digest] = {'path': path, 'key': ChecksumCache.get_key(path)}
+
+    def link(self, digest, path):
+        '''
+        Replaces a file by a hard link to the stored file with same content,
+        or adds it to the store
+
+        :param digest: sha256 digest of file
+        :type digest: str
+        :param path: file path
+        :type path: str
+        :return: bool, True if file was replaced by a hard link
+        '''
+        stored = self.get(digest)
+        if stored is None:
+            self.add(digest, path)
+            return False
+        file_stat = os.stat(path)
+        stored_stat = os.stat(stored)
+        if os.path.samestat(file_stat, stored_stat):
+            return False
+        if file_stat.st_dev != stored_stat.st_dev or file_stat.st_size != stored_stat.st_size:
+            return False
+        tmp_path = os.path.join(os.path.dirname(path), '.tmp_dedup_' + os.path.basename(path))
+        try:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(stored, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.debug('Dedup:Link:%s:%s' % (path, str(e)))
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        with self._lock:
+            # New link changed status change time of stored file
+            try:
+                self.entries[digest]['key'] = ChecksumCache.get_key(stored)
+            except OSError:
+                pass
+            self.nb_linked += 1
+            self.nb_bytes += file_stat.st_size
+        return True
+
+    def get_stats(self):
+        '''
+        Gets deduplication statistics
+
+        :return: dict with number of files replaced by a hard link and bytes saved
+        '''
+        with self._lock:
+            return {'files': self.nb_linked, 'bytes': self.nb_bytes}
+
+    def save(self):
+        '''
+        Write store file, dropping removed or modified files
+        '''
+        with self._lock:
+            entries = {}
+            for digest in self.entries:
+                try:
+                    if ChecksumCache.get_key(self.entries[digest]['path']) == self.entries[digest]['key']:
+                        entries[digest] = self.entries[digest]
+                except OSError:
+                    pass
+            self.entries = entries
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as store_file:
+                    json.dump(entries, store_file)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logging.warn('Dedup:Failed to save %s:%s' % (self.path, str(e)))
+
+
+class DedupScanner:
+    '''
+    Find identical files in several directories (production directories of
+    banks) and replace duplicates by hard links, on the same file system.
+
+    Files are first grouped by device, size, permissions and owner, then by
+    digest of samples of their content, and only remaining candidates are
+    fully hashed. Files already hard linked together are read once.
+    Removing a release or a bank is not affected: removing a link leaves
+    other links and their data unchanged.
+    '''
+
+    SAMPLE_SIZE = 65536
+
+    def __init__(self, max_workers=2, min_size=1, dry_run=False):
+        '''
+        Creates a scanner
+
+        :param max_workers: max number of directories walked or files hashed at the same time
+        :type max_workers: int
+        :param min_size: minimal size of files to deduplicate, in bytes
+        :type min_size: int
+        :param dry_run: only find duplicates, do not link them
+        :type dry_run: bool
+        '''
+        self.max_workers = max(1, int(max_workers))
+        self.min_size = max(1, int(min_size))
+        self.dry_run = dry_run
+        self._lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'hashed': 0, 'linked': 0, 'reclaimed': 0}
+        # root directory => bytes reclaimed
+        self.reclaimed = {}
+
+    def scan(self, directories):
+        '''
+        Deduplicate files of directories
+
+        :param directories: directories to scan
+        :type directories: list
+        :return: dict with number of scanned files and bytes, bytes hashed,
+                 number of files replaced by a hard link and bytes reclaimed
+        '''
+        self.link(self.find(directories))
+        return self.stats
+
+    def find(self, directories):
+        '''
+        Find identical files in directories
+
+        :param directories: directories to scan
+        :type directories: list
+        :return: list of groups of identical inodes, as tuples of scanned
+                 directory, list of file paths and stat
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            walked = list(executor.map(self._walk, directories))
+        # (device, size, mode, uid, gid) => inode => (root, paths, stat)
+        groups = {}
+        for (root, files) in zip(directories, walked):
+            for (path, file_stat) in files:
+                key = (file_stat.st_dev, file_stat.st_size, file_stat.st_mode, file_stat.st_uid, file_stat.st_gid)
+                inodes = groups.setdefault(key, {})
+                if file_stat.st_ino not in inodes:
+                    inodes[file_stat.st_ino] = (root, [], file_stat)
+                inodes[file_stat.st_ino][1].append(path)
+                self.stats['files'] += 1
+                self.stats['bytes'] += file_stat.st_size
+        candidates = [list(inodes.values()) for inodes in groups.values() if len(inodes) > 1]
+        for digest_function in [self._get_sample_digest, self._get_digest]:
+            candidates = self._split(candidates, digest_function)
+        return candidates
+
+    def link(self, duplicates):
+        '''
+        Replace identical files by hard links to the most linked one. Files
+        modified since found are skipped.
+
+        :param duplicates: groups of identical inodes, see find
+        :type duplicates: list
+        '''
+        for inodes in duplicates:
+            self._link(inodes)
+
+    def _walk(self, directory):
+        files = []
+        for (root, dirs, names) in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    file_stat = os.lstat(path)
+                except OSError:
+                    # Removed while walking
+                    continue
+                if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size >= self.min_size:
+                    files.append((path, file_stat))
+        return files
+
+    def _split(self, candidates, digest_function):
+        '''
+        Split groups of candidate inodes by digest, keeping groups of several inodes
+        '''
+        inodes = [inode for group in candidates for inode in group]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            digests = list(executor.map(lambda inode: digest_function(inode[1][0], inode[2].st_size), inodes))
+        result = []
+        index = 0
+        for group in candidates:
+            by_digest = {}
+            for inode in group:
+                if digests[index] is not None:
+                    by_digest.setdefault(digests[index], []).append(inode)
+                index += 1
+            result += [same for same in by_digest.values() if len(same) > 1]
+        return result
+
+    def _get_sample_digest(self, path, size):
+        if size <= 3 * DedupScanner.SAMPLE_SIZE:
+            # Small file, read once by full digest
+            return ''
+        file_hash = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for offset in [0, size // 2, size - DedupScanner.SAMPLE_SIZE]:
+                    f.seek(offset)
+                    file_hash.update(f.read(DedupScanner.SAMPLE_SIZE))
+        except OSError:
+            return None
+        with self._lock:
+            self.stats['hashed'] += 3 * DedupScanner.SAMPLE_SIZE
+        return file_hash.hexdigest()
+
+    def _get_digest(self, path, size):
+        file_hash = hashlib.sha256()
+        buf = bytearray(1048576)
+        view = memoryview(buf)
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    nb_read = f.readinto(buf)
+                    if not nb_read:
+                        break
+                    file_hash.update(view[:nb_read])
+        except OSError:
+            return None
+        with self._lock:
+            self.stats['hashed'] += size
+        return file_hash.hexdigest()
+
+    def _link(self, inodes):
+        '''
+        Replace files of identical inodes by hard links to the most linked one
+        '''
+        inodes.sort(key=lambda inode: (-inode[2].st_nlink, inode[1][0]))
+        (ref_root, ref_paths, ref_stat) = inodes[0]
+        for (root, paths, file_stat) in inodes[1:]:
+            nb_linked = 0
+            for path in paths:
+                try:
+                    current_stat = os.lstat(path)
+                    ref_current_stat = os.lstat(ref_paths[0])
+                    if current_stat.st_ino != file_stat.st_ino or current_stat.st_mtime_ns != file_stat.st_mtime_ns or \
+                       ref_current_stat.st_ino != ref_stat.st_ino or ref_current_stat.st_mtime_ns != ref_stat.st_mtime_ns:
+                        # Modified, removed or replaced since scanned
+                        continue
+                    logging.debug('Dedup:Link:%s:%s' % (path, ref_paths[0]))
+                    if not self.dry_run:
+                        tmp_path = os.path.join(os.path.dirname(path), '.tmp_dedup_' + os.path.basename(path))
+                        if os.path.lexists(tmp_path):
+                            os.remove(tmp_path)
+                        os.link(ref_paths[0], tmp_path)
+                        os.replace(tmp_path, path)
+                except OSError as e:
+                    logging.warn('Dedup:Link:%s:%s' % (path, str(e)))
+                    continue
+                nb_linked += 1
+            with self._lock:
+                self.stats['linked'] += nb_linked
+                if nb_linked == len(paths) and file_stat.st_nlink == len(paths):
+                    # No other link to these data
+                    self.stats['reclaimed'] += file_stat.st_size
+                    self.reclaimed[root] = self.reclaimed.get(root, 0) + file_stat.st_size
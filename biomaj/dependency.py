@@ -0,0 +1,124 @@
+import logging
+
+from biomaj_core.config import BiomajConfig
+
+from biomaj.options import Options
+
+
+class DependencyGraph:
+    '''
+    Graph of bank dependencies, defined by the *depends* property of banks.
+
+    Bank configurations are read once and only once per graph, so shared
+    dependencies are resolved only once.
+    '''
+
+    def __init__(self, options=None):
+        '''
+        Creates a graph
+
+        :param options: bank options, only user is used to load configurations
+        :type options: :class:`biomaj.options.Options`
+        '''
+        self.options = Options()
+        self.options.no_log = True
+        if options is not None and hasattr(options, 'user') and options.user:
+            self.options.user = options.user
+        # bank name => list of banks it directly depends on
+        self.depends = {}
+        # bank name => loaded configuration
+        self.configs = {}
+
+    def add(self, name, depends):
+        '''
+        Sets the direct dependencies of a bank, without loading its configuration
+
+        :param name: bank name
+        :type name: str
+        :param depends: value of depends property, comma separated list or list of bank names
+        :type depends: str or list
+        '''
+        if depends is None:
+            depends = []
+        elif not isinstance(depends, list):
+            depends = depends.split(',')
+        deps = []
+        for dep in depends:
+            dep = dep.strip()
+            if dep and dep not in deps:
+                deps.append(dep)
+        self.depends[name] = deps
+
+    def get_depends(self, name):
+        '''
+        Gets the banks a bank directly depends on
+
+        :param name: bank name
+        :type name: str
+        :return: list of bank names
+        '''
+        if name not in self.depends:
+            self.add(name, self.get_config(name).get('depends'))
+        return self.depends[name]
+
+    def get_config(self, name):
+        '''
+        Gets the configuration of a bank, loaded only once
+
+        :param name: bank name
+        :type name: str
+        :return: :class:`biomaj_core.config.BiomajConfig`
+        '''
+        if name not in self.configs:
+            logging.debug('Dependency:Load:' + name)
+            self.configs[name] = BiomajConfig(name, self.options)
+        return self.configs[name]
+
+    def runs_on_cluster(self, name):
+        '''
+        Checks if a bank executes some of its processes on a cluster (<process>.cluster)
+
+        :param name: bank name
+        :type name: str
+        :return: bool
+        '''
+        config = self.get_config(name)
+        for key in config.config_bank.options('GENERAL'):
+            if key.endswith('.cluster') and config.get_bool(key, default=False):
+                return True
+        return False
+
+    def get_order(self, names):
+        '''
+        Gets banks and all their dependencies, each bank after the banks it depends on
+
+        :param names: bank names
+        :type names: list
+        :return: de-duplicated list of bank names
+        :raise: Exception if a bank depends on itself
+        '''
+        order = []
+        for name in names:
+            self._visit(name, [], order)
+        return order
+
+    def _visit(self, name, path, order):
+        if name in order:
+            return
+        if name in path:
+            raise Exception('Cycle detected in bank dependencies: ' + ' -> '.join(path[path.index(name):] + [name]))
+        path.append(name)
+        for dep in self.get_depends(name):
+            self._visit(dep, path, order)
+        path.pop()
+        order.append(name)
+
+    def get_dependencies(self, name):
+        '''
+        Gets all banks a bank depends on, directly or not
+
+        :param name: bank name
+        :type name: str
+        :return: de-duplicated list of bank names, each bank after the banks it depends on
+        '''
+        return [dep for dep in self.get_order([name]) if dep != name]
@@ -0,0 +1,501 @@
+import bz2
+import collections
+import gzip
+import logging
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from biomaj_core.utils import Utils
+
+
+# Archives supported by Utils.uncompress
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tar', '.tgz', '.bz2', '.gz', '.zip')
+
+# Archive format by extension, the first matching extension is used
+FORMAT_EXTENSIONS = [
+    ('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.gz', 'gz'),
+    ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.bz2', 'bz2'),
+    ('.tar.xz', 'xz'), ('.txz', 'xz'), ('.xz', 'xz'),
+    ('.tar.zst', 'zst'), ('.tzst', 'zst'), ('.zst', 'zst'),
+    ('.tar', 'tar'), ('.zip', 'zip')
+]
+
+# Formats only extracted if enabled (uncompress.extra.formats)
+EXTRA_FORMATS = ('xz', 'zst')
+
+TAR_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar.zst', '.tzst', '.tar')
+
+# Archive format by magic bytes: offset, bytes, format
+FORMAT_MAGICS = [
+    (0, b'\x1f\x8b', 'gz'),
+    (0, b'BZh', 'bz2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'\x28\xb5\x2f\xfd', 'zst'),
+    (0, b'PK\x03\x04', 'zip'),
+    (257, b'ustar', 'tar')
+]
+
+# Size of chunks read from archives and written to extracted files
+BUFFER_SIZE = 1048576
+
+
+def detect_format(path):
+    '''
+    Detects archive format from file content
+
+    :param path: file path
+    :type path: str
+    :return: format (gz, bz2, xz, zst, zip, tar), None if not an archive
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(262)
+    for (offset, magic, archive_format) in FORMAT_MAGICS:
+        if header[offset:offset + len(magic)] == magic:
+            return archive_format
+    return None
+
+
+def get_format(path, detect=False):
+    '''
+    Gets archive format from file extension, or else from file content
+
+    :param path: file path
+    :type path: str
+    :param detect: detect format from content if extension is unknown
+    :type detect: bool
+    :return: format (gz, bz2, xz, zst, zip, tar), None if not an archive
+    '''
+    for (extension, archive_format) in FORMAT_EXTENSIONS:
+        if path.endswith(extension):
+            return archive_format
+    if detect:
+        return detect_format(path)
+    return None
+
+
+def is_archive(path, detect=False, extra=False):
+    '''
+    Checks if a file is an archive supported by extraction
+
+    :param path: file path
+    :type path: str
+    :param detect: detect format from content if extension is unknown
+    :type detect: bool
+    :param extra: also consider formats of EXTRA_FORMATS (xz, zst)
+    :type extra: bool
+    :return: bool
+    '''
+    archive_format = get_format(path, detect)
+    if archive_format in EXTRA_FORMATS and not extra:
+        return False
+    return archive_format is not None
+
+
+def has_decompressor(archive_format):
+    '''
+    Checks if an archive format can be decompressed on this host
+
+    zstd archives need zstandard python module or zstd command.
+
+    :param archive_format: archive format (gz, bz2, xz, zst, zip, tar)
+    :type archive_format: str
+    :return: bool
+    '''
+    if archive_format != 'zst':
+        return True
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return shutil.which('zstd') is not None
+
+
+class DefaultBackend:
+    '''
+    Extract archives with system commands (tar, gunzip, unzip), see Utils.uncompress
+    '''
+
+    name = 'default'
+
+    def __init__(self, threads=1):
+        self.threads = threads
+        # Extracted files of last archive, relative to archive directory, None if unknown
+        self.outputs = None
+
+    def extract(self, path):
+        '''
+        Extract an archive in its directory and remove it
+
+        :param path: archive path
+        :type path: str
+        :return: bool, False if extraction failed
+        '''
+        self.outputs = None
+        if not Utils.uncompress(path):
+            return False
+        if path.endswith('.gz') and not path.endswith(TAR_EXTENSIONS):
+            self.outputs = [os.path.basename(path)[:-len('.gz')]]
+        return True
+
+
+class StreamBackend(DefaultBackend):
+    '''
+    Extract archives in a single pass, tar members being written to disk
+    straight from the decompressed stream.
+
+    Supports xz and zstd archives (zstandard module or zstd command, only
+    extracted by workflow if uncompress.extra.formats is set) and archives
+    with unknown extension, format being detected from content.
+    A compressed file without known extension is replaced by its content.
+
+    With several threads, BGZF files (bgzip) are decompressed by blocks in
+    parallel, and pigz, lbzip2, pbzip2 or xz are used for other files if
+    available. Falls back on :class:`DefaultBackend` on error.
+    '''
+
+    name = 'stream'
+
+    def extract(self, path):
+        self.outputs = None
+        try:
+            outputs = self._extract(path)
+        except Exception as e:
+            if not path.endswith(ARCHIVE_EXTENSIONS):
+                logging.error('Workflow:wf_uncompress:Stream:%s:%s' % (path, str(e)))
+                return False
+            logging.warn('Workflow:wf_uncompress:Stream:%s:%s, using default extraction' % (path, str(e)))
+            return DefaultBackend.extract(self, path)
+        logging.debug('Workflow:wf_uncompress:Stream:' + path)
+        if outputs is None or os.path.basename(path) not in outputs:
+            os.remove(path)
+        self.outputs = outputs
+        return True
+
+    def _extract(self, path):
+        directory = os.path.dirname(path)
+        archive_format = get_format(path, detect=True)
+        if archive_format is None:
+            raise Exception('Unknown archive format')
+        if archive_format == 'zip':
+            return self._extract_zip(path, directory)
+        chunks = self.get_chunks(path, archive_format)
+        try:
+            reader = _ChunkReader(chunks)
+            if path.endswith(TAR_EXTENSIONS) or archive_format == 'tar':
+                return self._extract_tar(reader, directory)
+            output = path
+            if path.endswith('.gz'):
+                # Like gunzip, even if content is a tar file
+                output = path[:-len('.gz')]
+            elif reader.peek(512)[257:262] == b'ustar':
+                # Like tar xjf for .bz2 files
+                return self._extract_tar(reader, directory)
+            else:
+                for extension in ('.bz2', '.xz', '.zst'):
+                    if path.endswith(extension):
+                        output = path[:-len(extension)]
+            self._write_file(reader, path, output)
+            return [os.path.basename(output)]
+        finally:
+            chunks.close()
+
+    def get_chunks(self, path, archive_format=None):
+        '''
+        Gets the decompressed content of an archive
+
+        :param path: archive path
+        :type path: str
+        :param archive_format: archive format, from file name or content if not set
+        :type archive_format: str
+        :return: generator of bytes
+        '''
+        if archive_format is None:
+            archive_format = get_format(path, detect=True)
+        if archive_format == 'tar':
+            return _iter_file(open(path, 'rb'))
+        if archive_format == 'xz':
+            if self.threads > 1 and shutil.which('xz'):
+                return _iter_command(['xz', '-dc', '-T', str(self.threads), path])
+            return _iter_file(lzma.open(path, 'rb'))
+        if archive_format == 'zst':
+            try:
+                import zstandard
+                return _iter_file(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True))
+            except ImportError:
+                if not shutil.which('zstd'):
+                    raise Exception('zstd archives need zstandard python module or zstd command')
+            return _iter_command(['zstd', '-dcq', path])
+        if archive_format == 'bz2':
+            if self.threads > 1:
+                if shutil.which('lbzip2'):
+                    return _iter_command(['lbzip2', '-dc', '-n', str(self.threads), path])
+                if shutil.which('pbzip2'):
+                    return _iter_command(['pbzip2', '-dc', '-p' + str(self.threads), path])
+            return _iter_file(bz2.open(path, 'rb'))
+        if self.threads > 1:
+            if is_bgzf(path):
+                return _iter_bgzf(path, self.threads)
+            if shutil.which('pigz'):
+                return _iter_command(['pigz', '-dc', '-p', str(self.threads), path])
+        return _iter_file(gzip.open(path, 'rb'))
+
+    def _extract_tar(self, reader, directory):
+        '''
+        Extract tar members from reader
+
+        :return: list of extracted files and links, None if archive has
+                 special files (devices, fifos), which are not tracked
+        '''
+        tar_filter = getattr(tarfile, 'tar_filter', None)
+        outputs = []
+        special = False
+        with tarfile.open(fileobj=reader, mode='r|', bufsize=BUFFER_SIZE) as tar:
+            for member in tar:
+                if tar_filter is not None:
+                    member = tar_filter(member, directory)
+                elif os.path.isabs(member.name) or '..' in member.name.split('/'):
+                    raise Exception('Unsafe path in archive: ' + member.name)
+                target = os.path.join(directory, member.name)
+                if not member.isdir() and os.path.lexists(target) and not os.path.isdir(target):
+                    # Never write through an existing (hard) link
+                    os.remove(target)
+                kwargs = {'set_attrs': not member.isdir()}
+                if tar_filter is not None:
+                    kwargs['filter'] = 'fully_trusted'
+                tar.extract(member, directory, **kwargs)
+                if member.isfile() or member.islnk() or member.issym():
+                    outputs.append(os.path.normpath(member.name))
+                elif not member.isdir():
+                    special = True
+        if special:
+            return None
+        return outputs
+
+    def _extract_zip(self, path, directory):
+        outputs = []
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                target = os.path.join(directory, member.filename)
+                if not member.is_dir() and os.path.lexists(target) and not os.path.isdir(target):
+                    os.remove(target)
+                archive.extract(member, directory)
+                if not member.is_dir():
+                    outputs.append(os.path.normpath(member.filename))
+        return outputs
+
+    def _write_file(self, reader, path, output):
+        (fd, tmp_output) = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as output_file:
+                while True:
+                    chunk = reader.read(BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    output_file.write(chunk)
+            # Same permissions and dates as archive, like gunzip
+            shutil.copystat(path, tmp_output)
+            os.replace(tmp_output, output)
+        except Exception:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+            raise
+
+
+BACKENDS = {
+    DefaultBackend.name: DefaultBackend,
+    StreamBackend.name: StreamBackend
+}
+
+
+def get_backend(name='default', threads=1):
+    '''
+    Gets an extraction backend
+
+    :param name: backend name, one of BACKENDS
+    :type name: str
+    :param threads: number of threads a backend can use for an archive
+    :type threads: int
+    :return: backend
+    '''
+    if name not in BACKENDS:
+        logging.warn('Workflow:wf_uncompress:Unknown backend %s, using default' % (name))
+        name = DefaultBackend.name
+    return BACKENDS[name](max(1, int(threads)))
+
+
+def uncompress_archive(path, nb_try=2, backend='default', threads=1):
+    '''
+    Extract an archive in its directory and remove it, retrying on failure.
+    Can be executed in a separate process by wf_uncompress.
+
+    :param path: archive path
+    :type path: str
+    :param nb_try: max number of extraction attempts
+    :type nb_try: int
+    :param backend: extraction backend name
+    :type backend: str
+    :param threads: number of threads the backend can use
+    :type threads: int
+    :return: tuple status, duration in seconds, archive size in bytes and
+             list of extracted files relative to archive directory (None if unknown)
+    '''
+    if backend == DefaultBackend.name and not path.endswith(ARCHIVE_EXTENSIONS):
+        # Formats only supported by stream backend
+        backend = StreamBackend.name
+    extractor = get_backend(backend, threads)
+    size = os.path.getsize(path)
+    start = time.monotonic()
+    for i in range(nb_try):
+        if extractor.extract(path):
+            return (True, time.monotonic() - start, size, extractor.outputs)
+        logging.warn('Workflow:wf_uncompress:Failure:' + path + ':' + str(i + 1))
+    return (False, time.monotonic() - start, size, None)
+
+
+def is_bgzf(path):
+    '''
+    Checks if a file is in BGZF format (gzip blocks with their size, bgzip)
+
+    :param path: file path
+    :type path: str
+    :return: bool
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+            return False
+        xlen = struct.unpack('<H', header[10:12])[0]
+        return _get_bgzf_block_size(f.read(xlen)) is not None
+
+
+def _get_bgzf_block_size(extra):
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            return struct.unpack('<H', extra[i + 4:i + 6])[0]
+        i += 4 + slen
+    return None
+
+
+def _read_bgzf_block(f):
+    header = f.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+        raise Exception('Invalid BGZF block')
+    xlen = struct.unpack('<H', header[10:12])[0]
+    block_size = _get_bgzf_block_size(f.read(xlen))
+    if block_size is None:
+        raise Exception('Invalid BGZF block')
+    data = f.read(block_size - xlen - 19)
+    trailer = f.read(8)
+    if len(trailer) < 8:
+        raise Exception('Truncated BGZF block')
+    (crc, size) = struct.unpack('<II', trailer)
+    return (data, crc, size)
+
+
+def _inflate_bgzf_block(data, crc, size):
+    # zlib releases the GIL, blocks are decompressed in parallel
+    content = zlib.decompress(data, -15)
+    if len(content) != size or zlib.crc32(content) != crc:
+        raise Exception('Corrupted BGZF block')
+    return content
+
+
+def _iter_bgzf(path, threads):
+    with open(path, 'rb') as f:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = collections.deque()
+            while True:
+                block = _read_bgzf_block(f)
+                if block is None:
+                    break
+                pending.append(executor.submit(_inflate_bgzf_block, *block))
+                # Limit memory use, blocks are at most 64KB
+                if len(pending) >= threads * 16:
+                    content = pending.popleft().result()
+                    # EOF blocks, ending each bgzip member, are empty
+                    if content:
+                        yield content
+            while pending:
+                content = pending.popleft().result()
+                if content:
+                    yield content
+
+
+def _iter_file(f):
+    with f:
+        while True:
+            chunk = f.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _iter_command(command):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    completed = False
+    try:
+        while True:
+            chunk = process.stdout.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        completed = True
+    finally:
+        if not completed:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise Exception('%s exited with status %d' % (command[0], returncode))
+
+
+class _ChunkReader:
+    '''
+    File like reader over chunks of bytes
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b''
+        self.offset = 0
+
+    def peek(self, size):
+        data = self.buffer[self.offset:]
+        while len(data) < size:
+            # Empty chunks do not end the stream, only end of chunks
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            data += chunk
+        self.buffer = data
+        self.offset = 0
+        return data[:size]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buffer[self.offset:] + b''.join(self.chunks)
+            self.buffer = b''
+            self.offset = 0
+            return data
+        while self.offset >= len(self.buffer):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b''
+            self.buffer = chunk
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
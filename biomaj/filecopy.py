@@ -0,0 +1,226 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ioctl request cloning a file on copy on write file systems (btrfs, xfs...)
+FICLONE = 0x40049409
+
+# Errors meaning a copy method is not supported between two devices
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+# Errors meaning a copy method failed for a file only (permissions, max number
+# of links...), next method is used for this file
+FILE_ERRORS = (errno.ENOSYS, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EMLINK)
+
+
+class CopyEngine:
+    '''
+    Copy files using the cheapest available method for each file:
+
+    * hardlink: hard link to source file, if hard links are allowed
+    * reflink: clone of source file (FICLONE) on copy on write file systems
+    * copy_file_range: copy in kernel, without user space buffers
+    * sendfile: copy in kernel, for systems without copy_file_range
+    * buffer: read and write with large buffers
+
+    A method failing as unsupported is not tried again for files of the same
+    source and destination devices, a method failing for a file only is still
+    used for other files. Several files are copied at the same time.
+    '''
+
+    METHODS = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'buffer')
+
+    def __init__(self, max_workers=2, use_hardlinks=False, use_reflinks=True, buffer_size=1048576):
+        '''
+        Creates an engine
+
+        :param max_workers: max number of files copied at the same time
+        :type max_workers: int
+        :param use_hardlinks: hard link files instead of copying them, if possible
+        :type use_hardlinks: bool
+        :param use_reflinks: clone files, if file system supports it
+        :type use_reflinks: bool
+        :param buffer_size: size of copy buffer, in bytes
+        :type buffer_size: int
+        '''
+        self.max_workers = max(1, int(max_workers))
+        self.buffer_size = max(4096, int(buffer_size))
+        self.methods = list(CopyEngine.METHODS)
+        if not use_hardlinks:
+            self.methods.remove('hardlink')
+        if not use_reflinks:
+            self.methods.remove('reflink')
+        for method in ['copy_file_range', 'sendfile']:
+            if not hasattr(os, method):
+                self.methods.remove(method)
+        self._lock = threading.Lock()
+        # (source device, destination device) => unsupported methods
+        self._unsupported = {}
+        # method => number of files, bytes and time spent copying (seconds)
+        self.stats = {}
+        # Wall clock time spent copying, in seconds
+        self.duration = 0.0
+
+    def copy_file(self, from_file, to_file):
+        '''
+        Copy a file, keeping its permissions and dates.
+        An existing destination file is replaced, never written through.
+
+        :param from_file: source file path
+        :type from_file: str
+        :param to_file: destination file path
+        :type to_file: str
+        :return: name of the method used
+        '''
+        start = time.monotonic()
+        to_dir = os.path.dirname(to_file)
+        if to_dir:
+            os.makedirs(to_dir, exist_ok=True)
+        if os.path.lexists(to_file):
+            os.remove(to_file)
+        size = os.path.getsize(from_file)
+        devices = (os.stat(from_file).st_dev, os.stat(to_dir or '.').st_dev)
+        with self._lock:
+            unsupported = set(self._unsupported.get(devices, []))
+        for method in self.methods:
+            if method in unsupported:
+                continue
+            try:
+                getattr(self, '_' + method)(from_file, to_file, size)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS + FILE_ERRORS or method == 'buffer':
+                    raise
+                if e.errno in UNSUPPORTED_ERRORS:
+                    logging.debug('Copy:%s:Not supported for %s:%s' % (method, from_file, str(e)))
+                    with self._lock:
+                        self._unsupported.setdefault(devices, set()).add(method)
+                else:
+                    logging.debug('Copy:%s:Failed for %s:%s' % (method, from_file, str(e)))
+                if os.path.lexists(to_file):
+                    os.remove(to_file)
+                continue
+            if method != 'hardlink':
+                shutil.copystat(from_file, to_file)
+            duration = time.monotonic() - start
+            with self._lock:
+                stats = self.stats.setdefault(method, {'files': 0, 'bytes': 0, 'duration': 0.0})
+                stats['files'] += 1
+                stats['bytes'] += size
+                stats['duration'] += duration
+            return method
+
+    def copy_files(self, files_to_copy, to_dir):
+        '''
+        Copy files to to_dir, keeping directory structure, like
+        Utils.copy_files. Files must have attributes name (relative path of
+        file in root directory) and root. Copy time is set in download_time.
+
+        :param files_to_copy: list of files to copy
+        :type files_to_copy: list
+        :param to_dir: destination directory
+        :type to_dir: str
+        '''
+        if not files_to_copy:
+            return
+        start = time.monotonic()
+        try:
+            if self.max_workers == 1 or len(files_to_copy) == 1:
+                for file_to_copy in files_to_copy:
+                    self._copy_file_info(file_to_copy, to_dir)
+                return
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._copy_file_info, file_to_copy, to_dir) for file_to_copy in files_to_copy]
+                for future in futures:
+                    future.result()
+        finally:
+            with self._lock:
+                self.duration += time.monotonic() - start
+
+    def _copy_file_info(self, file_to_copy, to_dir):
+        start = time.monotonic()
+        name = file_to_copy['name'].lstrip('/')
+        method = self.copy_file(os.path.join(file_to_copy['root'], name), os.path.join(to_dir, name))
+        logging.debug('Copy:%s:%s' % (method, name))
+        file_to_copy['download_time'] = time.monotonic() - start
+
+    def get_stats(self):
+        '''
+        Gets copy statistics
+
+        :return: dict with total number of files, bytes, wall clock duration (seconds)
+                 and throughput (bytes/s), and same statistics per method (methods)
+        '''
+        with self._lock:
+            methods = {}
+            nb_files = 0
+            nb_bytes = 0
+            for method in self.stats:
+                stats = dict(self.stats[method])
+                stats['throughput'] = stats['bytes'] / stats['duration'] if stats['duration'] > 0 else 0
+                methods[method] = stats
+                nb_files += stats['files']
+                nb_bytes += stats['bytes']
+            return {
+                'files': nb_files,
+                'bytes': nb_bytes,
+                'duration': self.duration,
+                'throughput': nb_bytes / self.duration if self.duration > 0 else 0,
+                'methods': methods
+            }
+
+    def _hardlink(self, from_file, to_file, size):
+        os.link(from_file, to_file)
+
+    def _reflink(self, from_file, to_file, size):
+        with open(from_file, 'rb') as src, open(to_file, 'wb') as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+
+    def _copy_file_range(self, from_file, to_file, size):
+        with open(from_file, 'rb') as src, open(to_file, 'wb') as dest:
+            copied = 0
+            while copied < size:
+                nb_copied = os.copy_file_range(src.fileno(), dest.fileno(), size - copied)
+                if nb_copied == 0:
+                    self._check_no_data('copy_file_range', from_file, copied)
+                    break
+                copied += nb_copied
+        self._check_size(from_file, copied, size)
+
+    def _sendfile(self, from_file, to_file, size):
+        with open(from_file, 'rb') as src, open(to_file, 'wb') as dest:
+            copied = 0
+            while copied < size:
+                nb_copied = os.sendfile(dest.fileno(), src.fileno(), copied, size - copied)
+                if nb_copied == 0:
+                    self._check_no_data('sendfile', from_file, copied)
+                    break
+                copied += nb_copied
+        self._check_size(from_file, copied, size)
+
+    def _check_no_data(self, method, from_file, copied):
+        '''
+        Some file systems (procfs, fuse...) copy nothing instead of failing,
+        the next method is tried
+        '''
+        if copied == 0:
+            raise OSError(errno.ENOTSUP, '%s copied no data from %s' % (method, from_file))
+
+    def _check_size(self, from_file, copied, size):
+        if copied != size:
+            # File was truncated while copying
+            raise Exception('Copy:%s:%d bytes copied, %d expected' % (from_file, copied, size))
+
+    def _buffer(self, from_file, to_file, size):
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        with open(from_file, 'rb', buffering=0) as src, open(to_file, 'wb') as dest:
+            while True:
+                nb_read = src.readinto(buf)
+                if not nb_read:
+                    break
+                dest.write(view[:nb_read])
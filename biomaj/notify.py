@@ -9,8 +9,6 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email import encoders
 
-from jinja2 import Template
-
 
 class Notify:
     """
@@ -95,6 +93,7 @@ class Notify:
             logging.error('Template file not found: %s' % template_file)
             template_file = None
         if template_file:
+            from jinja2 import Template
             template = None
             with open(template_file) as file_:
                 template = Template(file_.read())
@@ -111,6 +110,7 @@ class Notify:
             logging.error('Template file not found: %s' % template_file)
             template_file = None
         if template_file:
+            from jinja2 import Template
             template = None
             with open(template_file) as file_:
                 template = Template(file_.read())
@@ -0,0 +1,179 @@
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import pycurl
+
+from biomaj_download.downloadclient import DownloadClient
+from biomaj_download.download.curl import CurlDownload
+
+
+class FilePipeline:
+    '''
+    Verify and extract downloaded files while other files are still being downloaded.
+
+    Files are processed as soon as they, their checksum files (.md5, .sha256)
+    and the checksum manifests of their directory, if those are expected too,
+    are available in the offline directory.
+    Successfully processed files are recorded in *done*, files in error are left
+    to the wf_checksum and wf_uncompress steps which report the error.
+    '''
+
+    CHECKSUM_SUFFIXES = ('.md5', '.sha256')
+
+    def __init__(self, workflow, files, max_workers=2):
+        '''
+        Creates a pipeline
+
+        :param workflow: update workflow
+        :type workflow: :class:`biomaj.workflow.UpdateWorkflow`
+        :param files: all files expected in offline directory
+        :type files: list
+        :param max_workers: number of files processed at the same time
+        :type max_workers: int
+        '''
+        self.workflow = workflow
+        self.files = {}
+        for rfile in files:
+            self.files[rfile.get('save_as') or rfile['name']] = rfile
+        # directory => checksum manifests
+        self.manifests = workflow._get_manifests(self.files)
+        self.extract = workflow.session.config.get('no.extract') in [None, 'false']
+        self.available = set()
+        self.submitted = set()
+        self.done = set()
+        self.archives = []
+        self.error = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+
+    def _is_complete(self, name):
+        '''
+        Checks file and its expected checksum files are available
+        '''
+        if name not in self.available:
+            return False
+        for suffix in FilePipeline.CHECKSUM_SUFFIXES:
+            if name + suffix in self.files and name + suffix not in self.available:
+                return False
+        for manifest in self.manifests.get(os.path.dirname(name), []):
+            if manifest not in self.available:
+                return False
+        return True
+
+    def file_ready(self, name):
+        '''
+        Notify that a file is available in offline directory
+
+        :param name: file path relative to offline directory (save_as)
+        :type name: str
+        '''
+        with self._lock:
+            self.available.add(name)
+            candidates = [name]
+            for suffix in FilePipeline.CHECKSUM_SUFFIXES:
+                if name.endswith(suffix):
+                    candidates.append(name[:-len(suffix)])
+            directory = os.path.dirname(name)
+            if name in self.manifests.get(directory, []):
+                candidates += [candidate for candidate in self.files if os.path.dirname(candidate) == directory]
+            for candidate in candidates:
+                if candidate in self.files and candidate not in self.submitted and self._is_complete(candidate):
+                    self.submitted.add(candidate)
+                    self._executor.submit(self._process, candidate)
+
+    def _process(self, name):
+        if self.error or self.workflow.cancel_event.is_set():
+            return
+        rfile = self.files[name]
+        try:
+            if not self.workflow._checksum_file(rfile):
+                self.error = True
+                return
+            if self.extract and not self.workflow._uncompress_file(rfile, self.archives):
+                self.error = True
+                return
+        except Exception as e:
+            logging.error('Workflow:wf_download:Pipeline:Exception:' + name + ':' + str(e))
+            logging.debug(traceback.format_exc())
+            self.error = True
+            return
+        with self._lock:
+            self.done.add(name)
+
+    def close(self):
+        '''
+        Wait for files in progress
+
+        :return: bool, False if a file could not be processed
+        '''
+        self._executor.shutdown(wait=True)
+        logging.info('Workflow:wf_download:Pipeline:Processed:%d/%d' % (len(self.done), len(self.files)))
+        return not self.error
+
+
+class LocalDownloadClient(DownloadClient):
+    '''
+    Local download client hashing files and sending them to a :class:`FilePipeline`
+    once downloaded. Once the action is cancelled, remaining files are skipped
+    and transfers in progress are aborted.
+    Downloaded file info (with download_time) is kept in *downloaded_files*,
+    files_to_download of downloaders being only copied by download threads.
+    '''
+
+    def __init__(self, pipeline=None, cancel_event=None, hash_file=None):
+        '''
+        Creates a download client
+
+        :param pipeline: pipeline to send downloaded files to
+        :type pipeline: :class:`FilePipeline`
+        :param cancel_event: event set on cancel request
+        :type cancel_event: :class:`threading.Event`
+        :param hash_file: function called, in download thread, with each downloaded file info before sending it to pipeline
+        :type hash_file: function
+        '''
+        DownloadClient.__init__(self)
+        self.pipeline = pipeline
+        self.cancel_event = cancel_event
+        self.hash_file = hash_file
+        self.downloaded_files = []
+        self._lock = threading.Lock()
+
+    def _get_handler(self, biomaj_file_info):
+        download_handler = DownloadClient._get_handler(self, biomaj_file_info)
+        if download_handler is None or self.cancel_event is None:
+            return download_handler
+        cancel_event = self.cancel_event
+        # Do not retry a download once cancelled
+        retryer = download_handler.retryer
+        download_handler.retryer = retryer.copy(stop=lambda retry_state: cancel_event.is_set() or retryer.stop(retry_state))
+        if isinstance(download_handler, CurlDownload):
+            # Curl options are reset before downloads
+            network_configuration = download_handler._network_configuration
+
+            def _network_configuration():
+                network_configuration()
+                # Abort transfer on cancel request
+                download_handler.crl.setopt(pycurl.NOPROGRESS, 0)
+                download_handler.crl.setopt(pycurl.XFERINFOFUNCTION, lambda *args: 1 if cancel_event.is_set() else 0)
+
+            download_handler._network_configuration = _network_configuration
+        return download_handler
+
+    def local_download(self, biomaj_file_info):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            logging.debug('Workflow:wf_download:Cancelled:Skip')
+            return None
+        downloaded_files = DownloadClient.local_download(self, biomaj_file_info)
+        if downloaded_files:
+            with self._lock:
+                self.downloaded_files += downloaded_files
+        if downloaded_files and self.hash_file is not None:
+            for downloaded_file in downloaded_files:
+                self.hash_file(downloaded_file)
+        if downloaded_files and self.pipeline is not None:
+            for downloaded_file in downloaded_files:
+                self.pipeline.file_ready(downloaded_file.get('save_as') or downloaded_file['name'])
+        return downloaded_files
@@ -1,13 +1,103 @@
 import threading
 import logging
 import os
+import subprocess
 
+import biomaj_process.process
 from biomaj_process.process import Process, DrmaaProcess, DockerProcess
 from biomaj_process.process import RemoteProcess
 from biomaj.mongo_connector import MongoConnector
 from biomaj_zipkin.zipkin import Zipkin
 
 
+# Process executed by a LocalProcess in current thread
+_local = threading.local()
+
+
+class _ProcessSubprocess(object):
+    '''
+    subprocess module as seen by biomaj_process: processes started by the
+    run method of a LocalProcess are created by its _popen method
+    '''
+
+    def __getattr__(self, name):
+        return getattr(subprocess, name)
+
+    def Popen(self, args, **kwargs):
+        process = getattr(_local, 'process', None)
+        if process is None:
+            return subprocess.Popen(args, **kwargs)
+        return process._popen(args, **kwargs)
+
+
+biomaj_process.process.subprocess = _ProcessSubprocess()
+
+
+class LocalProcess(Process):
+    '''
+    Process executed in a working directory (process.dir), without changing
+    the working directory of biomaj, which can be stopped while running
+    '''
+
+    # Seconds to wait for a terminated process before killing it
+    KILL_TIMEOUT = 10
+
+    def __init__(self, name, exe, args, cwd=None, **kwargs):
+        '''
+        Define one process
+
+        :param cwd: working directory of process, biomaj working directory if None
+        :type cwd: str
+
+        See :class:`biomaj_process.process.Process` for other parameters
+        '''
+        Process.__init__(self, name, exe, args, **kwargs)
+        self.cwd = cwd
+        self._proc = None
+        self._killed = False
+        self._proc_lock = threading.Lock()
+
+    def _popen(self, args, **kwargs):
+        '''
+        Starts the process command, called by :meth:`Process.run`
+        '''
+        with self._proc_lock:
+            if self._killed:
+                raise Exception('Kill request received, exiting')
+            self._proc = subprocess.Popen(args, cwd=self.cwd, **kwargs)
+            return self._proc
+
+    def kill(self, timeout=None):
+        '''
+        Stops the process if running, or prevents it from starting. Process
+        is terminated, then killed if still running after timeout.
+
+        :param timeout: seconds to wait before killing process, KILL_TIMEOUT if None
+        :type timeout: float
+        '''
+        if timeout is None:
+            timeout = LocalProcess.KILL_TIMEOUT
+        with self._proc_lock:
+            self._killed = True
+            proc = self._proc
+        if proc is None or proc.poll() is not None:
+            return
+        logging.warn('PROCESS:TERMINATE:' + self.name)
+        proc.terminate()
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logging.warn('PROCESS:KILL:' + self.name)
+            proc.kill()
+
+    def run(self, simulate=False):
+        _local.process = self
+        try:
+            return Process.run(self, simulate)
+        finally:
+            _local.process = None
+
+
 class MetaProcess(threading.Thread):
     '''
     Meta process in biomaj process workflow. Meta processes are executed in parallel.
@@ -33,6 +123,8 @@ class MetaProcess(threading.Thread):
         threading.Thread.__init__(self)
         self._lock = None
         self.kill_received = False
+        # Process being executed
+        self.current_process = None
         self.workflow = None
         self.simulate = simulate
         self.bank = bank
@@ -136,6 +228,22 @@ class MetaProcess(threading.Thread):
                 self.bmaj_env[key] = ''
                 self.bmaj_only_env[key] = ''
 
+    def get_local_exe(self, exe):
+        '''
+        Gets the path of a local executable
+
+        Paths relative to a sub directory (./test.sh, bin/test.sh) are relative
+        to process.dir, cluster processes do not run in process.dir. Executable
+        names are searched in PATH, which includes process.dir.
+
+        :param exe: executable
+        :type exe: str
+        :return: str
+        '''
+        if not exe or os.path.isabs(exe) or '/' not in exe:
+            return exe
+        return os.path.join(self.bank.config.get('process.dir'), exe)
+
     def set_progress(self, name, status=None):
         '''
         Update progress on execution
@@ -146,12 +254,24 @@ class MetaProcess(threading.Thread):
         :type status: bool or None
         '''
         logging.debug('Process:progress:' + name + "=" + str(status))
-        if self.workflow is not None:
+        if self.workflow is None:
+            return
+        if self.bank.progress is not None:
+            self.bank.progress.set('status.' + self.workflow + '.progress.' + name, status)
+        else:
             MongoConnector.banks.update(
                 {'name': self.bank.name},
                 {'$set': {'status.' + self.workflow + '.progress.' + name: status}}
             )
 
+    def kill_process(self):
+        '''
+        Stops the process being executed, if executed locally
+        '''
+        process = self.current_process
+        if isinstance(process, LocalProcess):
+            process.kill()
+
     def run(self):
         # Run meta processes
         self.global_status = True
@@ -182,7 +302,7 @@ class MetaProcess(threading.Thread):
                     expand = self.bank.config.get_bool(bprocess + '.expand', default=True)
                     if cluster:
                         native = self.bank.config.get(bprocess + '.native')
-                        bmaj_process = DrmaaProcess(meta + '_' + name, exe, args, desc, proc_type, native,
+                        bmaj_process = DrmaaProcess(meta + '_' + name, self.get_local_exe(exe), args, desc, proc_type, native,
                                                     expand, self.bmaj_env,
                                                     os.path.dirname(self.bank.config.log_file))
                     else:
@@ -229,8 +349,9 @@ class MetaProcess(threading.Thread):
                                     log_dir=os.path.dirname(self.bank.config.log_file),
                                     use_sudo=use_sudo)
                             else:
-                                bmaj_process = Process(
+                                bmaj_process = LocalProcess(
                                     meta + '_' + name, exe, args,
+                                    cwd=self.bank.config.get('process.dir'),
                                     desc=desc,
                                     proc_type=proc_type,
                                     expand=expand,
@@ -252,7 +373,14 @@ class MetaProcess(threading.Thread):
                         span = Zipkin('biomaj-process', bmaj_process.name, trace_id=self.bank.config.get('zipkin_trace_id'), parent_id=self.bank.config.get('zipkin_span_id'))
                         bmaj_process.set_trace(span.get_trace_id(), span.get_span_id())
 
-                    res = bmaj_process.run(self.simulate)
+                    self.current_process = bmaj_process
+                    # Kill request received while process was defined
+                    if self.kill_received:
+                        raise Exception('Kill request received, exiting')
+                    try:
+                        res = bmaj_process.run(self.simulate)
+                    finally:
+                        self.current_process = None
 
                     if span:
                         span.add_binary_annotation('status', str(res))
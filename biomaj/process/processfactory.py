@@ -1,6 +1,5 @@
 import threading
 import logging
-import os
 from biomaj.process.metaprocess import MetaProcess
 
 
@@ -11,7 +10,7 @@ class ProcessFactory:
 
     NB_THREAD = 2
 
-    def __init__(self, bank, redis_client=None, redis_prefix=None):
+    def __init__(self, bank, redis_client=None, redis_prefix=None, cancel_event=None):
         self.bank = bank
         self.threads_tasks = []
         if self.bank.session:
@@ -20,6 +19,30 @@ class ProcessFactory:
             self.meta_data = {}
         self.redis_client = redis_client
         self.redis_prefix = redis_prefix
+        # Event set on cancel request, if None redis is checked
+        self.cancel_event = cancel_event
+        # Set per factory, banks can be updated at the same time (dependencies)
+        self.nb_thread = ProcessFactory.NB_THREAD
+        if self.bank.config.get('bank.num.threads') is not None:
+            self.nb_thread = int(self.bank.config.get('bank.num.threads'))
+
+    def _cancel_requested(self):
+        '''
+        Checks if a cancel request was received
+
+        :return: bool
+        '''
+        cancel_key = None
+        if self.redis_client:
+            cancel_key = self.redis_prefix + ':' + self.bank.name + ':action:cancel'
+        if self.cancel_event is not None:
+            if not self.cancel_event.is_set():
+                return False
+        elif not cancel_key or not self.redis_client.get(cancel_key):
+            return False
+        if cancel_key:
+            self.redis_client.delete(cancel_key)
+        return True
 
     def run(self, simulate=False):
         '''
@@ -40,7 +63,6 @@ class ProcessFactory:
         :return: tuple global execution status and status per meta process
         '''
         logging.debug('Start meta threads')
-        os.chdir(self.bank.config.get('process.dir'))
         threads = []
         running_th = []
         for thread_tasks in self.threads_tasks:
@@ -58,13 +80,15 @@ class ProcessFactory:
                 # Filter out threads which have been joined or are None
 
                 # Check for cancel request
-                if self.redis_client and self.redis_client.get(self.redis_prefix + ':' + self.bank.name + ':action:cancel'):
+                if not kill_received and self._cancel_requested():
                     logging.warn('Cancel requested, stopping process update')
-                    self.redis_client.delete(self.redis_prefix + ':' + self.bank.name + ':session:' + self.session)
                     kill_received = True
                     for t in running_th:
                         t.kill_received = True
-                running_th = [t.join(1000) for t in running_th if t is not None and t.is_alive()]
+                    for t in running_th:
+                        t.kill_process()
+                running_th[0].join(1)
+                running_th = [t for t in running_th if t.is_alive()]
             except KeyboardInterrupt:
                 logging.warn("Ctrl-c received! Sending kill to threads...")
                 logging.warn("Running tasks will continue and process will stop.")
@@ -94,13 +118,13 @@ class ProcessFactory:
         Dispatch meta processes in available threads
         '''
         self.threads_tasks = []
-        for i in range(0, ProcessFactory.NB_THREAD):
+        for i in range(0, self.nb_thread):
             # Fill array of meta process in future threads
             self.threads_tasks.append([])
         thread_id = 0
         for meta in metas:
             meta_process = meta.strip()
-            if thread_id == ProcessFactory.NB_THREAD:
+            if thread_id == self.nb_thread:
                 thread_id = 0
             self.threads_tasks[thread_id].append(meta_process)
             thread_id += 1
@@ -111,7 +135,7 @@ class PreProcessFactory(ProcessFactory):
     Manage preprocesses
     '''
 
-    def __init__(self, bank, metas=None, redis_client=None, redis_prefix=None):
+    def __init__(self, bank, metas=None, redis_client=None, redis_prefix=None, cancel_event=None):
         '''
         Creates a preprocess factory
 
@@ -120,7 +144,7 @@ class PreProcessFactory(ProcessFactory):
         :param metas: initial status of meta processes
         :type metas: dict
         '''
-        ProcessFactory.__init__(self, bank, redis_client, redis_prefix)
+        ProcessFactory.__init__(self, bank, redis_client, redis_prefix, cancel_event)
         self.meta_status = None
         if metas is not None:
             self.meta_status = metas
@@ -149,7 +173,7 @@ class RemoveProcessFactory(ProcessFactory):
     Manage remove processes
     '''
 
-    def __init__(self, bank, metas=None, redis_client=None, redis_prefix=None):
+    def __init__(self, bank, metas=None, redis_client=None, redis_prefix=None, cancel_event=None):
         '''
         Creates a remove process factory
 
@@ -158,7 +182,7 @@ class RemoveProcessFactory(ProcessFactory):
         :param metas: initial status of meta processes
         :type metas: dict
         '''
-        ProcessFactory.__init__(self, bank, redis_client, redis_prefix)
+        ProcessFactory.__init__(self, bank, redis_client, redis_prefix, cancel_event)
         self.meta_status = None
         if metas is not None:
             self.meta_status = metas
@@ -190,7 +214,7 @@ class PostProcessFactory(ProcessFactory):
     Each meta process status is a dict of process status
     '''
 
-    def __init__(self, bank, blocks=None, redis_client=None, redis_prefix=None):
+    def __init__(self, bank, blocks=None, redis_client=None, redis_prefix=None, cancel_event=None):
         '''
         Creates a postprocess factory
 
@@ -199,7 +223,7 @@ class PostProcessFactory(ProcessFactory):
         :param blocks: initial status of block processes
         :type blocks: dict
         '''
-        ProcessFactory.__init__(self, bank, redis_client, redis_prefix)
+        ProcessFactory.__init__(self, bank, redis_client, redis_prefix, cancel_event)
         self.blocks = {}
         if blocks is not None:
             self.blocks = blocks
@@ -0,0 +1,104 @@
+import logging
+import threading
+import traceback
+
+from pymongo import WriteConcern
+
+from biomaj.mongo_connector import MongoConnector
+
+
+class ProgressWriter:
+    '''
+    Buffer bank progress status updates and write them in background.
+
+    Updates are kept in memory, the last value of a field replacing the
+    previous ones, and written every *interval* seconds as a single $set
+    on the bank document. With an interval of 0, updates are written
+    immediately.
+    '''
+
+    def __init__(self, name, interval=2, relaxed=False):
+        '''
+        Creates a writer
+
+        :param name: bank name
+        :type name: str
+        :param interval: number of seconds between two writes
+        :type interval: float
+        :param relaxed: do not wait for database acknowledgement of writes
+        :type relaxed: bool
+        '''
+        self.name = name
+        self.interval = float(interval)
+        self.relaxed = relaxed
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _get_collection(self):
+        banks = MongoConnector.banks
+        if self.relaxed:
+            banks = banks.with_options(write_concern=WriteConcern(w=0))
+        return banks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def set(self, field, value):
+        '''
+        Sets a field of bank document
+
+        :param field: field name, in dot notation (status.download.progress)
+        :type field: str
+        :param value: field value
+        '''
+        with self._lock:
+            # A parent field replaces any previous update of its sub fields
+            for key in list(self.pending.keys()):
+                if key.startswith(field + '.'):
+                    del self.pending[key]
+            self.pending[field] = value
+        if self._thread is None or self._stopped.is_set():
+            self.flush()
+
+    def flush(self):
+        '''
+        Write pending updates
+        '''
+        # Keep writes ordered if flush is called from several threads
+        with self._write_lock:
+            with self._lock:
+                pending = self.pending
+                self.pending = {}
+            if not pending:
+                return
+            # Fields can't be updated along with one of their parent fields
+            updates = [{}]
+            for field in sorted(pending.keys()):
+                parents = [field[:i] for i in range(len(field)) if field[i] == '.']
+                if any(parent in updates[-1] for parent in parents):
+                    updates.append({})
+                updates[-1][field] = pending[field]
+            try:
+                banks = self._get_collection()
+                for update in updates:
+                    banks.update({'name': self.name}, {'$set': update})
+            except Exception as e:
+                logging.error('Progress:' + self.name + ':Error:' + str(e))
+                logging.debug(traceback.format_exc())
+
+    def close(self):
+        '''
+        Stop background writes and write pending updates
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
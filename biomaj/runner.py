@@ -0,0 +1,111 @@
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from biomaj_core.config import BiomajConfig
+
+from biomaj.mongo_connector import MongoConnector
+from biomaj.dependency import DependencyGraph
+from biomaj.scheduler import StepScheduler
+
+
+def update_bank(name, options=None, config_file=None):
+    '''
+    Update a bank, executed in a separate process by :class:`BankRunner`
+
+    :param name: bank name
+    :type name: str
+    :param options: bank options
+    :type options: :class:`biomaj.options.Options`
+    :param config_file: global.properties file path, used if configuration is not loaded
+    :type config_file: str
+    :return: tuple update status and error message
+    '''
+    from biomaj.bank import Bank
+    if BiomajConfig.global_config is None:
+        BiomajConfig.load_config(config_file)
+    # Never reuse a connection inherited from parent process
+    MongoConnector.db = None
+    try:
+        bank = Bank(name, options)
+        return (bank.update(depends=False), None)
+    except Exception as e:
+        logging.error('Runner:' + name + ':Exception:' + str(e))
+        logging.debug(traceback.format_exc())
+        return (False, str(e))
+
+
+class BankRunner:
+    '''
+    Update a list of banks, running independent banks concurrently.
+
+    A bank is updated only once all the banks it depends on (*depends*
+    property, directly or not) and which are part of the run were
+    successfully updated. A failure only prevents banks depending on the
+    failed bank from being updated.
+    '''
+
+    def __init__(self, banks, options=None, max_workers=2, with_depends=False):
+        '''
+        Creates a runner
+
+        :param banks: list of bank names
+        :type banks: list
+        :param options: options given to each bank update
+        :type options: :class:`biomaj.options.Options`
+        :param max_workers: max number of banks updated at the same time
+        :type max_workers: int
+        :param with_depends: also update dependencies not listed in *banks*
+        :type with_depends: bool
+        '''
+        self.banks = []
+        for bank in banks:
+            if bank not in self.banks:
+                self.banks.append(bank)
+        self.options = options
+        self.max_workers = max(1, int(max_workers))
+        # bank => list of all banks it depends on
+        self.depends = {}
+        # bank => True (updated), False (error), None (not updated)
+        self.status = {}
+        # bank => error message
+        self.errors = {}
+        self._load_depends(with_depends)
+
+    def _load_depends(self, with_depends=False):
+        '''
+        Loads the dependencies of all banks
+
+        :param with_depends: add dependencies to the banks to update
+        :type with_depends: bool
+        :raise: Exception if a bank depends on itself
+        '''
+        graph = DependencyGraph(self.options)
+        order = graph.get_order(self.banks)
+        for bank in order:
+            self.depends[bank] = graph.get_dependencies(bank)
+        if with_depends:
+            self.banks = order
+
+    def run(self):
+        '''
+        Run bank updates
+
+        :return: bool, True if all banks were successfully updated
+        '''
+        scheduler = StepScheduler(self.banks, self.depends, max_workers=self.max_workers, stop_on_failure=False)
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            def run_bank(name):
+                logging.info('Runner:' + name + ':Update')
+                (res, error) = executor.submit(update_bank, name, self.options, BiomajConfig.config_file).result()
+                if error:
+                    self.errors[name] = error
+                logging.info('Runner:' + name + ':' + str(res))
+                return res
+            (res, self.status) = scheduler.run(run_bank)
+        for bank in self.banks:
+            if self.status[bank] is None:
+                failed = [dep for dep in self.depends[bank] if self.status.get(dep) is False]
+                self.errors[bank] = 'Dependency failed: ' + ','.join(failed)
+                logging.warn('Runner:' + bank + ':Skipped:' + self.errors[bank])
+        return res
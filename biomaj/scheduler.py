@@ -0,0 +1,102 @@
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class StepScheduler:
+    '''
+    Execute named tasks following a dependency graph.
+
+    Tasks whose dependencies all succeeded are started concurrently in a
+    bounded thread pool. After a failure, or if a task is refused by the
+    *can_start* callback, no new task is started and running tasks are
+    waited for. If *stop_on_failure* is False, a failure only prevents
+    tasks depending on the failed task from running.
+    '''
+
+    def __init__(self, tasks, depends=None, max_workers=2, stop_on_failure=True):
+        '''
+        Creates a scheduler
+
+        :param tasks: ordered list of task names
+        :type tasks: list
+        :param depends: task name => list of task names it requires, dependencies not in tasks are ignored
+        :type depends: dict
+        :param max_workers: max number of tasks running at the same time
+        :type max_workers: int
+        :param stop_on_failure: stop scheduling new tasks after a task failure
+        :type stop_on_failure: bool
+        '''
+        if depends is None:
+            depends = {}
+        self.tasks = list(tasks)
+        self.max_workers = max(1, int(max_workers))
+        self.stop_on_failure = stop_on_failure
+        self.depends = {}
+        for task in self.tasks:
+            self.depends[task] = [dep for dep in depends.get(task, []) if dep in self.tasks and dep != task]
+        self._check_cycles()
+
+    def _check_cycles(self):
+        '''
+        Checks graph can be fully executed
+
+        :raise: Exception if a cycle is found
+        '''
+        done = set()
+        remaining = list(self.tasks)
+        while remaining:
+            ready = [task for task in remaining if all(dep in done for dep in self.depends[task])]
+            if not ready:
+                raise Exception('Cycle detected in tasks dependencies: ' + ','.join(remaining))
+            for task in ready:
+                done.add(task)
+                remaining.remove(task)
+
+    def run(self, run_task, can_start=None):
+        '''
+        Run tasks
+
+        :param run_task: function called with task name, returns task status
+        :type run_task: function
+        :param can_start: optional function called with task name before starting it, if it returns False, stop scheduling
+        :type can_start: function
+        :return: tuple global status and dict of status per task (None if task was not executed)
+        '''
+        status = {}
+        for task in self.tasks:
+            status[task] = None
+        pending = list(self.tasks)
+        running = {}
+        go_ahead = True
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if go_ahead:
+                    for task in list(pending):
+                        if not all(status[dep] for dep in self.depends[task]):
+                            continue
+                        if can_start is not None and not can_start(task):
+                            go_ahead = False
+                            break
+                        logging.debug('Scheduler:Start:' + task)
+                        pending.remove(task)
+                        running[executor.submit(run_task, task)] = task
+                if not running:
+                    break
+                (done, _) = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        status[task] = bool(future.result())
+                    except Exception as e:
+                        logging.error('Scheduler:' + task + ':Exception:' + str(e))
+                        logging.debug(traceback.format_exc())
+                        status[task] = False
+                    logging.debug('Scheduler:Over:' + task + ':' + str(status[task]))
+                    if not status[task] and self.stop_on_failure:
+                        go_ahead = False
+        global_status = go_ahead and not pending
+        for task in self.tasks:
+            if not status[task]:
+                global_status = False
+        return (global_status, status)
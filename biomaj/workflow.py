@@ -9,21 +9,16 @@ import traceback
 import json
 import hashlib
 import sys
+import threading
+import errno
+import stat
 
 from biomaj_core.utils import Utils
-from biomaj_download.downloadclient import DownloadClient
-from biomaj_download.message import downmessage_pb2
-from biomaj_download.download.curl import HTTPParse
-from biomaj_download.download.localcopy import LocalDownload
 
 from biomaj.mongo_connector import MongoConnector
 from biomaj.options import Options
-from biomaj.process.processfactory import RemoveProcessFactory, PreProcessFactory, PostProcessFactory
-
-from biomaj_zipkin.zipkin import Zipkin
-from yapsy.PluginManager import PluginManager
-
-from packaging.version import parse
+from biomaj.scheduler import StepScheduler
+from biomaj.progress import ProgressWriter
 
 
 class Workflow:
@@ -48,6 +43,9 @@ class Workflow:
         {'name': 'over', 'steps': []}
     ]
 
+    # Steps a flow step requires, used when steps.parallel is set
+    STEPS_DEPENDS = {}
+
     def __init__(self, bank, session=None):
         """
         Instantiate a new workflow
@@ -73,14 +71,159 @@ class Workflow:
         # For micro services
         self.redis_client = None
         self.redis_prefix = None
+        # Set once a cancel request is received
+        self.cancel_event = threading.Event()
+        # Background listener setting cancel_event, if any
+        self.cancel_listener = None
         # Zipkin
         self.span = None
+        # Bank status updates, set up when workflow starts
+        self.progress = None
+
+    def _get_progress(self):
+        """
+        Gets the bank status writer, created on first use if workflow was not
+        started (wf_* methods called directly), writing updates immediately
+
+        :return: :class:`biomaj.progress.ProgressWriter`
+        """
+        if self.progress is None:
+            self.progress = ProgressWriter(self.name, interval=0)
+        return self.progress
 
     def get_flow(self, task):
         for flow in Workflow.FLOW:
             if flow['name'] == task:
                 return flow
 
+    def _cancel_requested(self):
+        """
+        Checks if a cancel request was sent for this bank, and consume it
+
+        :return: bool
+        """
+        if not self.cancel_event.is_set():
+            # Without listener, check redis directly
+            if self.cancel_listener is not None or not self.redis_client:
+                return False
+            if not self.redis_client.get(self.redis_prefix + ':' + self.bank.name + ':action:cancel'):
+                return False
+            self.cancel_event.set()
+        logging.warn('Cancel requested, stopping update')
+        if self.redis_client:
+            self.redis_client.delete(self.redis_prefix + ':' + self.bank.name + ':action:cancel')
+        return True
+
+    def _set_timing(self, name, start, duration, parent=None):
+        """
+        Record timing of a flow or step in session stats
+
+        :param name: flow or step name
+        :type name: str
+        :param start: start timestamp
+        :type start: float
+        :param duration: duration in seconds
+        :type duration: float
+        :param parent: flow name, for a step
+        :type parent: str
+        """
+        timing = {'start': start, 'end': start + duration, 'duration': duration}
+        if parent:
+            timing['parent'] = parent
+        self.session._session['stats']['timing'][name] = timing
+
+    def _add_file_timing(self, task, name, duration, size=None):
+        """
+        Record time spent on a file by a task if stats.files is set
+
+        :param task: task name (download, uncompress)
+        :type task: str
+        :param name: file name
+        :type name: str
+        :param duration: duration in seconds
+        :type duration: float
+        :param size: number of bytes processed
+        :type size: int
+        """
+        if not self.session.config.get_bool('stats.files', default=False):
+            return
+        files = self.session._session['stats'].setdefault('files', {})
+        file_timing = {'name': name, 'duration': duration}
+        if size is not None:
+            file_timing['bytes'] = size
+        files.setdefault(task, []).append(file_timing)
+
+    def _run_step(self, flow, step):
+        """
+        Execute a sub task of a flow
+
+        :param flow: flow the step belongs to
+        :type flow: dict
+        :param step: name of the step
+        :type step: str
+        :return: bool, status of the step
+        """
+        span = None
+        start_timestamp = time.time()
+        start_monotonic = time.monotonic()
+        try:
+            if self.options.get_option('traceId'):
+                from biomaj_zipkin.zipkin import Zipkin
+                trace_id = self.options.get_option('traceId')
+                span_id = self.options.get_option('spanId')
+                span = Zipkin('biomaj-workflow', flow['name'] + ":wf_" + step, trace_id=trace_id, parent_id=span_id)
+                self.span = span
+                self.bank.config.set('zipkin_trace_id', span.get_trace_id())
+                self.bank.config.set('zipkin_span_id', span.get_span_id())
+            res = getattr(self, 'wf_' + step)()
+
+            if span:
+                span.add_binary_annotation('status', str(res))
+                span.trace()
+
+            if not res:
+                logging.error('Error during ' + flow['name'] + ' subtask: wf_' + step)
+            return res
+        except Exception as e:
+            logging.error('Workflow:' + flow['name'] + ' subtask: wf_' + step + ':Exception:' + str(e))
+            logging.debug(traceback.format_exc())
+            return False
+        finally:
+            self._set_timing(step, start_timestamp, time.monotonic() - start_monotonic, parent=flow['name'])
+
+    def _run_steps(self, flow):
+        """
+        Execute sub tasks of a flow, sequentially or, if steps.parallel is set,
+        following STEPS_DEPENDS with independent steps run concurrently
+
+        :param flow: flow to execute steps of
+        :type flow: dict
+        :return: True if all steps are successful, False on error, None if cancelled
+        """
+        cancelled = []
+
+        def can_start(step):
+            if self._cancel_requested():
+                cancelled.append(step)
+                return False
+            return True
+
+        if not self.session.config.get_bool('steps.parallel', default=False):
+            for step in flow['steps']:
+                if not can_start(step):
+                    return None
+                if not self._run_step(flow, step):
+                    return False
+            return True
+
+        nb_threads = int(self.session.config.get('steps.num.threads', default='2'))
+        logging.info('Workflow:' + flow['name'] + ':Steps:Parallel:' + str(nb_threads))
+        scheduler = StepScheduler(flow['steps'], self.STEPS_DEPENDS, max_workers=nb_threads)
+        (res, _) = scheduler.run(lambda step: self._run_step(flow, step), can_start=can_start)
+        if cancelled:
+            return None
+        return res
+
     def start(self):
         """
         Start the workflow
@@ -91,10 +234,18 @@ class Workflow:
                 'workflow': {},
                 'nb_downloaded_files': 0
             }
+        if 'timing' not in self.session._session['stats']:
+            self.session._session['stats']['timing'] = {}
+        self.progress = ProgressWriter(
+            self.name,
+            interval=float(self.session.config.get('progress.flush.interval', default='2')),
+            relaxed=self.session.config.get_bool('progress.relaxed.write', default=False)
+        )
+        self.bank.progress = self.progress
 
         for flow in self.session.flow:
-            dt = datetime.datetime.now()
-            start_timestamp = time.mktime(dt.timetuple())
+            start_timestamp = time.time()
+            start_monotonic = time.monotonic()
             if self.skip_all:
                 logging.info('Workflow:Skip:' + flow['name'])
                 self.session._session['status'][flow['name']] = None
@@ -106,9 +257,7 @@ class Workflow:
                 break
 
             # Check for cancel request
-            if self.redis_client and self.redis_client.get(self.redis_prefix + ':' + self.bank.name + ':action:cancel'):
-                logging.warn('Cancel requested, stopping update')
-                self.redis_client.delete(self.redis_prefix + ':' + self.bank.name + ':action:cancel')
+            if self._cancel_requested():
                 self.wf_over()
                 return False
 
@@ -119,6 +268,7 @@ class Workflow:
                 logging.info('Workflow:Start:' + flow['name'])
                 span = None
                 if self.options.get_option('traceId'):
+                    from biomaj_zipkin.zipkin import Zipkin
                     trace_id = self.options.get_option('traceId')
                     span_id = self.options.get_option('spanId')
                     span = Zipkin('biomaj-workflow', flow['name'], trace_id=trace_id, parent_id=span_id)
@@ -143,47 +293,24 @@ class Workflow:
                     logging.error('Error during task ' + flow['name'])
                     if flow['name'] != Workflow.FLOW_INIT:
                         self.wf_over()
+                    else:
+                        self._get_progress().close()
                     return False
                 # Main task is over, execute sub tasks of main
-                if not self.skip_all:
-                    for step in flow['steps']:
-                        span = None
-                        try:
-                            # Check for cancel request
-                            if self.redis_client and self.redis_client.get(self.redis_prefix + ':' + self.bank.name + ':action:cancel'):
-                                logging.warn('Cancel requested, stopping update')
-                                self.redis_client.delete(self.redis_prefix + ':' + self.bank.name + ':action:cancel')
-                                self.wf_over()
-                                return False
-
-                            if self.options.get_option('traceId'):
-                                trace_id = self.options.get_option('traceId')
-                                span_id = self.options.get_option('spanId')
-                                span = Zipkin('biomaj-workflow', flow['name'] + ":wf_" + step, trace_id=trace_id, parent_id=span_id)
-                                self.span = span
-                                self.bank.config.set('zipkin_trace_id', span.get_trace_id())
-                                self.bank.config.set('zipkin_span_id', span.get_span_id())
-                            res = getattr(self, 'wf_' + step)()
-
-                            if span:
-                                span.add_binary_annotation('status', str(res))
-                                span.trace()
-
-                            if not res:
-                                logging.error('Error during ' + flow['name'] + ' subtask: wf_' + step)
-                                logging.error('Revert main task status ' + flow['name'] + ' to error status')
-                                self.session._session['status'][flow['name']] = False
-                                self.wf_over()
-                                return False
-                        except Exception as e:
-                            logging.error('Workflow:' + flow['name'] + ' subtask: wf_' + step + ':Exception:' + str(e))
-                            self.session._session['status'][flow['name']] = False
-                            logging.debug(traceback.format_exc())
-                            self.wf_over()
-                            return False
-            dt = datetime.datetime.now()
-            end_timestamp = time.mktime(dt.timetuple())
-            self.session._session['stats']['workflow'][flow['name']] = end_timestamp - start_timestamp
+                if not self.skip_all and flow['steps']:
+                    res = self._run_steps(flow)
+                    if res is None:
+                        # Cancelled
+                        self.wf_over()
+                        return False
+                    if not res:
+                        logging.error('Revert main task status ' + flow['name'] + ' to error status')
+                        self.session._session['status'][flow['name']] = False
+                        self.wf_over()
+                        return False
+            duration = time.monotonic() - start_monotonic
+            self.session._session['stats']['workflow'][flow['name']] = duration
+            self._set_timing(flow['name'], start_timestamp, duration)
             if self.options.get_option(Options.STOP_AFTER) == flow['name']:
                 self.wf_over()
                 break
@@ -206,12 +333,14 @@ class Workflow:
                 status[flow['name']] = {'status': None, 'progress': ''}
             else:
                 status[flow['name']] = {'status': None, 'progress': 0}
-        MongoConnector.banks.update({'name': self.name}, {'$set': {'status': status}})
+        self._get_progress().set('status', status)
+        self._get_progress().flush()
 
     def wf_progress_end(self):
         """
         Reset progress status when workflow is over
         """
+        self._get_progress().close()
         return True
 
     def wf_progress(self, task, status):
@@ -219,7 +348,7 @@ class Workflow:
         Update bank status
         """
         subtask = 'status.' + task + '.status'
-        MongoConnector.banks.update({'name': self.name}, {'$set': {subtask: status}})
+        self._get_progress().set(subtask, status)
 
     def wf_init(self):
         """
@@ -254,6 +383,8 @@ class Workflow:
         lock_file = os.path.join(lock_dir, self.name + '.lock')
         if os.path.exists(lock_file):
             os.remove(lock_file)
+        # Write last status updates
+        self._get_progress().close()
         return True
 
 
@@ -298,9 +429,10 @@ class RemoveWorkflow(Workflow):
         return self.bank.remove_session(self.session.get('update_session_id'))
 
     def wf_removeprocess(self):
+        from biomaj.process.processfactory import RemoveProcessFactory
         logging.info('Workflow:wf_removepreprocess')
         metas = self.session._session['process']['removeprocess']
-        pfactory = RemoveProcessFactory(self.bank, metas, redis_client=self.redis_client, redis_prefix=self.redis_prefix)
+        pfactory = RemoveProcessFactory(self.bank, metas, redis_client=self.redis_client, redis_prefix=self.redis_prefix, cancel_event=self.cancel_event)
         res = pfactory.run()
         self.session._session['process']['removeprocess'] = pfactory.meta_status
         return res
@@ -323,6 +455,21 @@ class UpdateWorkflow(Workflow):
         {'name': 'over', 'steps': []}
     ]
 
+    # delete_old switches bank session while removing releases,
+    # clean_old_sessions must wait for it
+    STEPS_DEPENDS = {
+        'checksum': [],
+        'uncompress': ['checksum'],
+        'copy': ['uncompress'],
+        'copydepends': [],
+        'metadata': [],
+        'stats': [],
+        'old_biomaj_api': [],
+        'clean_offline': [],
+        'delete_old': [],
+        'clean_old_sessions': ['delete_old']
+    }
+
     def __init__(self, bank):
         """
         Instantiate a new workflow
@@ -333,8 +480,26 @@ class UpdateWorkflow(Workflow):
         Workflow.__init__(self, bank)
         logging.debug('New workflow')
         self.session._session['update'] = True
+        # Files already checked and extracted during download
+        self.pipeline_done = set()
+        # Extracted archives, kept until all files are extracted
+        self.archives = []
+        self.checksum_engine = None
+        self.copy_engine = None
+        self.copy_lock = threading.Lock()
+        # Files hashed while downloading, save_as => file info
+        self.inline_files = {}
+        self.inline_manifests = {}
+        # Digests listed in checksum manifests, directory => file path => digests
+        self.manifests = {}
+        self.manifests_lock = threading.Lock()
+        self.uncompress_lock = threading.Lock()
+        # Archives of last production release, save_as => file info, and its flat directory
+        self.previous_archives = None
+        self.previous_flat_dir = None
 
     def _get_plugin(self, name, plugin_args):
+        from yapsy.PluginManager import PluginManager
         options = {}
         plugins_dir = self.bank.config.get('plugins_dir')
         if not plugins_dir:
@@ -369,19 +534,260 @@ class UpdateWorkflow(Workflow):
 
         return True
 
+    def _get_checksum_engine(self):
+        """
+        Gets the checksum engine of the workflow, created on first use
+        """
+        if self.checksum_engine is None:
+            from biomaj.checksum import ChecksumEngine
+            pool_size = self.session.config.get('checksum.num.threads', default=None)
+            if pool_size is None:
+                pool_size = self.session.config.get('files.num.threads', default='2')
+            buffer_size = self.session.config.get('checksum.buffer.size', default='1048576')
+            cache = None
+            cache_dir = self.session.config.get('cache.dir')
+            if self.session.config.get_bool('checksum.cache', default=True) and cache_dir and os.path.isdir(cache_dir):
+                from biomaj.checksum import ChecksumCache
+                cache = ChecksumCache(os.path.join(cache_dir, 'checksums_' + self.name))
+            self.checksum_engine = ChecksumEngine(max_workers=int(pool_size), buffer_size=int(buffer_size), cache=cache)
+        return self.checksum_engine
+
+    def _get_copy_engine(self):
+        """
+        Gets the copy engine of the workflow, created on first use
+        """
+        with self.copy_lock:
+            if self.copy_engine is None:
+                self.copy_engine = self._new_copy_engine(self.session.config.get_bool('use_hardlinks', default=False))
+            return self.copy_engine
+
+    def _new_copy_engine(self, use_hardlinks):
+        """
+        Creates a copy engine (copy.num.threads, copy.reflink)
+
+        :param use_hardlinks: hard link files if possible
+        :type use_hardlinks: bool
+        :return: :class:`biomaj.filecopy.CopyEngine`
+        """
+        from biomaj.filecopy import CopyEngine
+        pool_size = self.session.config.get('copy.num.threads', default=None)
+        if pool_size is None:
+            pool_size = self.session.config.get('files.num.threads', default='2')
+        return CopyEngine(
+            max_workers=int(pool_size),
+            use_hardlinks=use_hardlinks,
+            use_reflinks=self.session.config.get_bool('copy.reflink', default=True)
+        )
+
+    def _set_copy_stats(self, copy_engine=None, name='copy'):
+        """
+        Record copy statistics in session stats
+
+        :param copy_engine: copy engine, default workflow copy engine
+        :type copy_engine: :class:`biomaj.filecopy.CopyEngine`
+        :param name: name of statistics in session stats
+        :type name: str
+        """
+        if copy_engine is None:
+            copy_engine = self.copy_engine
+        if copy_engine is None:
+            return
+        stats = copy_engine.get_stats()
+        self.session._session['stats'][name] = stats
+        for method in stats['methods']:
+            logging.info('Workflow:Copy:%s:%d files, %d bytes, %.1f MB/s' % (method, stats['methods'][method]['files'], stats['methods'][method]['bytes'], stats['methods'][method]['throughput'] / 1048576))
+
     def _md5(self, fname):
-        hash_md5 = hashlib.md5()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return self._get_checksum_engine().hash_file(fname, ['md5'])['md5']
 
     def _sha256(self, fname):
-        hash_sha256 = hashlib.sha256()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha256.update(chunk)
-        return hash_sha256.hexdigest()
+        return self._get_checksum_engine().hash_file(fname, ['sha256'])['sha256']
+
+    def _get_expected_checksums(self, downloaded_file):
+        """
+        Gets the expected digests of a downloaded file from remote listing, the
+        manifests of its directory and its .md5 and .sha256 files, if present
+
+        :param downloaded_file: downloaded file info
+        :type downloaded_file: dict
+        :return: dict algorithm => expected digest
+        """
+        offline_dir = self.session.get_offline_directory()
+        downloaded_file_name = downloaded_file.get('save_as', downloaded_file['name'])
+        expected = self._get_listing_checksums(downloaded_file)
+        expected.update(self._get_manifest_checksums(downloaded_file_name))
+        for algorithm in ['md5', 'sha256']:
+            cksum_file = os.path.join(offline_dir, downloaded_file_name + '.' + algorithm)
+            if os.path.exists(cksum_file):
+                with open(cksum_file, 'r') as cksum_content:
+                    data = cksum_content.read().split()
+                    if data:
+                        expected[algorithm] = data[0]
+        return expected
+
+    def _get_listing_checksums(self, downloaded_file):
+        """
+        Gets the digests of a file given by remote listing (md5 and, if
+        checksum.listing.hash sets its algorithm, hash)
+
+        :param downloaded_file: downloaded file info
+        :type downloaded_file: dict
+        :return: dict algorithm => digest
+        """
+        listing = {}
+        if downloaded_file.get('md5'):
+            listing['md5'] = downloaded_file['md5']
+        # By default, hash only identifies a remote file version (listing line, date...)
+        hash_algorithm = self.session.config.get('checksum.listing.hash', default=None)
+        if hash_algorithm and downloaded_file.get('hash'):
+            listing[hash_algorithm] = downloaded_file['hash']
+        checksums = {}
+        for (algorithm, digest) in listing.items():
+            try:
+                digest_size = hashlib.new(algorithm).digest_size
+            except ValueError:
+                logging.warn('Workflow:wf_checksum:UnknownAlgorithm:' + algorithm)
+                continue
+            digest = str(digest).strip().lower()
+            if len(digest) == 2 * digest_size and re.match('^[0-9a-f]+$', digest):
+                checksums[algorithm] = digest
+        return checksums
+
+    def _is_manifest(self, name):
+        """
+        Checks if a file is a checksum manifest (checksum.manifest)
+
+        :param name: file path relative to offline directory
+        :type name: str
+        :return: bool
+        """
+        pattern = self.session.config.get('checksum.manifest', default=None)
+        if not pattern:
+            return False
+        return re.match('(' + pattern + ')$', os.path.basename(name)) is not None
+
+    def _get_manifests(self, names):
+        """
+        Gets the checksum manifests among files
+
+        :param names: file paths relative to offline directory
+        :type names: list or dict
+        :return: dict directory => list of manifests
+        """
+        manifests = {}
+        for name in names:
+            if self._is_manifest(name):
+                manifests.setdefault(os.path.dirname(name), []).append(name)
+        return manifests
+
+    def _get_manifest_checksums(self, name):
+        """
+        Gets the digests of a file listed in the manifests of its directory.
+        Manifests of a directory are parsed only once.
+
+        :param name: file path relative to offline directory
+        :type name: str
+        :return: dict algorithm => digest
+        """
+        if not self.session.config.get('checksum.manifest', default=None):
+            return {}
+        directory = os.path.dirname(name)
+        with self.manifests_lock:
+            if directory not in self.manifests:
+                from biomaj.checksum import ChecksumManifest
+                checksums = {}
+                dir_path = os.path.join(self.session.get_offline_directory(), directory)
+                for manifest in sorted(os.listdir(dir_path)):
+                    manifest_path = os.path.join(dir_path, manifest)
+                    if not self._is_manifest(manifest) or not os.path.isfile(manifest_path):
+                        continue
+                    logging.debug('Workflow:wf_checksum:Manifest:' + os.path.join(directory, manifest))
+                    for (file_name, digests) in ChecksumManifest.parse(manifest_path).items():
+                        checksums.setdefault(os.path.normpath(os.path.join(directory, file_name)), {}).update(digests)
+                self.manifests[directory] = checksums
+        return self.manifests[directory].get(os.path.normpath(name), {})
+
+    def _check_digests(self, downloaded_file_name, expected, digests):
+        """
+        Compares computed digests of a file with expected ones
+
+        :return: bool, False if a checksum does not match
+        """
+        error = False
+        for algorithm in expected:
+            logging.debug('Wf_checksum:%s:%s:%s:%s' % (algorithm, downloaded_file_name, digests[algorithm], expected[algorithm]))
+            if digests[algorithm] != expected[algorithm]:
+                logging.error('Invalid %s checksum for file %s' % (algorithm, downloaded_file_name))
+                error = True
+        if error and self.checksum_engine is not None and self.checksum_engine.cache is not None:
+            # Do not reuse digests of a corrupted file
+            self.checksum_engine.cache.remove(os.path.join(self.session.get_offline_directory(), downloaded_file_name))
+        return not error
+
+    def _checksum_file(self, downloaded_file):
+        """
+        Checks a downloaded file against remote listing digests, its manifests and .md5 and .sha256 files, if present
+
+        :param downloaded_file: downloaded file info
+        :type downloaded_file: dict
+        :return: bool, False if a checksum does not match
+        """
+        expected = self._get_expected_checksums(downloaded_file)
+        if not expected:
+            return True
+        downloaded_file_name = downloaded_file.get('save_as', downloaded_file['name'])
+        digests = downloaded_file.get('digests') or {}
+        if any(algorithm not in digests for algorithm in expected):
+            file_path = os.path.join(self.session.get_offline_directory(), downloaded_file_name)
+            # All digests are computed reading the file only once
+            digests = self._get_checksum_engine().hash_file(file_path, list(expected.keys()))
+        return self._check_digests(downloaded_file_name, expected, digests)
+
+    def _get_checksum_algorithms(self, name, expected_files, manifests=None):
+        """
+        Gets the digests to compute for a downloaded file
+
+        :param name: file path relative to offline directory
+        :type name: str
+        :param expected_files: file paths expected in offline directory
+        :type expected_files: list or dict
+        :param manifests: checksum manifests expected in offline directory, directory => list of manifests
+        :type manifests: dict
+        :return: list of algorithms
+        """
+        algorithms = [algorithm for algorithm in ['md5', 'sha256'] if name + '.' + algorithm in expected_files]
+        if manifests and name not in manifests.get(os.path.dirname(name), []):
+            from biomaj.checksum import ChecksumManifest
+            for manifest in manifests.get(os.path.dirname(name), []):
+                for algorithm in ChecksumManifest.get_algorithms(manifest):
+                    if algorithm not in algorithms:
+                        algorithms.append(algorithm)
+        return algorithms
+
+    def _hash_downloaded_file(self, downloaded_file):
+        """
+        Computes digests of a file as soon as it is downloaded, while its content
+        is still in page cache, and attach them to the file info (*digests*)
+
+        :param downloaded_file: file info returned by download handler
+        :type downloaded_file: dict
+        """
+        name = downloaded_file.get('save_as') or downloaded_file['name']
+        rfile = self.inline_files.get(name)
+        if rfile is None:
+            return
+        algorithms = self._get_checksum_algorithms(name, self.inline_files, self.inline_manifests)
+        for algorithm in self._get_listing_checksums(rfile):
+            if algorithm not in algorithms:
+                algorithms.append(algorithm)
+        if not algorithms:
+            return
+        try:
+            file_path = os.path.join(self.session.get_offline_directory(), name)
+            rfile['digests'] = self._get_checksum_engine().hash_file(file_path, algorithms)
+        except Exception as e:
+            # File will be hashed again by wf_checksum
+            logging.warn('Workflow:wf_download:Checksum:%s:%s' % (name, str(e)))
 
     def wf_checksum(self):
         logging.info('Workflow:wf_checksum')
@@ -391,31 +797,37 @@ class UpdateWorkflow(Workflow):
             return True
         '''
         offline_dir = self.session.get_offline_directory()
-        error = False
+        to_check = []
         for downloaded_file in self.downloaded_files:
-            downloaded_file_name = downloaded_file['name']
-            if 'save_as' in downloaded_file:
-                downloaded_file_name = downloaded_file['save_as']
-            md5_file = os.path.join(offline_dir, downloaded_file_name + '.md5')
-            if os.path.exists(md5_file):
-                with open(md5_file, 'r') as md5_content:
-                    data = md5_content.read().split()
-                    md5_cksum = data[0]
-                    downloaded_file_md5 = self._md5(os.path.join(offline_dir, downloaded_file_name))
-                    logging.debug('Wf_checksum:md5:%s:%s:%s' % (downloaded_file_name, downloaded_file_md5, md5_cksum))
-                    if downloaded_file_md5 != md5_cksum:
-                        logging.error('Invalid md5 checksum for file %s' % (downloaded_file_name))
-                        error = True
-            sha256_file = os.path.join(offline_dir, downloaded_file_name + '.sha256')
-            if os.path.exists(sha256_file):
-                with open(sha256_file, 'r') as sha256_content:
-                    data = sha256_content.read().split()
-                    sha256_cksum = data[0]
-                    downloaded_file_sha256 = self._sha256(os.path.join(offline_dir, downloaded_file_name))
-                    logging.debug('Wf_checksum:sha256:%s:%s:%s' % (downloaded_file_name, downloaded_file_sha256, sha256_cksum))
-                    if downloaded_file_sha256 != sha256_cksum:
-                        logging.error('Invalid sha256 checksum for file %s' % (downloaded_file_name))
-                        error = True
+            downloaded_file_name = downloaded_file.get('save_as', downloaded_file['name'])
+            if downloaded_file_name in self.pipeline_done:
+                # Already checked while downloading
+                continue
+            expected = self._get_expected_checksums(downloaded_file)
+            if expected:
+                to_check.append((downloaded_file_name, expected, downloaded_file.get('digests') or {}))
+        error = False
+        to_hash = []
+        for (downloaded_file_name, expected, digests) in to_check:
+            if any(algorithm not in digests for algorithm in expected):
+                to_hash.append((downloaded_file_name, expected))
+            elif not self._check_digests(downloaded_file_name, expected, digests):
+                # Digests computed while downloading
+                error = True
+        engine = self._get_checksum_engine()
+        try:
+            digests = engine.hash_files([(os.path.join(offline_dir, name), list(expected.keys())) for (name, expected) in to_hash])
+            for i in range(len(to_hash)):
+                (downloaded_file_name, expected) = to_hash[i]
+                if not self._check_digests(downloaded_file_name, expected, digests[i]):
+                    error = True
+        finally:
+            # Saved once digests of files failing the check are dropped
+            if engine.cache is not None:
+                engine.cache.save()
+        stats = engine.get_stats()
+        self.session._session['stats']['checksum'] = stats
+        logging.info('Workflow:wf_checksum:%d files, %d bytes, %.1f MB/s, %d files in cache' % (stats['files'], stats['bytes'], stats['throughput'] / 1048576, stats['cached']))
         if error:
             return False
         return True
@@ -450,45 +862,84 @@ class UpdateWorkflow(Workflow):
     def wf_copydepends(self):
         """
         Copy files from dependent banks if needed
+
+        Dependencies are processed concurrently (copydepends.num.threads).
+        Files are copied with a copy engine (hard links if use_hardlinks is
+        set, clones on copy on write file systems), or with depends.files.link
+        hard linked (hardlink) or symbolic linked (symlink) to the files of
+        dependency releases. Symbolic links are absolute, they break when the
+        dependency release is removed.
         """
+        from concurrent.futures import ThreadPoolExecutor
         logging.info('Workflow:wf_copydepends')
-        deps = self.bank.get_dependencies()
-        cf = self.session.config
-        for dep in deps:
-            if self.bank.config.get(dep + '.files.move'):
-                logging.info('Worflow:wf_depends:Files:Move:' + self.bank.config.get(dep + '.files.move'))
-                bdir = None
-                for bdep in self.bank.depends:
-                    if bdep.name == dep:
-                        bdir = bdep.session.get_full_release_directory()
-                        break
-                if bdir is None:
-                    logging.error('Could not find a session update for bank ' + dep)
-                    return False
-                # b = self.bank.get_bank(dep, no_log=True)
-                locald = LocalDownload(
-                    bdir,
-                    use_hardlinks=cf.get_bool("use_hardlinks", default=False)
-                )
-                (file_list, dir_list) = locald.list()
-                locald.match(self.bank.config.get(dep + '.files.move').split(), file_list, dir_list)
-                bankdepdir = self.bank.session.get_full_release_directory() + "/" + dep
-                if not os.path.exists(bankdepdir):
-                    os.mkdir(bankdepdir)
-                downloadedfiles = locald.download(bankdepdir)
-                locald.close()
-                if not downloadedfiles:
-                    logging.info('Workflow:wf_copydepends:no files to copy')
-                    return False
+        deps = [dep for dep in self.bank.get_dependencies() if self.bank.config.get(dep + '.files.move')]
+        if not deps:
+            return True
+        link = self.session.config.get('depends.files.link', default='copy')
+        copy_engine = self._new_copy_engine(link == 'hardlink' or self.session.config.get_bool('use_hardlinks', default=False))
+        pool_size = min(len(deps), int(self.session.config.get('copydepends.num.threads', default='2')))
+        with ThreadPoolExecutor(max_workers=max(1, pool_size)) as executor:
+            results = list(executor.map(lambda dep: self._copy_dependency(dep, link, copy_engine), deps))
+        self._set_copy_stats(copy_engine, 'copydepends')
+        return all(results)
+
+    def _copy_dependency(self, dep, link, copy_engine):
+        """
+        Copy files of a dependent bank matching <dep>.files.move in <release>/<dep>
+
+        :param dep: dependency bank name
+        :type dep: str
+        :param link: copy, hardlink or symlink
+        :type link: str
+        :param copy_engine: engine copying files
+        :type copy_engine: :class:`biomaj.filecopy.CopyEngine`
+        :return: bool, False if bank or files were not found
+        """
+        from biomaj_download.download.localcopy import LocalDownload
+        logging.info('Worflow:wf_depends:Files:Move:' + self.bank.config.get(dep + '.files.move'))
+        bdir = None
+        for bdep in self.bank.depends:
+            if bdep.name == dep:
+                bdir = bdep.session.get_full_release_directory()
+                break
+        if bdir is None:
+            logging.error('Could not find a session update for bank ' + dep)
+            return False
+        try:
+            locald = LocalDownload(bdir)
+            (file_list, dir_list) = locald.list()
+            locald.match(self.bank.config.get(dep + '.files.move').split(), file_list, dir_list)
+            locald.close()
+            files = locald.files_to_download
+            if not files:
+                logging.info('Workflow:wf_copydepends:no files to copy')
+                return False
+            bankdepdir = self.bank.session.get_full_release_directory() + "/" + dep
+            if link == 'symlink':
+                for rfile in files:
+                    name = rfile['name'].lstrip('/')
+                    target = os.path.join(bankdepdir, name)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(os.path.join(rfile['root'], name), target)
+            else:
+                copy_engine.copy_files(files, bankdepdir)
+        except Exception as e:
+            logging.error('Workflow:wf_copydepends:' + dep + ':' + str(e))
+            logging.debug(traceback.format_exc())
+            return False
+        logging.info('Workflow:wf_copydepends:%s:%d files (%s)' % (dep, len(files), link))
         return True
 
     def wf_preprocess(self):
         """
         Execute pre-processes
         """
+        from biomaj.process.processfactory import PreProcessFactory
         logging.info('Workflow:wf_preprocess')
         metas = self.session._session['process']['preprocess']
-        pfactory = PreProcessFactory(self.bank, metas, redis_client=self.redis_client, redis_prefix=self.redis_prefix)
+        pfactory = PreProcessFactory(self.bank, metas, redis_client=self.redis_client, redis_prefix=self.redis_prefix, cancel_event=self.cancel_event)
         res = pfactory.run()
         self.session._session['process']['preprocess'] = pfactory.meta_status
         return res
@@ -506,7 +957,12 @@ class UpdateWorkflow(Workflow):
         '''
         Update some info in db for current bank
         '''
-        if info is not None:
+        if info is None:
+            return
+        if list(info.keys()) == ['$set']:
+            for field in info['$set']:
+                self._get_progress().set(field, info['$set'][field])
+        else:
             MongoConnector.banks.update({'name': self.bank.name},
                                         info)
 
@@ -514,6 +970,7 @@ class UpdateWorkflow(Workflow):
         '''
         Try to find most release from releases input array
         '''
+        from packaging.version import parse
         release = releases[0]
         release_version = parse(release)
         logging.debug('found a release %s' % (release))
@@ -531,6 +988,8 @@ class UpdateWorkflow(Workflow):
         """
         Find current release on remote
         """
+        from biomaj_download.downloadclient import DownloadClient
+        from biomaj_download.download.curl import HTTPParse
         logging.info('Workflow:wf_release')
         release = None
         cf = self.session.config
@@ -1020,10 +1479,33 @@ class UpdateWorkflow(Workflow):
                 rfile['root'] = self.session.config.get('remote.dir')
         return data
 
+    def _get_inline_hash(self, copied_files, downloaders):
+        """
+        Prepare digests computation while downloading (checksum.inline)
+
+        :return: function to call on downloaded files, None if disabled
+        """
+        if not self.session.config.get_bool('checksum.inline', default=True):
+            return None
+        self.inline_files = {}
+        for rfile in copied_files:
+            self.inline_files[rfile.get('save_as') or rfile['name']] = rfile
+        for downloader in downloaders:
+            for rfile in downloader.files_to_download:
+                self.inline_files[rfile.get('save_as') or rfile['name']] = rfile
+        self.inline_manifests = self._get_manifests(self.inline_files)
+        # Engine is shared by download threads
+        self._get_checksum_engine()
+        return self._hash_downloaded_file
+
     def wf_download(self):
         """
         Download remote files or use an available local copy from last production directory if possible.
         """
+        from biomaj_download.downloadclient import DownloadClient
+        from biomaj_download.message import downmessage_pb2
+        from biomaj_download.download.curl import HTTPParse
+        from biomaj.pipeline import FilePipeline, LocalDownloadClient
         logging.info('Workflow:wf_download')
         # flow = self.get_flow(Workflow.FLOW_DOWNLOAD)
         downloader = None
@@ -1489,15 +1971,14 @@ class UpdateWorkflow(Workflow):
             for downloader in downloaders:
                 copied_files += downloader.files_to_copy
                 logging.info('Workflow:wf_download:Copying %d files from %s' % (len(downloader.files_to_copy), last_production_dir))
-                Utils.copy_files(
-                    downloader.files_to_copy, offline_dir,
-                    use_hardlinks=cf.get_bool('use_hardlinks', default=False)
-                )
+                self._get_copy_engine().copy_files(downloader.files_to_copy, offline_dir)
+            self._set_copy_stats()
 
         downloader.close()
 
         pool_size = self.session.config.get('files.num.threads', default=None)
         dserv = None
+        pipeline = None
 
         if self.bank.config.get('micro.biomaj.service.download', default=None) == '1':
             dserv = DownloadClient(
@@ -1513,8 +1994,18 @@ class UpdateWorkflow(Workflow):
                 logging.info('Set rate limiting: %s' % (str(pool_size)))
                 dserv.set_rate_limiting(int(pool_size))
 
+        elif cf.get_bool('download.pipeline', default=False) and cf.get('download.plugin', default=None) is None:
+            # Check and extract files as soon as they are downloaded
+            logging.info('Workflow:wf_download:Pipeline')
+            pipeline_files = list(copied_files)
+            for downloader in downloaders:
+                pipeline_files += downloader.files_to_download
+            pipeline = FilePipeline(self, pipeline_files, max_workers=int(pool_size or 2))
+            dserv = LocalDownloadClient(pipeline, cancel_event=self.cancel_event, hash_file=self._get_inline_hash(copied_files, downloaders))
+            for copied_file in copied_files:
+                pipeline.file_ready(copied_file.get('save_as') or copied_file['name'])
         else:
-            dserv = DownloadClient()
+            dserv = LocalDownloadClient(cancel_event=self.cancel_event, hash_file=self._get_inline_hash(copied_files, downloaders))
 
         if pool_size:
             dserv.set_queue_size(int(pool_size))
@@ -1627,26 +2118,304 @@ class UpdateWorkflow(Workflow):
             download_error = dserv.wait_for_download()
         except Exception as e:
             self._close_download_service(dserv)
+            if pipeline is not None:
+                pipeline.close()
+                self._revert_archives(pipeline.archives)
             logging.exception('Workflow:wf_download:Exception:' + str(e))
             return False
         except KeyboardInterrupt:
             logging.warn("Ctrl-c received! Stop downloads...")
             logging.warn("Running downloads will continue and process will stop.")
             self._close_download_service(dserv)
+            if pipeline is not None:
+                pipeline.close()
+                self._revert_archives(pipeline.archives)
             return False
 
         self._close_download_service(dserv)
 
+        if self._cancel_requested():
+            if pipeline is not None:
+                pipeline.close()
+                self._revert_archives(pipeline.archives)
+            logging.error('Workflow:wf_download:Cancelled')
+            return False
+
+        if pipeline is not None:
+            if not pipeline.close():
+                logging.warn('Workflow:wf_download:Pipeline:some files failed, they will be checked again')
+            self.pipeline_done = pipeline.done
+            self.archives = pipeline.archives
+
         self.downloaded_files = copied_files
         for downloader in downloaders:
             self.downloaded_files += downloader.files_to_download
+        # Files downloaded by local download threads, remote downloads are not timed
+        for downloaded_file in getattr(dserv, 'downloaded_files', []):
+            if 'download_time' in downloaded_file:
+                self._add_file_timing('download', downloaded_file.get('save_as') or downloaded_file['name'], downloaded_file['download_time'])
 
         if download_error:
             logging.error('An error occured during download')
+            self._revert_archives(self.archives)
             return False
 
         return True
 
+    def _revert_archives(self, archives):
+        """
+        Restore extracted archives and remove their known extracted files,
+        after an extraction failure or an interrupted download
+
+        :param archives: list of extracted archives
+        :type archives: list
+        """
+        offline_dir = self.session.get_offline_directory()
+        for archive in archives:
+            if not os.path.exists(archive['to']):
+                continue
+            if os.path.exists(archive['from']) and os.path.samefile(archive['from'], archive['to']):
+                # Archive was not removed, drop its link
+                os.remove(archive['to'])
+                continue
+            for extracted in archive['file'].pop('extracted', []):
+                output = os.path.join(offline_dir, extracted[0])
+                if os.path.lexists(output):
+                    os.remove(output)
+            logging.info("Workflow:wf_uncompress:RevertArchive:" + archive['from'])
+            shutil.move(archive['to'], archive['from'])
+        del archives[:]
+
+    def _get_archive(self, file, archives):
+        """
+        Prepare extraction of a downloaded file if it is an archive
+
+        A hard link to the archive is kept and added to archives so that it
+        can be reverted if an extraction fails. Extraction never modifies the
+        archive in place, it only removes it, so no data copy is needed.
+
+        :param file: downloaded file info
+        :type file: dict
+        :param archives: list of extracted archives
+        :type archives: list
+        :return: archive path, None if file is not an archive
+        """
+        from biomaj.extract import EXTRA_FORMATS
+        from biomaj.extract import get_format
+        from biomaj.extract import has_decompressor
+        if 'save_as' not in file:
+            file['save_as'] = file['name']
+        origFile = self.session.get_offline_directory() + '/' + file['save_as']
+
+        logging.info('Workflow:wf_uncompress:Uncompress:' + origFile)
+        if not os.path.exists(origFile):
+            logging.warn('Workflow:wf_uncompress:NotExists:' + origFile)
+            return None
+
+        archive_format = get_format(origFile, detect=self.session.config.get_bool('uncompress.detect', default=False))
+        if archive_format is None:
+            return None
+        if archive_format in EXTRA_FORMATS and not self.session.config.get_bool('uncompress.extra.formats', default=False):
+            return None
+        if not has_decompressor(archive_format):
+            logging.warn('Workflow:wf_uncompress:NoDecompressor:%s:%s, file kept compressed' % (archive_format, origFile))
+            return None
+        tmpFileNameElts = file['save_as'].split('/')
+        tmpFileNameElts[len(tmpFileNameElts) - 1] = 'tmp_' + tmpFileNameElts[len(tmpFileNameElts) - 1]
+        tmpCompressedFile = self.session.get_offline_directory() + '/' + '/'.join(tmpFileNameElts)
+        if not any(archive['from'] == origFile for archive in archives):
+            # Not already added by download pipeline
+            archives.append({'from': origFile, 'to': tmpCompressedFile, 'file': file})
+
+        if os.path.exists(tmpCompressedFile):
+            os.remove(tmpCompressedFile)
+        try:
+            os.link(origFile, tmpCompressedFile)
+        except OSError as e:
+            # File system without hard links
+            logging.debug('Workflow:wf_uncompress:Link:' + str(e))
+            shutil.copy(origFile, tmpCompressedFile)
+        return origFile
+
+    def _set_uncompress_status(self, file, status, duration, size, outputs=None):
+        """
+        Record the result of an archive extraction
+
+        Extracted files, if known, are recorded in file info (extracted), for
+        wf_copy and so that next update can reuse them (uncompress.reuse).
+
+        :return: bool, extraction status
+        """
+        if not status:
+            logging.error('Workflow:wf_uncompress:Failure:' + file['name'])
+            return False
+        self._add_file_timing('uncompress', file['save_as'], duration, size)
+        if outputs is not None:
+            extracted = []
+            directory = os.path.dirname(file['save_as'])
+            for output in outputs:
+                output = os.path.normpath(os.path.join(directory, output))
+                output_stat = os.lstat(os.path.join(self.session.get_offline_directory(), output))
+                extracted.append([output, output_stat.st_size, output_stat.st_mtime_ns])
+            file['extracted'] = extracted
+        # Archives can be extracted by download pipeline threads
+        with self.uncompress_lock:
+            stats = self.session._session['stats'].setdefault('uncompress', {'archives': 0, 'bytes': 0, 'duration': 0})
+            stats['archives'] += 1
+            stats['bytes'] += size
+            stats['duration'] += duration
+        return True
+
+    def _uncompress_file(self, file, archives):
+        """
+        Uncompress a downloaded file if it is an archive
+
+        The archive is kept and added to archives so that it can be reverted
+        if an extraction fails.
+
+        :param file: downloaded file info
+        :type file: dict
+        :param archives: list of extracted archives
+        :type archives: list
+        :return: bool, False if extraction failed
+        """
+        from biomaj.extract import uncompress_archive
+        origFile = self._get_archive(file, archives)
+        if origFile is None or self._reuse_extraction(file, origFile):
+            return True
+        (status, duration, size, outputs) = uncompress_archive(origFile, **self._get_uncompress_options())
+        return self._set_uncompress_status(file, status, duration, size, outputs)
+
+    def _get_previous_archives(self):
+        """
+        Gets files downloaded for last production release, with their extracted files
+
+        :return: dict save_as => file info
+        """
+        with self.uncompress_lock:
+            if self.previous_archives is not None:
+                return self.previous_archives
+            self.previous_archives = {}
+            if not self.bank.bank.get('production'):
+                return self.previous_archives
+            last_production = self.bank.bank['production'][-1]
+            previous_files = self._load_download_files_from_session(last_production['session'])
+            self.previous_flat_dir = os.path.join(self.session.get_full_release_directory(release=last_production['release']), 'flat')
+            for previous_file in previous_files or []:
+                if previous_file.get('extracted'):
+                    self.previous_archives[previous_file.get('save_as') or previous_file['name']] = previous_file
+            return self.previous_archives
+
+    def _reuse_extraction(self, file, origFile):
+        """
+        Use files extracted from the same archive in last production release
+        (uncompress.reuse) instead of extracting the archive again.
+
+        Archive must have same name, size and date (and hash, digests if known)
+        as in last production release, and its extracted files must still
+        have the size and modification time they had after extraction.
+        They are copied with the copy engine, hard linked if use_hardlinks is set.
+
+        :param file: downloaded file info
+        :type file: dict
+        :param origFile: archive path
+        :type origFile: str
+        :return: bool, True if archive does not need to be extracted
+        """
+        if not self.session.config.get_bool('uncompress.reuse', default=False):
+            return False
+        previous_file = self._get_previous_archives().get(file['save_as'])
+        if previous_file is None:
+            return False
+        for key in ['name', 'size', 'year', 'month', 'day']:
+            if file.get(key) != previous_file.get(key):
+                return False
+        if file.get('hash') and previous_file.get('hash') and file['hash'] != previous_file['hash']:
+            return False
+        for (algorithm, digest) in file.get('digests', {}).items():
+            if previous_file.get('digests', {}).get(algorithm, digest) != digest:
+                return False
+        for (output, size, mtime) in previous_file['extracted']:
+            try:
+                output_stat = os.lstat(os.path.join(self.previous_flat_dir, output))
+            except OSError:
+                return False
+            if stat.S_ISLNK(output_stat.st_mode):
+                # Copy would follow links, extract again
+                return False
+            if output_stat.st_size != size or output_stat.st_mtime_ns != mtime:
+                # Modified by a post process
+                return False
+        start = time.monotonic()
+        offline_dir = self.session.get_offline_directory()
+        copy_engine = self._get_copy_engine()
+        for (output, size, mtime) in previous_file['extracted']:
+            copy_engine.copy_file(os.path.join(self.previous_flat_dir, output), os.path.join(offline_dir, output))
+        # Archive link is kept for revert
+        os.remove(origFile)
+        file['extracted'] = previous_file['extracted']
+        logging.info('Workflow:wf_uncompress:Reuse:%s:%d files from %s' % (file['save_as'], len(file['extracted']), self.previous_flat_dir))
+        self._add_file_timing('uncompress', file['save_as'], time.monotonic() - start, file.get('size'))
+        with self.uncompress_lock:
+            stats = self.session._session['stats'].setdefault('uncompress', {'archives': 0, 'bytes': 0, 'duration': 0})
+            stats['reused'] = stats.get('reused', 0) + 1
+        return True
+
+    def _get_uncompress_options(self):
+        """
+        Gets extraction backend options (uncompress.backend, uncompress.num.threads)
+
+        :return: dict of uncompress_archive options
+        """
+        return {
+            'backend': self.session.config.get('uncompress.backend', default='default'),
+            'threads': int(self.session.config.get('uncompress.num.threads', default='1'))
+        }
+
+    def _uncompress_files(self, files, archives, max_workers):
+        """
+        Uncompress archives in a pool of processes
+
+        :param files: downloaded files info
+        :type files: list
+        :param archives: list of extracted archives
+        :type archives: list
+        :param max_workers: number of processes
+        :type max_workers: int
+        :return: bool, False if an extraction failed or was cancelled
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        from biomaj.extract import uncompress_archive
+        res = True
+        options = self._get_uncompress_options()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for file in files:
+                origFile = self._get_archive(file, archives)
+                if origFile is not None and not self._reuse_extraction(file, origFile):
+                    try:
+                        futures.append((file, executor.submit(uncompress_archive, origFile, **options)))
+                    except Exception as e:
+                        # Pool is broken, a worker process died
+                        logging.error('Workflow:wf_uncompress:Failure:%s:%s' % (file['name'], str(e)))
+                        res = False
+                        break
+            for (file, future) in futures:
+                if not res or self._cancel_requested():
+                    # Stop remaining extractions, running ones complete
+                    res = False
+                    future.cancel()
+                    continue
+                try:
+                    (status, duration, size, outputs) = future.result()
+                except Exception as e:
+                    logging.error('Workflow:wf_uncompress:Failure:%s:%s' % (file['name'], str(e)))
+                    res = False
+                    continue
+                if not self._set_uncompress_status(file, status, duration, size, outputs):
+                    res = False
+        return res
+
     def wf_uncompress(self):
         """
         Uncompress files if archives and no.extract = false
@@ -1657,58 +2426,30 @@ class UpdateWorkflow(Workflow):
             return True
         no_extract = self.session.config.get('no.extract')
         if no_extract is None or no_extract == 'false':
-            archives = []
-            for file in self.downloaded_files:
-                if 'save_as' not in file:
-                    file['save_as'] = file['name']
-                nb_try = 1
-                origFile = self.session.get_offline_directory() + '/' + file['save_as']
-                is_archive = False
-                if origFile.endswith(('.tar.gz', '.tar', '.tgz')):
-                    is_archive = True
-                elif origFile.endswith('.bz2'):
-                    is_archive = True
-                elif origFile.endswith('.gz'):
-                    is_archive = True
-                elif origFile.endswith('.zip'):
-                    is_archive = True
-
-                logging.info('Workflow:wf_uncompress:Uncompress:' + origFile)
-                if not os.path.exists(origFile):
-                    logging.warn('Workflow:wf_uncompress:NotExists:' + origFile)
-                    continue
-
-                tmpCompressedFile = origFile
-                if is_archive:
-                    tmpFileNameElts = file['save_as'].split('/')
-                    tmpFileNameElts[len(tmpFileNameElts) - 1] = 'tmp_' + tmpFileNameElts[len(tmpFileNameElts) - 1]
-                    tmpCompressedFile = self.session.get_offline_directory() + '/' + '/'.join(tmpFileNameElts)
-                    archives.append({'from': origFile, 'to': tmpCompressedFile})
-                else:
-                    continue
-
-                shutil.copy(origFile, tmpCompressedFile)
-
-                not_ok = True
-                while nb_try < 3 and not_ok:
-                    status = Utils.uncompress(origFile)
-                    if status:
-                        not_ok = False
-                    else:
-                        logging.warn('Workflow:wf_uncompress:Failure:' + file['name'] + ':' + str(nb_try))
-                        nb_try += 1
-                if not_ok:
-                    logging.error('Workflow:wf_uncompress:Failure:' + file['name'])
-                    # Revert archive files
-                    for archive in archives:
-                        if os.path.exists(archive['to']):
-                            logging.info("Workflow:wf_uncompress:RevertArchive:" + archive['from'])
-                            shutil.move(archive['to'], archive['from'])
-                    return False
+            # Archives may already have been extracted while downloading
+            archives = self.archives
+            files = [file for file in self.downloaded_files if file.get('save_as', file['name']) not in self.pipeline_done]
+            pool_size = int(self.session.config.get('uncompress.num.processes', default='1'))
+            if pool_size > 1:
+                res = self._uncompress_files(files, archives, pool_size)
+            else:
+                res = True
+                for file in files:
+                    if self._cancel_requested() or not self._uncompress_file(file, archives):
+                        res = False
+                        break
+            if not res:
+                self._revert_archives(archives)
+                return False
             for archive in archives:
                 if os.path.exists(archive['to']):
                     logging.info("Workflow:wf_uncompress:RemoveAfterExtract:" + archive['to'])
                     os.remove(archive['to'])
+            if 'uncompress' in self.session._session['stats']:
+                stats = self.session._session['stats']['uncompress']
+                logging.info('Workflow:wf_uncompress:%d archives, %d bytes, %d reused' % (stats['archives'], stats['bytes'], stats.get('reused', 0)))
+                if stats.get('reused'):
+                    self._set_copy_stats()
 
         else:
             logging.info("Workflow:wf_uncompress:NoExtract")
@@ -1731,14 +2472,164 @@ class UpdateWorkflow(Workflow):
             self.session.get_release_directory(),
             'flat'
         )
-        # We use move=True so there is no need to try to use hardlinks here
-        local_files = Utils.copy_files_with_regexp(from_dir, to_dir, regexp, True)
+        local_files = None
+        if self.session.config.get_bool('copy.manifest', default=True):
+            local_files = self._move_manifest_files(from_dir, to_dir, regexp)
+        if local_files is None:
+            # We use move=True so there is no need to try to use hardlinks here
+            local_files = Utils.copy_files_with_regexp(from_dir, to_dir, regexp, True)
         self.session._session['files'] = local_files
         if len(self.session._session['files']) == 0:
             logging.error('Workflow:wf_copy:No file match in offline dir')
             return False
+        if self.session.config.get_bool('copy.dedup', default=False):
+            self._dedup_files(to_dir, local_files)
         return True
 
+    def _dedup_files(self, to_dir, local_files):
+        """
+        Replace release files by hard links to identical files of previous
+        releases (copy.dedup), using the content addressed store of the bank
+        in cache.dir.
+
+        Files are identified by their sha256 digest, computed while
+        downloading if checked against a sha256 digest, else computed here
+        (or found in checksum cache).
+
+        :param to_dir: release directory
+        :type to_dir: str
+        :param local_files: files of release directory
+        :type local_files: list
+        """
+        from biomaj.dedup import DedupStore
+        cache_dir = self.session.config.get('cache.dir')
+        if not cache_dir or not os.path.isdir(cache_dir):
+            logging.warn('Workflow:wf_copy:Dedup:cache.dir not available, skipping')
+            return
+        known_digests = {}
+        for file in self.downloaded_files:
+            digest = file.get('digests', {}).get(DedupStore.ALGORITHM)
+            # Digest of an extracted archive is not the one of its content
+            if digest and 'extracted' not in file:
+                known_digests[os.path.normpath((file.get('save_as') or file['name']).lstrip('/'))] = digest
+        paths = []
+        files = []
+        digests = []
+        to_hash = []
+        for local_file in local_files:
+            path = os.path.join(to_dir, local_file['name'])
+            if not os.path.isfile(path) or os.path.islink(path) or os.path.getsize(path) == 0:
+                continue
+            paths.append(path)
+            files.append(local_file)
+            digests.append(known_digests.get(os.path.normpath(local_file['name'])))
+            if digests[-1] is None:
+                to_hash.append(len(paths) - 1)
+        engine = self._get_checksum_engine()
+        try:
+            hashed = engine.hash_files([(paths[index], [DedupStore.ALGORITHM]) for index in to_hash])
+        finally:
+            if engine.cache is not None:
+                engine.cache.save()
+        for (index, file_digests) in zip(to_hash, hashed):
+            digests[index] = file_digests[DedupStore.ALGORITHM]
+        store = DedupStore(os.path.join(cache_dir, 'dedup_' + self.name))
+        for (path, local_file, digest) in zip(paths, files, digests):
+            if store.link(digest, path):
+                # File now has the date of the stored file
+                f_stat = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+                local_file['size'] = os.path.getsize(path)
+                local_file['year'] = str(f_stat.year)
+                local_file['month'] = str(f_stat.month)
+                local_file['day'] = str(f_stat.day)
+        store.save()
+        stats = store.get_stats()
+        self.session._session['stats']['dedup'] = stats
+        logging.info('Workflow:wf_copy:Dedup:%d files linked to previous releases, %d bytes saved' % (stats['files'], stats['bytes']))
+
+    def _get_manifest_files(self, from_dir):
+        """
+        Gets the files of offline directory known by the workflow: downloaded
+        files, or files extracted from them
+
+        :param from_dir: offline directory
+        :type from_dir: str
+        :return: list of file paths relative to offline directory, None if some
+                 files are unknown (archive extracted without list of its files)
+        """
+        names = []
+        for file in self.downloaded_files:
+            if 'extracted' in file:
+                names += [extracted[0] for extracted in file['extracted']]
+                continue
+            name = os.path.normpath((file.get('save_as') or file['name']).lstrip('/'))
+            if not os.path.exists(os.path.join(from_dir, name)):
+                logging.info('Workflow:wf_copy:Manifest:Unknown files for ' + name)
+                return None
+            names.append(name)
+        # Keep order, drop files listed twice
+        return list(dict.fromkeys(names))
+
+    def _move_manifest_files(self, from_dir, to_dir, regexps):
+        """
+        Move files known by the workflow (see _get_manifest_files) and matching
+        regexps from offline directory to release directory, instead of
+        walking offline directory like Utils.copy_files_with_regexp.
+        Destination directories are created once, files are renamed directory
+        by directory.
+
+        :param from_dir: offline directory
+        :type from_dir: str
+        :param to_dir: release directory
+        :type to_dir: str
+        :param regexps: list of regular expressions of files to move (local.files)
+        :type regexps: list
+        :return: list of moved files with their size, date and format, None if
+                 files of offline directory are not all known
+        """
+        names = self._get_manifest_files(from_dir)
+        if names is None:
+            return None
+        directories = {}
+        for name in names:
+            for reg in regexps:
+                if reg == '**/*' or re.match(reg, name):
+                    directories.setdefault(os.path.dirname(name), []).append(name)
+                    break
+        moved = []
+        for directory in directories:
+            os.makedirs(os.path.join(to_dir, directory), exist_ok=True)
+            for name in directories[directory]:
+                from_file = os.path.join(from_dir, name)
+                to_file = os.path.join(to_dir, name)
+                try:
+                    os.rename(from_file, to_file)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.move(from_file, to_file)
+                moved.append(name)
+        # Symbolic links are followed once their targets are moved too
+        local_files = []
+        for name in moved:
+            to_file = os.path.join(to_dir, name)
+            if os.path.exists(to_file):
+                file_stat = os.stat(to_file)
+            else:
+                file_stat = os.lstat(to_file)
+            f_stat = datetime.datetime.fromtimestamp(file_stat.st_mtime)
+            (file_format, encoding) = Utils.detect_format(to_file)
+            local_files.append({
+                'name': name,
+                'size': file_stat.st_size,
+                'year': str(f_stat.year),
+                'month': str(f_stat.month),
+                'day': str(f_stat.day),
+                'format': file_format
+            })
+        logging.info('Workflow:wf_copy:Manifest:Moved %d files in %d directories' % (len(local_files), len(directories)))
+        return local_files
+
     def wf_metadata(self):
         """
         Update metadata with info gathered from processes
@@ -1773,6 +2664,7 @@ class UpdateWorkflow(Workflow):
         """
         Execute post processes
         """
+        from biomaj.process.processfactory import PostProcessFactory
         # Creates a temporary symlink future_release to keep compatibility if process
         # tries to access dir with this name
         future_link = os.path.join(
@@ -1780,20 +2672,14 @@ class UpdateWorkflow(Workflow):
             self.bank.config.get('dir.version'),
             'future_release'
         )
-        # prod_dir = self.session.get_full_release_directory()
-        to_dir = os.path.join(
-            self.bank.config.get('data.dir'),
-            self.bank.config.get('dir.version')
-        )
-
         if os.path.lexists(future_link):
             os.remove(future_link)
-        os.chdir(to_dir)
-        os.symlink(self.session.get_release_directory(), 'future_release')
+        # Link target is relative to link directory
+        os.symlink(self.session.get_release_directory(), future_link)
 
         logging.info('Workflow:wf_postprocess')
         blocks = self.session._session['process']['postprocess']
-        pfactory = PostProcessFactory(self.bank, blocks, redis_client=self.redis_client, redis_prefix=self.redis_prefix)
+        pfactory = PostProcessFactory(self.bank, blocks, redis_client=self.redis_client, redis_prefix=self.redis_prefix, cancel_event=self.cancel_event)
         res = pfactory.run()
         self.session._session['process']['postprocess'] = pfactory.blocks
 
@@ -1824,7 +2710,7 @@ class UpdateWorkflow(Workflow):
         Generates a listing.format file containing the list of files in directories declared in formats
         """
         release_dir = self.session.get_full_release_directory()
-        for release_format in self.bank.session.get('formats'):
+        for release_format in self.session.get('formats'):
             format_file = os.path.join(release_dir, 'listingv1.' + release_format.replace('/', '_'))
             section = self.list_section(release_dir, release_format, release_format)
             logging.debug("Worfklow:OldAPI:WriteListing: " + format_file)
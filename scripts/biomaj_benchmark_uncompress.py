@@ -0,0 +1,118 @@
+'''
+Compare extraction backends (uncompress.backend, uncompress.num.threads)
+on FASTA archives, generated or given on command line
+'''
+from biomaj.extract import BACKENDS
+from biomaj.extract import uncompress_archive
+import argparse
+import gzip
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import zlib
+
+
+def write_fasta(path, size):
+    '''
+    Write random protein sequences up to size bytes
+    '''
+    rand = random.Random(0)
+    alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+    written = 0
+    nb_seq = 0
+    with open(path, 'w') as fasta:
+        while written < size:
+            nb_seq += 1
+            seq = ''.join(rand.choice(alphabet) for i in range(rand.randint(100, 2000)))
+            lines = ['>seq%d test sequence %d' % (nb_seq, nb_seq)]
+            lines += [seq[i:i + 60] for i in range(0, len(seq), 60)]
+            data = '\n'.join(lines) + '\n'
+            fasta.write(data)
+            written += len(data)
+
+
+def write_bgzf_block(dest, data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = b'\x1f\x8b\x08\x04' + struct.pack('<IBBH', 0, 0, 255, 6)
+    header += b'BC' + struct.pack('<HH', 2, len(cdata) + 25)
+    dest.write(header + cdata + struct.pack('<II', zlib.crc32(data), len(data)))
+
+
+def write_bgzf(path, output, member_blocks=256):
+    '''
+    Compress a file in BGZF format, like bgzip, as several bgzip files of
+    member_blocks blocks concatenated
+    '''
+    with open(path, 'rb') as src, open(output, 'wb') as dest:
+        nb_blocks = 0
+        while True:
+            data = src.read(65280)
+            if not data:
+                break
+            write_bgzf_block(dest, data)
+            nb_blocks += 1
+            if nb_blocks % member_blocks == 0:
+                # Empty block marks end of member
+                write_bgzf_block(dest, b'')
+        if nb_blocks % member_blocks != 0 or nb_blocks == 0:
+            write_bgzf_block(dest, b'')
+
+
+def create_archives(directory, size):
+    fasta = os.path.join(directory, 'test.fasta')
+    write_fasta(fasta, size)
+    archives = []
+    with open(fasta, 'rb') as src, gzip.open(fasta + '.gz', 'wb') as dest:
+        shutil.copyfileobj(src, dest)
+    archives.append(fasta + '.gz')
+    write_bgzf(fasta, os.path.join(directory, 'test.bgzf.fasta.gz'))
+    archives.append(os.path.join(directory, 'test.bgzf.fasta.gz'))
+    for (ext, mode) in [('.tar.gz', 'w:gz'), ('.tar.bz2', 'w:bz2'), ('.tar.xz', 'w:xz')]:
+        with tarfile.open(fasta + ext, mode) as tar:
+            tar.add(fasta, arcname='test.fasta')
+        archives.append(fasta + ext)
+    os.remove(fasta)
+    return archives
+
+
+desc = "Compare extraction backends on FASTA archives"
+parser = argparse.ArgumentParser(description=desc)
+parser.add_argument('archives', nargs='*',
+                    help="Archives to extract, test archives are generated if not set")
+parser.add_argument('-s', '--size', action="store", dest="size", type=int,
+                    default=100, help="Size of generated FASTA file, in MB")
+parser.add_argument('-n', '--threads', action="store", dest="threads", default='1,4',
+                    help="Comma separated list of number of threads per archive")
+parser.add_argument('-b', '--backends', action="store", dest="backends", default=','.join(sorted(BACKENDS.keys())),
+                    help="Comma separated list of backends")
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp(prefix='biomaj_benchmark_')
+try:
+    archives = args.archives
+    if not archives:
+        print('Generating %d MB of FASTA in %s' % (args.size, tmp_dir))
+        archives = create_archives(tmp_dir, args.size * 1024 * 1024)
+    print('%-30s %-10s %8s %10s %10s' % ('archive', 'backend', 'threads', 'seconds', 'MB/s'))
+    for archive in archives:
+        for backend in args.backends.split(','):
+            for threads in args.threads.split(','):
+                run_dir = tempfile.mkdtemp(dir=tmp_dir)
+                path = os.path.join(run_dir, os.path.basename(archive))
+                shutil.copy(archive, path)
+                # Do not measure reads from disk
+                subprocess.call(['cat', path], stdout=subprocess.DEVNULL)
+                (status, duration, size, outputs) = uncompress_archive(path, nb_try=1, backend=backend, threads=int(threads))
+                extracted = 0
+                for (root, dirs, files) in os.walk(run_dir):
+                    extracted += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+                speed = extracted / duration / 1048576 if status and duration > 0 else 0
+                print('%-30s %-10s %8s %10.2f %10.1f%s' % (os.path.basename(archive), backend, threads, duration, speed, '' if status else ' ERROR'))
+                shutil.rmtree(run_dir)
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,37 @@
+from biomaj_core.config import BiomajConfig
+from biomaj.bank import Bank
+import argparse
+import logging
+import sys
+
+
+desc = "Replace identical files of bank production directories by hard links"
+parser = argparse.ArgumentParser(description=desc)
+parser.add_argument('banks', nargs='*',
+                    help="Bank names, comma separated lists are accepted, default all banks")
+parser.add_argument('-n', '--threads', action="store", dest="threads", type=int,
+                    default=2, help="Max number of directories walked or files hashed at the same time")
+parser.add_argument('-s', '--min-size', action="store", dest="min_size", type=int,
+                    default=1, help="Minimal size of files to deduplicate, in bytes")
+parser.add_argument('--dry-run', action="store_true", dest="dry_run",
+                    default=False, help="Only report duplicates, do not link them")
+parser.add_argument('-c', '--config', action="store", dest="config", default=None,
+                    help="global.properties file path")
+args = parser.parse_args()
+
+logging.warn("Needs global.properties in local directory or env variable BIOMAJ_CONF, or --config")
+BiomajConfig.load_config(args.config)
+
+banks = []
+for bank in args.banks:
+    banks += [name.strip() for name in bank.split(',') if name.strip()]
+
+stats = Bank.dedup_productions(banks=banks, max_workers=args.threads,
+                               min_size=args.min_size, dry_run=args.dry_run)
+if stats is None:
+    sys.exit(1)
+print('Scanned %d files, %d bytes, hashed %d bytes' % (stats['files'], stats['bytes'], stats['hashed']))
+print('%s %d files, %d bytes reclaimed' % ('Would link' if args.dry_run else 'Linked', stats['linked'], stats['reclaimed']))
+for bank in sorted(stats['banks']):
+    print(bank + ': ' + str(stats['banks'][bank]))
+sys.exit(0)
@@ -0,0 +1,46 @@
+from biomaj_core.config import BiomajConfig
+from biomaj.options import Options
+from biomaj.runner import BankRunner
+import argparse
+import logging
+import sys
+
+
+desc = "Update several banks, independent banks being updated concurrently"
+parser = argparse.ArgumentParser(description=desc)
+parser.add_argument('banks', nargs='+',
+                    help="Bank names, comma separated lists are accepted")
+parser.add_argument('-n', '--threads', action="store", dest="threads", type=int,
+                    default=2, help="Max number of banks updated at the same time")
+parser.add_argument('-d', '--with-depends', action="store_true", dest="with_depends",
+                    default=False, help="Also update dependencies not listed")
+parser.add_argument('-c', '--config', action="store", dest="config", default=None,
+                    help="global.properties file path")
+parser.add_argument('-u', '--user', action="store", dest="user", default=None,
+                    help="User updating the banks")
+args = parser.parse_args()
+
+logging.warn("Needs global.properties in local directory or env variable BIOMAJ_CONF, or --config")
+BiomajConfig.load_config(args.config)
+
+banks = []
+for bank in args.banks:
+    banks += [name.strip() for name in bank.split(',') if name.strip()]
+
+options = Options()
+if args.user:
+    options.user = args.user
+
+runner = BankRunner(banks, options=options, max_workers=args.threads,
+                    with_depends=args.with_depends)
+res = runner.run()
+for bank in runner.banks:
+    if runner.status[bank]:
+        print(bank + ': OK')
+    elif runner.status[bank] is False:
+        print(bank + ': ERROR ' + str(runner.errors.get(bank, '')))
+    else:
+        print(bank + ': SKIPPED ' + str(runner.errors.get(bank, '')))
+if not res:
+    sys.exit(1)
+sys.exit(0)
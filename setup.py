@@ -77,7 +77,9 @@ config = {
     'tests_require': ['pytest'],
     'packages': find_packages(),
     'include_package_data': True,
-    'scripts': ['scripts/biomaj_migrate_database.py'],
+    'scripts': ['scripts/biomaj_migrate_database.py',
+                'scripts/biomaj_update_banks.py',
+                'scripts/biomaj_dedup.py'],
     'name': 'biomaj',
     #'cmdclass': {'install': post_install},
 }
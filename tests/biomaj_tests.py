@@ -6,6 +6,7 @@ import logging
 import copy
 import stat
 import time
+import threading
 from optparse import OptionParser
 from unittest.mock import patch
 
@@ -18,6 +19,8 @@ from biomaj.workflow import UpdateWorkflow
 from biomaj.workflow import ReleaseCheckWorkflow
 from biomaj_core.utils import Utils
 from biomaj_core.config import BiomajConfig
+from biomaj.process.metaprocess import LocalProcess
+from biomaj.process.processfactory import ProcessFactory
 from biomaj.process.processfactory import PostProcessFactory
 from biomaj.process.processfactory import PreProcessFactory
 from biomaj.process.processfactory import RemoveProcessFactory
@@ -371,6 +374,21 @@ class TestBiomajFunctional():
     assert (os.path.exists(current_link))
     assert (b.bank['current'] == b.session._session['id'])
 
+  def test_update_keeps_working_dir(self):
+    """
+    Post processes and publish do not change the working directory
+    """
+    cwd = os.getcwd()
+    b = Bank('localprocess')
+    b.update()
+    b.publish()
+    assert (os.getcwd() == cwd)
+    current_link = os.path.join(b.config.get('data.dir'),
+                                b.config.get('dir.version'),
+                                'current')
+    assert (os.readlink(current_link) == b.session.get_release_directory())
+    assert (os.path.exists(os.path.join(current_link, 'proc1.txt')))
+
   # Should test this on local downloader, changing 1 file to force update,
   # else we would get same bank and there would be no update
   def test_no_update(self):
@@ -645,6 +663,16 @@ class TestBiomajFunctional():
     assert (b.session.get_status('download'))
     assert not (b.session.get_status('postprocess'))
 
+  def test_update_timing(self):
+    b = Bank('local')
+    b.config.set('stats.files', '1')
+    b.update()
+    timing = b.get_timing()
+    assert (timing['tasks']['download']['duration'] >= 0)
+    assert (timing['tasks']['download']['end'] >= timing['tasks']['download']['start'])
+    assert (timing['tasks']['uncompress']['parent'] == 'download')
+    assert (len(timing['files']['download']) > 0)
+
   def test_update_stop_before(self):
     b = Bank('local')
     b.options.stop_before = 'postprocess'
@@ -771,6 +799,37 @@ class TestBiomajFunctional():
     assert (b.session._session['depends']['sub2'])
     assert not (b.session._session['depends']['error'])
 
+  def test_computed_parallel_depends(self):
+    b = Bank('computed')
+    b.config.set('depends.parallel', '1')
+    res = b.update(True)
+    assert (res)
+    assert ([bdep.name for bdep in b.depends] == ['sub2', 'sub1'])
+    assert (b.session._session['depends']['sub1'])
+    assert (os.path.exists(b.session.get_full_release_directory()+'/sub1/flat/test_100.txt'))
+
+  def test_computed_parallel_depends_cluster(self):
+    """
+    Dependencies running cluster processes are updated sequentially
+    """
+    b = Bank('computed')
+    b.config.set('depends.parallel', '1')
+    b.get_dependencies()
+    b.dependency_graph.get_config('sub1').set('PROC0.cluster', 'true')
+    with patch('biomaj.bank.StepScheduler') as scheduler:
+      res = b.update(True)
+    assert (res)
+    assert (not scheduler.called)
+    assert ([bdep.name for bdep in b.depends] == ['sub2', 'sub1'])
+
+  def test_computederror_parallel_depends(self):
+    b = Bank('computederror')
+    b.config.set('depends.parallel', '1')
+    res = b.update(True)
+    assert not (res)
+    assert (b.session._session['depends']['sub2'])
+    assert not (b.session._session['depends']['error'])
+
   @pytest.mark.skipif(
     os.environ.get('NETWORK', 1) == '0',
     reason='network tests disabled'
@@ -867,3 +926,1359 @@ class TestBiomajFunctional():
     b = Bank('alu_list_error')
     res = b.update()
     assert not (res)
+
+
+class TestBiomajScheduler():
+
+  def test_scheduler_order(self):
+    """
+    Steps must run after their dependencies, independent steps may overlap
+    """
+    from biomaj.scheduler import StepScheduler
+    lock = threading.Lock()
+    events = []
+    def run_task(task):
+      with lock:
+        events.append(task + ':start')
+      time.sleep(0.1)
+      with lock:
+        events.append(task + ':end')
+      return True
+    scheduler = StepScheduler(['a', 'b', 'c'], {'c': ['a']}, max_workers=3)
+    (res, status) = scheduler.run(run_task)
+    assert (res)
+    assert (status == {'a': True, 'b': True, 'c': True})
+    assert (events.index('a:end') < events.index('c:start'))
+    assert (events.index('b:start') < events.index('a:end'))
+
+  def test_scheduler_failure(self):
+    """
+    Dependent steps are not run after a failure
+    """
+    from biomaj.scheduler import StepScheduler
+    scheduler = StepScheduler(['a', 'b'], {'b': ['a']}, max_workers=2)
+    (res, status) = scheduler.run(lambda task: task != 'a')
+    assert not (res)
+    assert (status['a'] is False)
+    assert (status['b'] is None)
+
+  def test_scheduler_cancel(self):
+    from biomaj.scheduler import StepScheduler
+    scheduler = StepScheduler(['a', 'b'], {'b': ['a']})
+    (res, status) = scheduler.run(lambda task: True, can_start=lambda task: task != 'b')
+    assert not (res)
+    assert (status['b'] is None)
+
+  def test_scheduler_cycle(self):
+    from biomaj.scheduler import StepScheduler
+    with pytest.raises(Exception):
+      StepScheduler(['a', 'b'], {'a': ['b'], 'b': ['a']})
+
+  def test_scheduler_no_stop_on_failure(self):
+    """
+    Only tasks depending on a failed task are not run
+    """
+    from biomaj.scheduler import StepScheduler
+    scheduler = StepScheduler(['a', 'b', 'c', 'd'], {'b': ['a'], 'c': ['b'], 'd': []}, stop_on_failure=False)
+    (res, status) = scheduler.run(lambda task: task != 'a')
+    assert not (res)
+    assert (status == {'a': False, 'b': None, 'c': None, 'd': True})
+
+
+class TestBiomajRunner():
+
+  def setup_method(self, m):
+    self.utils = UtilsForTest()
+    BiomajConfig.load_config(self.utils.global_properties, allow_user_config=False)
+
+  def teardown_method(self, m):
+    self.utils.clean()
+
+  def test_runner_depends(self):
+    """
+    Banks wait for all their dependencies, even indirect ones
+    """
+    from biomaj.runner import BankRunner
+    runner = BankRunner(['computed', 'sub2', 'local'])
+    assert (sorted(runner.depends['computed']) == ['sub1', 'sub2'])
+    assert (runner.depends['local'] == [])
+    assert (runner.banks == ['computed', 'sub2', 'local'])
+
+  def test_runner_with_depends(self):
+    from biomaj.runner import BankRunner
+    runner = BankRunner(['computed'], with_depends=True)
+    assert (runner.banks == ['sub2', 'sub1', 'computed'])
+
+  def test_dependency_order(self):
+    """
+    Shared dependencies are loaded and listed only once
+    """
+    from biomaj.dependency import DependencyGraph
+    graph = DependencyGraph()
+    with patch('biomaj.dependency.BiomajConfig', wraps=BiomajConfig) as config_init:
+      order = graph.get_order(['computed', 'computed2', 'computederror'])
+      assert (config_init.call_count == 6)
+    assert (order == ['sub2', 'sub1', 'computed', 'computed2', 'error', 'computederror'])
+    assert (graph.get_dependencies('computederror') == ['sub2', 'error'])
+
+  def test_dependency_cluster(self):
+    """
+    Banks running processes on a cluster are detected
+    """
+    from biomaj.dependency import DependencyGraph
+    graph = DependencyGraph()
+    assert (not graph.runs_on_cluster('localprocess'))
+    graph.get_config('sub1').set('PROC0.cluster', 'true')
+    assert (graph.runs_on_cluster('sub1'))
+    with patch('biomaj.dependency.BiomajConfig', wraps=BiomajConfig) as config_init:
+      graph.get_depends('sub1')
+      assert (config_init.call_count == 0)
+
+  def test_dependency_cycle(self):
+    from biomaj.dependency import DependencyGraph
+    graph = DependencyGraph()
+    graph.add('sub2', 'computed')
+    with pytest.raises(Exception):
+      graph.get_order(['computed'])
+
+
+class FakePipelineWorkflow(object):
+  """
+  Minimal workflow recording files processed by a FilePipeline
+  """
+
+  def __init__(self, failures=None):
+    self.checked = []
+    self.extracted = []
+    self.failures = failures or []
+    self.cancel_event = threading.Event()
+    self.session = self
+    self.config = self
+
+  def get(self, key, default=None):
+    return default
+
+  def _checksum_file(self, rfile):
+    self.checked.append(rfile['name'])
+    return rfile['name'] not in self.failures
+
+  def _uncompress_file(self, rfile, archives):
+    self.extracted.append(rfile['name'])
+    return True
+
+  def _get_manifests(self, names):
+    manifests = {}
+    for name in names:
+      if os.path.basename(name) == 'MD5SUMS':
+        manifests.setdefault(os.path.dirname(name), []).append(name)
+    return manifests
+
+
+class TestBiomajPipeline():
+
+  def test_pipeline_waits_checksum_file(self):
+    """
+    A file is processed only once its checksum file is available too
+    """
+    from biomaj.pipeline import FilePipeline
+    workflow = FakePipelineWorkflow()
+    pipeline = FilePipeline(workflow, [{'name': 'a.gz'}, {'name': 'a.gz.md5'}, {'name': 'b'}])
+    pipeline.file_ready('a.gz')
+    pipeline.file_ready('b')
+    time.sleep(0.2)
+    assert ('a.gz' not in workflow.checked)
+    pipeline.file_ready('a.gz.md5')
+    assert (pipeline.close())
+    assert (pipeline.done == set(['a.gz', 'a.gz.md5', 'b']))
+    assert (workflow.checked.count('a.gz') == 1)
+    assert ('a.gz' in workflow.extracted)
+
+  def test_pipeline_error(self):
+    from biomaj.pipeline import FilePipeline
+    workflow = FakePipelineWorkflow(failures=['a'])
+    pipeline = FilePipeline(workflow, [{'name': 'a'}])
+    pipeline.file_ready('a')
+    assert not (pipeline.close())
+    assert ('a' not in pipeline.done)
+    assert ('a' not in workflow.extracted)
+
+  def test_pipeline_cancel(self):
+    from biomaj.pipeline import FilePipeline
+    workflow = FakePipelineWorkflow()
+    workflow.cancel_event.set()
+    pipeline = FilePipeline(workflow, [{'name': 'a'}])
+    pipeline.file_ready('a')
+    pipeline.close()
+    assert (workflow.checked == [])
+
+  def test_pipeline_waits_manifest(self):
+    """
+    Files are processed only once the checksum manifest of their directory is available
+    """
+    from biomaj.pipeline import FilePipeline
+    workflow = FakePipelineWorkflow()
+    pipeline = FilePipeline(workflow, [{'name': 'd/a'}, {'name': 'd/MD5SUMS'}, {'name': 'b'}])
+    pipeline.file_ready('d/a')
+    pipeline.file_ready('b')
+    time.sleep(0.2)
+    assert ('d/a' not in workflow.checked)
+    pipeline.file_ready('d/MD5SUMS')
+    assert (pipeline.close())
+    assert (pipeline.done == set(['d/a', 'd/MD5SUMS', 'b']))
+
+  def test_download_client_hash_before_pipeline(self):
+    """
+    Downloaded files are hashed before being sent to pipeline
+    """
+    from biomaj.pipeline import FilePipeline
+    from biomaj.pipeline import LocalDownloadClient
+    from biomaj_download.downloadclient import DownloadClient
+    workflow = FakePipelineWorkflow()
+    pipeline = FilePipeline(workflow, [{'name': 'a'}])
+    hashed = []
+
+    def hash_file(downloaded_file):
+      assert (workflow.checked == [])
+      hashed.append(downloaded_file['save_as'])
+
+    dserv = LocalDownloadClient(pipeline, hash_file=hash_file)
+    with patch.object(DownloadClient, 'local_download', return_value=[{'name': 'a', 'save_as': 'a'}]):
+      dserv.local_download(None)
+    assert (pipeline.close())
+    assert (hashed == ['a'])
+    assert (workflow.checked == ['a'])
+
+  def test_download_client_files(self):
+    """
+    Files downloaded by download threads are kept with their download time
+    """
+    from biomaj.pipeline import LocalDownloadClient
+    from biomaj_download.downloadclient import DownloadClient
+    dserv = LocalDownloadClient()
+    for name in ['a', 'b']:
+      with patch.object(DownloadClient, 'local_download', return_value=[{'name': name, 'download_time': 1.5}]):
+        dserv.local_download(None)
+    assert (dserv.downloaded_files == [{'name': 'a', 'download_time': 1.5}, {'name': 'b', 'download_time': 1.5}])
+
+
+class FakeCancelRedis(object):
+  """
+  Minimal redis client, without pub/sub support
+  """
+
+  def __init__(self):
+    self.keys = {}
+    self.connection_pool = self
+    self.connection_kwargs = {'db': 0}
+
+  def get(self, key):
+    return self.keys.get(key)
+
+  def pubsub(self, **kwargs):
+    raise Exception('pubsub not supported')
+
+
+class TestBiomajCancel():
+
+  def test_cancel_listener_poll(self):
+    """
+    Without pub/sub, cancel key is checked at interval
+    """
+    from biomaj.cancel import CancelListener
+    redis_client = FakeCancelRedis()
+    listener = CancelListener(redis_client, 'biomaj', 'alu', interval=0.1)
+    listener.start()
+    time.sleep(0.3)
+    assert not (listener.is_cancelled())
+    redis_client.keys['biomaj:alu:action:cancel'] = '1'
+    assert (listener.event.wait(2))
+    listener.join(2)
+    assert not (listener.is_alive())
+
+  def test_cancel_listener_stop(self):
+    from biomaj.cancel import CancelListener
+    listener = CancelListener(FakeCancelRedis(), 'biomaj', 'alu', interval=0.1)
+    listener.start()
+    listener.stop()
+    listener.join(2)
+    assert not (listener.is_alive())
+    assert not (listener.is_cancelled())
+    assert (listener.get_channels() == ['biomaj:alu:action:cancel', '__keyspace@0__:biomaj:alu:action:cancel'])
+
+  def test_cancel_running_process(self):
+    """
+    A running local process is terminated, then killed if it ignores termination
+    """
+    import threading
+    test_dir = tempfile.mkdtemp('biomaj')
+    try:
+      script = os.path.join(test_dir, 'test.sh')
+      with open(script, 'w') as f:
+        f.write("trap '' TERM\nexec sleep 30\n")
+      process = LocalProcess('test', 'sh', script, cwd=test_dir, expand=False, bank_env=dict(os.environ), log_dir=test_dir)
+      status = []
+      thread = threading.Thread(target=lambda: status.append(process.run()))
+      thread.start()
+      for i in range(50):
+        if process._proc is not None:
+          break
+        time.sleep(0.1)
+      start = time.time()
+      process.kill(timeout=0.5)
+      thread.join(10)
+      assert (not thread.is_alive())
+      assert (status == [False])
+      assert (time.time() - start < 5)
+      # Not started once killed
+      with pytest.raises(Exception):
+        process.run()
+    finally:
+      shutil.rmtree(test_dir)
+
+  def test_cancel_download_retry(self):
+    """
+    Failed downloads are not retried once cancelled
+    """
+    import threading
+    from biomaj.pipeline import LocalDownloadClient
+    from biomaj_download.download.localcopy import LocalDownload
+    from biomaj_download.downloadclient import DownloadClient
+    cancel_event = threading.Event()
+    client = LocalDownloadClient(cancel_event=cancel_event)
+    handler = LocalDownload('/tmp')
+    handler.set_options({'stop_condition': 'stop_after_attempt(3)', 'wait_policy': 'wait_fixed(0)'})
+    attempts = []
+    with patch.object(DownloadClient, '_get_handler', return_value=handler):
+      handler = client._get_handler(None)
+    handler.retryer(lambda: attempts.append(1) or True)
+    assert (len(attempts) == 3)
+    cancel_event.set()
+    attempts = []
+    handler.retryer(lambda: attempts.append(1) or True)
+    assert (len(attempts) == 1)
+
+
+class FakeProgressCollection(object):
+  """
+  Records updates sent to banks collection
+  """
+
+  def __init__(self):
+    self.updates = []
+
+  def update(self, query, update):
+    self.updates.append(update['$set'])
+
+  def with_options(self, **kwargs):
+    return self
+
+
+class TestBiomajProgress():
+
+  def test_progress_coalesce(self):
+    """
+    Updates are buffered and written at once
+    """
+    from biomaj.progress import ProgressWriter
+    from biomaj.mongo_connector import MongoConnector
+    banks = FakeProgressCollection()
+    with patch.object(MongoConnector, 'banks', banks):
+      progress = ProgressWriter('alu', interval=60)
+      progress.set('status.download.status', None)
+      progress.set('status.download.status', True)
+      progress.set('status.postprocess.progress.p1', True)
+      assert (banks.updates == [])
+      progress.close()
+    assert (banks.updates == [{'status.download.status': True, 'status.postprocess.progress.p1': True}])
+
+  def test_progress_parent_field(self):
+    from biomaj.progress import ProgressWriter
+    from biomaj.mongo_connector import MongoConnector
+    banks = FakeProgressCollection()
+    with patch.object(MongoConnector, 'banks', banks):
+      progress = ProgressWriter('alu', interval=60, relaxed=True)
+      progress.set('status.download.status', True)
+      progress.set('status', {'download': {'status': None}})
+      progress.set('status.init.status', True)
+      progress.close()
+      # Once closed, updates are written immediately
+      progress.set('status.over.status', True)
+    assert (banks.updates == [
+      {'status': {'download': {'status': None}}},
+      {'status.init.status': True},
+      {'status.over.status': True}
+    ])
+
+
+  def test_progress_not_started(self):
+    """
+    Workflow steps called without starting workflow write status immediately
+    """
+    from biomaj.mongo_connector import MongoConnector
+    test_dir = tempfile.mkdtemp('biomaj')
+    banks = FakeProgressCollection()
+    try:
+      workflow = UpdateWorkflow(FakeWorkflowBank(test_dir))
+      with patch.object(MongoConnector, 'banks', banks):
+        workflow.wf_progress('download', True)
+        assert (banks.updates == [{'status.download.status': True}])
+        assert (workflow.wf_over())
+    finally:
+      shutil.rmtree(test_dir)
+
+
+class TestBiomajStartup():
+
+  def test_lazy_imports(self):
+    """
+    Read only commands must not load download, process, plugin or redis libraries
+    """
+    import subprocess
+    import sys
+    heavy = ['redis', 'biomaj_download', 'biomaj_process', 'biomaj_zipkin',
+             'yapsy', 'packaging', 'jinja2']
+    code = ("import sys, time\n"
+            "start = time.time()\n"
+            "import biomaj.bank\n"
+            "print(time.time() - start)\n"
+            "print(','.join([m for m in %s if m in sys.modules]))\n" % str(heavy))
+    curdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=curdir).decode('utf-8').splitlines()
+    assert (output[1] == '')
+    # Import time budget, in seconds
+    assert (float(output[0]) < float(os.environ.get('BIOMAJ_IMPORT_BUDGET', '5')))
+
+
+class TestBiomajChecksum():
+
+  def setup_method(self, m):
+    self.test_dir = tempfile.mkdtemp('biomaj')
+
+  def teardown_method(self, m):
+    shutil.rmtree(self.test_dir)
+
+  def test_checksum_one_pass(self):
+    """
+    All digests are computed reading a file once, with a buffer smaller than the file
+    """
+    import hashlib
+    from biomaj.checksum import ChecksumEngine
+    content = os.urandom(20000)
+    file_path = os.path.join(self.test_dir, 'test.dat')
+    with open(file_path, 'wb') as f:
+      f.write(content)
+    engine = ChecksumEngine(max_workers=1, buffer_size=4096)
+    digests = engine.hash_file(file_path, ['md5', 'sha256'])
+    assert (digests['md5'] == hashlib.md5(content).hexdigest())
+    assert (digests['sha256'] == hashlib.sha256(content).hexdigest())
+    stats = engine.get_stats()
+    assert (stats['files'] == 1)
+    assert (stats['bytes'] == 20000)
+
+  def test_checksum_parallel(self):
+    """
+    Files hashed concurrently are returned in the requested order
+    """
+    import hashlib
+    from biomaj.checksum import ChecksumEngine
+    files = []
+    expected = []
+    for i in range(6):
+      content = os.urandom(1000 * (i + 1))
+      file_path = os.path.join(self.test_dir, 'test%d.dat' % i)
+      with open(file_path, 'wb') as f:
+        f.write(content)
+      files.append((file_path, ['md5']))
+      expected.append(hashlib.md5(content).hexdigest())
+    engine = ChecksumEngine(max_workers=3)
+    digests = engine.hash_files(files)
+    assert ([digest['md5'] for digest in digests] == expected)
+    assert (engine.get_stats()['files'] == 6)
+    assert (engine.get_stats()['bytes'] == 21000)
+
+  def test_checksum_cache(self):
+    """
+    Digests of unchanged files are read from cache, modified files are hashed again
+    """
+    import hashlib
+    from biomaj.checksum import ChecksumEngine
+    from biomaj.checksum import ChecksumCache
+    file_path = os.path.join(self.test_dir, 'test.dat')
+    with open(file_path, 'wb') as f:
+      f.write(b'test')
+    cache_path = os.path.join(self.test_dir, 'checksums_test')
+    engine = ChecksumEngine(cache=ChecksumCache(cache_path))
+    engine.hash_files([(file_path, ['md5', 'sha256'])])
+    engine.cache.save()
+    assert (os.path.exists(cache_path))
+    engine = ChecksumEngine(cache=ChecksumCache(cache_path))
+    digests = engine.hash_files([(file_path, ['sha256'])])
+    assert (digests[0]['sha256'] == hashlib.sha256(b'test').hexdigest())
+    assert (engine.get_stats()['cached'] == 1)
+    assert (engine.get_stats()['files'] == 0)
+    with open(file_path, 'wb') as f:
+      f.write(b'modified')
+    digests = engine.hash_files([(file_path, ['md5'])])
+    assert (digests[0]['md5'] == hashlib.md5(b'modified').hexdigest())
+    assert (engine.get_stats()['files'] == 1)
+    # Removed files are dropped from cache
+    os.remove(file_path)
+    engine.cache.save()
+    assert (ChecksumCache(cache_path).entries == {})
+
+  def test_checksum_cache_same_mtime(self):
+    """
+    Files rewritten with same size and modification time are hashed again
+    """
+    import hashlib
+    import time
+    from biomaj.checksum import ChecksumEngine
+    from biomaj.checksum import ChecksumCache
+    file_path = os.path.join(self.test_dir, 'test.dat')
+    with open(file_path, 'wb') as f:
+      f.write(b'test')
+    # Remote date at day precision, as set by downloaders
+    os.utime(file_path, (86400 * 18000, 86400 * 18000))
+    engine = ChecksumEngine(cache=ChecksumCache(os.path.join(self.test_dir, 'checksums_test')))
+    engine.hash_files([(file_path, ['md5'])])
+    time.sleep(0.01)
+    with open(file_path, 'wb') as f:
+      f.write(b'tost')
+    os.utime(file_path, (86400 * 18000, 86400 * 18000))
+    digests = engine.hash_files([(file_path, ['md5'])])
+    assert (digests[0]['md5'] == hashlib.md5(b'tost').hexdigest())
+    assert (engine.get_stats()['cached'] == 0)
+
+  def test_checksum_cache_failed_check(self):
+    """
+    Digests of files failing checksum verification are not kept in cache
+    """
+    from biomaj.checksum import ChecksumCache
+    from biomaj.workflow import UpdateWorkflow
+    bank = FakeWorkflowBank(self.test_dir, config={'cache.dir': os.path.join(self.test_dir, 'cache')})
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    with open(os.path.join(offline_dir, 'test.dat'), 'wb') as f:
+      f.write(b'test')
+    assert (workflow._checksum_file({'name': 'test.dat', 'md5': '0' * 32}) is False)
+    workflow.checksum_engine.cache.save()
+    assert (ChecksumCache(workflow.checksum_engine.cache.path).entries == {})
+
+  def test_checksum_manifest(self):
+    """
+    md5sum and BSD tagged manifest formats
+    """
+    from biomaj.checksum import ChecksumManifest
+    manifest_path = os.path.join(self.test_dir, 'MD5SUMS')
+    with open(manifest_path, 'w') as f:
+      f.write('# comment\n')
+      f.write('D41D8CD98F00B204E9800998ECF8427E  ./a.gz\n')
+      f.write('e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855 *sub/b.gz\n')
+      f.write('SHA256 (a.gz) = e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855\n')
+      f.write('12345 67 c.gz\n')
+    checksums = ChecksumManifest.parse(manifest_path)
+    assert (checksums == {
+      'a.gz': {
+        'md5': 'd41d8cd98f00b204e9800998ecf8427e',
+        'sha256': 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+      },
+      'sub/b.gz': {'sha256': 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'}
+    })
+    assert (ChecksumManifest.get_algorithms('md5checksums.txt') == ['md5'])
+    assert (ChecksumManifest.get_algorithms('CHECKSUMS') == ['md5', 'sha256'])
+
+  def test_checksum_listing(self):
+    """
+    Remote listing md5 is checked, hash only if checksum.listing.hash sets its algorithm
+    """
+    import hashlib
+    content = b'>seq\nACGT\n'
+    md5 = hashlib.md5(content).hexdigest()
+    sha256 = hashlib.sha256(content).hexdigest()
+    bank = FakeWorkflowBank(self.test_dir)
+    with open(os.path.join(bank.session.get_offline_directory(), 'test.fa'), 'wb') as f:
+      f.write(content)
+    workflow = UpdateWorkflow(bank)
+    rfile = {'name': 'test.fa', 'md5': md5.upper(), 'hash': sha256}
+    assert (workflow._get_listing_checksums(rfile) == {'md5': md5})
+    assert (workflow._checksum_file(rfile))
+    assert (not workflow._checksum_file({'name': 'test.fa', 'md5': hashlib.md5(b'other').hexdigest()}))
+    bank.config.set('checksum.listing.hash', 'sha256')
+    assert (workflow._get_listing_checksums(rfile) == {'md5': md5, 'sha256': sha256})
+    assert (workflow._checksum_file(rfile))
+    rfile['hash'] = hashlib.sha256(b'other').hexdigest()
+    assert (not workflow._checksum_file(rfile))
+
+  def test_checksum_listing_malformed(self):
+    """
+    Empty, malformed or unknown listing digests are ignored
+    """
+    bank = FakeWorkflowBank(self.test_dir, {'checksum.listing.hash': 'sha256'})
+    with open(os.path.join(bank.session.get_offline_directory(), 'test.fa'), 'wb') as f:
+      f.write(b'>seq\nACGT\n')
+    workflow = UpdateWorkflow(bank)
+    for (md5, file_hash) in [('', ''), (None, None), ('  ', '1234'), ('d41d8cd98f00b204e9800998ecf8427', 'Sun Oct 18 2026'),
+                             ('z41d8cd98f00b204e9800998ecf8427e', 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b85g')]:
+      rfile = {'name': 'test.fa', 'md5': md5, 'hash': file_hash}
+      assert (workflow._get_listing_checksums(rfile) == {})
+      assert (workflow._checksum_file(rfile))
+    bank.config.set('checksum.listing.hash', 'unknown')
+    assert (workflow._get_listing_checksums({'name': 'test.fa', 'hash': '1234'}) == {})
+
+
+class TestBiomajExtract():
+
+  def setup_method(self, m):
+    self.test_dir = tempfile.mkdtemp('biomaj')
+
+  def teardown_method(self, m):
+    shutil.rmtree(self.test_dir)
+
+  def test_uncompress_archive(self):
+    """
+    Archive is extracted in its directory and removed, with its size
+    """
+    import gzip
+    from biomaj.extract import uncompress_archive
+    archive = os.path.join(self.test_dir, 'test.fa.gz')
+    with gzip.open(archive, 'wb') as f:
+      f.write(b'>seq\nACGT\n')
+    size = os.path.getsize(archive)
+    (status, duration, archive_size, outputs) = uncompress_archive(archive)
+    assert (status)
+    assert (archive_size == size)
+    assert (not os.path.exists(archive))
+    assert (outputs == ['test.fa'])
+    with open(os.path.join(self.test_dir, 'test.fa'), 'rb') as f:
+      assert (f.read() == b'>seq\nACGT\n')
+
+  def test_uncompress_archive_error(self):
+    from biomaj.extract import uncompress_archive
+    archive = os.path.join(self.test_dir, 'test.gz')
+    with open(archive, 'w') as f:
+      f.write('not an archive')
+    (status, duration, archive_size, outputs) = uncompress_archive(archive)
+    assert (not status)
+    assert (os.path.exists(archive))
+
+  def test_stream_backend(self):
+    """
+    Stream backend extracts gzip, tar.gz and plain bzip2 files like default backend
+    """
+    import bz2
+    import gzip
+    import tarfile
+    from biomaj.extract import uncompress_archive
+    content = b'>seq\nACGT\n' * 1000
+    fasta = os.path.join(self.test_dir, 'test.fa')
+    with open(fasta, 'wb') as f:
+      f.write(content)
+    with tarfile.open(os.path.join(self.test_dir, 'test.tar.gz'), 'w:gz') as tar:
+      tar.add(fasta, arcname='sub/test_tar.fa')
+    with gzip.open(os.path.join(self.test_dir, 'test_gz.fa.gz'), 'wb') as f:
+      f.write(content)
+    with bz2.open(os.path.join(self.test_dir, 'test_bz2.fa.bz2'), 'wb') as f:
+      f.write(content)
+    for (archive, extracted) in [('test.tar.gz', 'sub/test_tar.fa'), ('test_gz.fa.gz', 'test_gz.fa'), ('test_bz2.fa.bz2', 'test_bz2.fa')]:
+      (status, duration, size, outputs) = uncompress_archive(os.path.join(self.test_dir, archive), backend='stream', threads=2)
+      assert (status)
+      assert (outputs == [extracted])
+      assert (not os.path.exists(os.path.join(self.test_dir, archive)))
+      with open(os.path.join(self.test_dir, extracted), 'rb') as f:
+        assert (f.read() == content)
+
+  def test_stream_backend_bgzf(self):
+    """
+    BGZF blocks are decompressed in parallel and checked
+    """
+    import struct
+    import zlib
+    from biomaj.extract import is_bgzf
+    from biomaj.extract import uncompress_archive
+    archive = os.path.join(self.test_dir, 'test.fa.gz')
+    content = b''
+    with open(archive, 'wb') as f:
+      for i in range(10):
+        data = ('>seq%d\nACGT\n' % i).encode('utf-8') * 100
+        content += data
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        f.write(b'\x1f\x8b\x08\x04' + struct.pack('<IBBH', 0, 0, 255, 6) + b'BC' + struct.pack('<HH', 2, len(cdata) + 25))
+        f.write(cdata + struct.pack('<II', zlib.crc32(data), len(data)))
+    assert (is_bgzf(archive))
+    (status, duration, size, outputs) = uncompress_archive(archive, backend='stream', threads=3)
+    assert (status)
+    with open(os.path.join(self.test_dir, 'test.fa'), 'rb') as f:
+      assert (f.read() == content)
+
+  def test_stream_backend_bgzf_members(self):
+    """
+    Empty end of member blocks of concatenated BGZF files do not end extraction
+    """
+    import io
+    import struct
+    import tarfile
+    import zlib
+    from biomaj.extract import uncompress_archive
+
+    def write_block(f, data):
+      compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+      cdata = compressor.compress(data) + compressor.flush()
+      f.write(b'\x1f\x8b\x08\x04' + struct.pack('<IBBH', 0, 0, 255, 6) + b'BC' + struct.pack('<HH', 2, len(cdata) + 25))
+      f.write(cdata + struct.pack('<II', zlib.crc32(data), len(data)))
+
+    content = b''.join([('>seq%d\nACGT\n' % i).encode('utf-8') * 1000 for i in range(4)])
+    tar_content = io.BytesIO()
+    with tarfile.open(fileobj=tar_content, mode='w') as tar:
+      info = tarfile.TarInfo('test.fa')
+      info.size = len(content)
+      tar.addfile(info, io.BytesIO(content))
+    for (name, data, extracted) in [('test.fa.gz', content, 'test.fa'), ('test.tar.gz', tar_content.getvalue(), 'test.fa')]:
+      archive = os.path.join(self.test_dir, name)
+      with open(archive, 'wb') as f:
+        # Three members, as bgzip files concatenated
+        for member in range(3):
+          part = data[member * len(data) // 3:(member + 1) * len(data) // 3]
+          for i in range(0, len(part), 4096):
+            write_block(f, part[i:i + 4096])
+          write_block(f, b'')
+      (status, duration, size, outputs) = uncompress_archive(archive, backend='stream', threads=2)
+      assert (status)
+      assert (outputs == [extracted])
+      with open(os.path.join(self.test_dir, extracted), 'rb') as f:
+        assert (f.read() == content)
+      os.remove(os.path.join(self.test_dir, extracted))
+
+  def test_stream_backend_fallback(self):
+    """
+    On error, stream backend falls back on default extraction
+    """
+    from biomaj.extract import uncompress_archive
+    archive = os.path.join(self.test_dir, 'test.gz')
+    with open(archive, 'w') as f:
+      f.write('not an archive')
+    with patch('biomaj.extract.Utils.uncompress', return_value=False) as uncompress:
+      (status, duration, size, outputs) = uncompress_archive(archive, nb_try=1, backend='stream')
+    assert (not status)
+    assert (uncompress.called)
+    assert (os.path.exists(archive))
+    assert (os.listdir(self.test_dir) == ['test.gz'])
+
+  def test_archive_format(self):
+    """
+    Archive format is given by extension, or else by content if detection is enabled
+    """
+    import gzip
+    from biomaj.extract import get_format
+    from biomaj.extract import is_archive
+    archive = os.path.join(self.test_dir, 'download')
+    with gzip.open(archive, 'wb') as f:
+      f.write(b'>seq\nACGT\n')
+    assert (get_format('test.tar.xz') == 'xz')
+    assert (get_format('test.zst') == 'zst')
+    assert (not is_archive(archive))
+    assert (get_format(archive, detect=True) == 'gz')
+    assert (not is_archive('test.tar.xz'))
+    assert (is_archive('test.tar.xz', extra=True))
+    with open(os.path.join(self.test_dir, 'test.fa'), 'w') as f:
+      f.write('>seq\nACGT\n')
+    assert (not is_archive(os.path.join(self.test_dir, 'test.fa'), detect=True))
+
+  def test_uncompress_xz(self):
+    """
+    xz files and tar files are extracted, files without extension in place
+    """
+    import gzip
+    import lzma
+    import tarfile
+    from biomaj.extract import uncompress_archive
+    content = b'>seq\nACGT\n' * 100
+    fasta = os.path.join(self.test_dir, 'test.fa')
+    with open(fasta, 'wb') as f:
+      f.write(content)
+    with tarfile.open(os.path.join(self.test_dir, 'test.tar.xz'), 'w:xz') as tar:
+      tar.add(fasta, arcname='test_tar.fa')
+    os.remove(fasta)
+    with lzma.open(os.path.join(self.test_dir, 'test_xz.fa.xz'), 'wb') as f:
+      f.write(content)
+    with gzip.open(os.path.join(self.test_dir, 'download'), 'wb') as f:
+      f.write(content)
+    for (archive, extracted) in [('test.tar.xz', 'test_tar.fa'), ('test_xz.fa.xz', 'test_xz.fa'), ('download', 'download')]:
+      (status, duration, size, outputs) = uncompress_archive(os.path.join(self.test_dir, archive))
+      assert (status)
+      assert (outputs == [extracted])
+      with open(os.path.join(self.test_dir, extracted), 'rb') as f:
+        assert (f.read() == content)
+    assert (sorted(os.listdir(self.test_dir)) == ['download', 'test_tar.fa', 'test_xz.fa'])
+
+
+class TestBiomajCopy():
+
+  def setup_method(self, m):
+    self.test_dir = tempfile.mkdtemp('biomaj')
+    os.makedirs(os.path.join(self.test_dir, 'src', 'sub'))
+    for i in range(3):
+      with open(os.path.join(self.test_dir, 'src', 'sub', 'test%d.fa' % i), 'w') as f:
+        f.write('>seq%d\nACGT\n' % i)
+
+  def teardown_method(self, m):
+    shutil.rmtree(self.test_dir)
+
+  def test_copy_files(self):
+    """
+    Files are copied keeping directory structure and dates, with statistics per method
+    """
+    from biomaj.filecopy import CopyEngine
+    engine = CopyEngine(max_workers=2)
+    files = [{'name': 'sub/test%d.fa' % i, 'root': os.path.join(self.test_dir, 'src')} for i in range(3)]
+    engine.copy_files(files, os.path.join(self.test_dir, 'dest'))
+    for i in range(3):
+      src = os.path.join(self.test_dir, 'src', 'sub', 'test%d.fa' % i)
+      dest = os.path.join(self.test_dir, 'dest', 'sub', 'test%d.fa' % i)
+      with open(dest) as f:
+        assert (f.read() == '>seq%d\nACGT\n' % i)
+      assert (not os.path.samefile(src, dest))
+      assert (os.stat(src).st_mtime_ns == os.stat(dest).st_mtime_ns)
+      assert ('download_time' in files[i])
+    stats = engine.get_stats()
+    assert (stats['files'] == 3)
+    assert (stats['bytes'] == sum(os.path.getsize(os.path.join(self.test_dir, 'src', 'sub', 'test%d.fa' % i)) for i in range(3)))
+    assert ('hardlink' not in stats['methods'])
+
+  def test_copy_hardlink(self):
+    """
+    Files are hard linked if allowed, an existing destination is replaced
+    """
+    from biomaj.filecopy import CopyEngine
+    engine = CopyEngine(use_hardlinks=True)
+    src = os.path.join(self.test_dir, 'src', 'sub', 'test0.fa')
+    dest = os.path.join(self.test_dir, 'test0.fa')
+    with open(dest, 'w') as f:
+      f.write('old')
+    assert (engine.copy_file(src, dest) == 'hardlink')
+    assert (os.path.samefile(src, dest))
+
+  def test_copy_fallback(self):
+    """
+    An unsupported method is not used again for the same devices
+    """
+    import errno
+    from biomaj.filecopy import CopyEngine
+    engine = CopyEngine(use_hardlinks=True)
+    with patch('os.link', side_effect=OSError(errno.EXDEV, 'Cross-device link')) as link:
+      for i in range(3):
+        method = engine.copy_file(os.path.join(self.test_dir, 'src', 'sub', 'test%d.fa' % i), os.path.join(self.test_dir, 'test%d.fa' % i))
+        assert (method != 'hardlink')
+      assert (link.call_count == 1)
+    with open(os.path.join(self.test_dir, 'test2.fa')) as f:
+      assert (f.read() == '>seq2\nACGT\n')
+
+  def test_copy_fallback_file(self):
+    """
+    A method failing for a file only (permissions, links) is still used for next files
+    """
+    import errno
+    from biomaj.filecopy import CopyEngine
+    engine = CopyEngine(use_hardlinks=True)
+    link = os.link
+    errors = [OSError(errno.EMLINK, 'Too many links'), OSError(errno.EPERM, 'Operation not permitted')]
+
+    def link_file(from_file, to_file):
+      if errors:
+        raise errors.pop(0)
+      link(from_file, to_file)
+
+    with patch('os.link', side_effect=link_file) as fake_link:
+      methods = []
+      for i in range(3):
+        methods.append(engine.copy_file(os.path.join(self.test_dir, 'src', 'sub', 'test%d.fa' % i), os.path.join(self.test_dir, 'test%d.fa' % i)))
+      assert (fake_link.call_count == 3)
+    assert (methods[0] != 'hardlink')
+    assert (methods[1] != 'hardlink')
+    assert (methods[2] == 'hardlink')
+
+  def test_copy_no_data(self):
+    """
+    A kernel copy copying no data falls back on next method, a truncated copy fails
+    """
+    from biomaj.filecopy import CopyEngine
+    src = os.path.join(self.test_dir, 'src', 'sub', 'test0.fa')
+    for method in ['copy_file_range', 'sendfile']:
+      if not hasattr(os, method):
+        continue
+      engine = CopyEngine(use_reflinks=False)
+      engine.methods = [method, 'buffer']
+      dest = os.path.join(self.test_dir, method + '.fa')
+      with patch('os.' + method, return_value=0):
+        assert (engine.copy_file(src, dest) == 'buffer')
+      with open(dest) as f:
+        assert (f.read() == '>seq0\nACGT\n')
+      engine = CopyEngine(use_reflinks=False)
+      engine.methods = [method, 'buffer']
+      with patch('os.' + method, side_effect=[4, 0]):
+        with pytest.raises(Exception, match='4 bytes copied'):
+          engine.copy_file(src, dest)
+
+
+class TestBiomajDedup():
+
+  def setup_method(self, m):
+    self.test_dir = tempfile.mkdtemp('biomaj')
+
+  def teardown_method(self, m):
+    shutil.rmtree(self.test_dir)
+
+  def test_dedup_link(self):
+    """
+    A file with same content as a stored file is replaced by a hard link
+    """
+    import hashlib
+    from biomaj.dedup import DedupStore
+    digest = hashlib.sha256(b'>seq\nACGT\n').hexdigest()
+    for release in ['1', '2']:
+      os.makedirs(os.path.join(self.test_dir, release))
+      with open(os.path.join(self.test_dir, release, 'test.fa'), 'wb') as f:
+        f.write(b'>seq\nACGT\n')
+    store = DedupStore(os.path.join(self.test_dir, 'dedup'))
+    assert (not store.link(digest, os.path.join(self.test_dir, '1', 'test.fa')))
+    store.save()
+    store = DedupStore(os.path.join(self.test_dir, 'dedup'))
+    assert (store.link(digest, os.path.join(self.test_dir, '2', 'test.fa')))
+    assert (os.path.samefile(os.path.join(self.test_dir, '1', 'test.fa'), os.path.join(self.test_dir, '2', 'test.fa')))
+    assert (store.get_stats() == {'files': 1, 'bytes': 10})
+
+  def test_dedup_modified(self):
+    """
+    Stored files modified or removed since stored are not used
+    """
+    import hashlib
+    from biomaj.dedup import DedupStore
+    digest = hashlib.sha256(b'>seq\nACGT\n').hexdigest()
+    for name in ['test1.fa', 'test2.fa']:
+      with open(os.path.join(self.test_dir, name), 'wb') as f:
+        f.write(b'>seq\nACGT\n')
+    store = DedupStore(os.path.join(self.test_dir, 'dedup'))
+    store.add(digest, os.path.join(self.test_dir, 'test1.fa'))
+    with open(os.path.join(self.test_dir, 'test1.fa'), 'ab') as f:
+      f.write(b'ACGT\n')
+    assert (store.get(digest) is None)
+    assert (not store.link(digest, os.path.join(self.test_dir, 'test2.fa')))
+    assert (store.get(digest) == os.path.join(self.test_dir, 'test2.fa'))
+    os.remove(os.path.join(self.test_dir, 'test2.fa'))
+    store.save()
+    assert (store.entries == {})
+
+  def test_dedup_scanner(self):
+    """
+    Identical files of several directories are hard linked, others are kept
+    """
+    from biomaj.dedup import DedupScanner
+    content = b'>seq\nACGT\n' * 20000
+    for bank in ['bank1', 'bank2', 'bank3']:
+      os.makedirs(os.path.join(self.test_dir, bank))
+      with open(os.path.join(self.test_dir, bank, 'test.fa'), 'wb') as f:
+        f.write(content)
+    # Same size and samples, different content
+    with open(os.path.join(self.test_dir, 'bank3', 'test.fa'), 'r+b') as f:
+      f.seek(len(content) // 4)
+      f.write(b'N')
+    with open(os.path.join(self.test_dir, 'bank1', 'small.fa'), 'wb') as f:
+      f.write(b'>seq\nACGT\n')
+    os.link(os.path.join(self.test_dir, 'bank1', 'small.fa'), os.path.join(self.test_dir, 'bank1', 'small_link.fa'))
+    with open(os.path.join(self.test_dir, 'bank2', 'small.fa'), 'wb') as f:
+      f.write(b'>seq\nACGT\n')
+    scanner = DedupScanner(max_workers=2)
+    stats = scanner.scan([os.path.join(self.test_dir, bank) for bank in ['bank1', 'bank2', 'bank3']])
+    assert (os.path.samefile(os.path.join(self.test_dir, 'bank1', 'test.fa'), os.path.join(self.test_dir, 'bank2', 'test.fa')))
+    assert (not os.path.samefile(os.path.join(self.test_dir, 'bank1', 'test.fa'), os.path.join(self.test_dir, 'bank3', 'test.fa')))
+    # Most linked file is kept
+    assert (os.path.samefile(os.path.join(self.test_dir, 'bank1', 'small.fa'), os.path.join(self.test_dir, 'bank2', 'small.fa')))
+    assert (stats['linked'] == 2)
+    assert (stats['reclaimed'] == len(content) + 10)
+    assert (scanner.reclaimed == {os.path.join(self.test_dir, 'bank2'): len(content) + 10})
+    with open(os.path.join(self.test_dir, 'bank2', 'test.fa'), 'rb') as f:
+      assert (f.read() == content)
+
+  def test_dedup_productions_locks(self):
+    """
+    Banks are locked in their own lock.dir, banks locked by an update are skipped
+    """
+    from unittest.mock import MagicMock
+    content = b'>seq\nACGT\n' * 100
+    banks = []
+    configs = {}
+    for name in ['bank1', 'bank2', 'bank3']:
+      data_dir = os.path.join(self.test_dir, name + '_data')
+      os.makedirs(os.path.join(data_dir, name, name + '_1'))
+      with open(os.path.join(data_dir, name, name + '_1', 'test.fa'), 'wb') as f:
+        f.write(content)
+      banks.append({'name': name, 'production': [{'data_dir': data_dir, 'dir_version': name, 'prod_dir': name + '_1'}]})
+      configs[name] = FakeWorkflowConfig({'data.dir': data_dir})
+    # bank1 is being updated
+    configs['bank1'].set('lock.dir', os.path.join(self.test_dir, 'lock'))
+    os.makedirs(os.path.join(self.test_dir, 'lock'))
+    with open(os.path.join(self.test_dir, 'lock', 'bank1.lock'), 'w') as f:
+      f.write('1')
+    connector = MagicMock()
+    connector.banks.find.return_value = banks
+    with patch('biomaj.bank.MongoConnector', connector):
+      with patch('biomaj.bank.BiomajConfig', side_effect=lambda name, options: configs[name]):
+        stats = Bank.dedup_productions()
+    files = [os.path.join(self.test_dir, name + '_data', name, name + '_1', 'test.fa') for name in ['bank1', 'bank2', 'bank3']]
+    assert (os.path.samefile(files[1], files[2]))
+    assert (not os.path.samefile(files[0], files[1]))
+    assert (stats['linked'] == 1)
+    assert (os.path.exists(os.path.join(self.test_dir, 'lock', 'bank1.lock')))
+    for name in ['bank2', 'bank3']:
+      assert (not os.path.exists(os.path.join(self.test_dir, name + '_data', name + '.lock')))
+    assert (connector.history.insert.call_count == 1)
+
+
+def exit_process(*args, **kwargs):
+  """
+  Kills the process, as a crashed worker of a pool of processes
+  """
+  os._exit(1)
+
+
+class FakeWorkflowConfig(object):
+  """
+  Bank configuration from a dict
+  """
+
+  def __init__(self, values):
+    self.values = dict(values)
+
+  def get(self, key, default=None):
+    return self.values.get(key, default)
+
+  def get_bool(self, key, default=False):
+    value = self.values.get(key)
+    if value is None:
+      return default
+    return str(value).lower() in ['1', 'true', 'yes']
+
+  def set(self, key, value):
+    self.values[key] = value
+
+
+class FakeWorkflowSession(object):
+  """
+  Session with offline and release directories in data.dir
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self._session = {'stats': {}}
+
+  def get(self, attr):
+    return self._session.get(attr)
+
+  def set(self, attr, value):
+    self._session[attr] = value
+
+  def get_offline_directory(self):
+    return os.path.join(self.config.get('data.dir'), self.config.get('offline.dir.name'))
+
+  def get_release_directory(self):
+    return 'test_1'
+
+  def get_full_release_directory(self, release=None):
+    return os.path.join(self.config.get('data.dir'), self.config.get('dir.version'), 'test_' + (release or '1'))
+
+
+class FakeWorkflowBank(object):
+  """
+  Minimal bank to run workflow steps on files, without database
+  """
+
+  def __init__(self, test_dir, config=None, name='test'):
+    values = {
+      'data.dir': test_dir,
+      'offline.dir.name': 'offline',
+      'dir.version': name,
+      'cache.dir': os.path.join(test_dir, 'cache')
+    }
+    values.update(config or {})
+    self.name = name
+    self.options = None
+    self.config = FakeWorkflowConfig(values)
+    self.session = FakeWorkflowSession(self.config)
+    self.bank = {'production': []}
+    self.depends = []
+    os.makedirs(self.session.get_offline_directory(), exist_ok=True)
+    os.makedirs(values['cache.dir'], exist_ok=True)
+
+
+class TestBiomajWorkflowFiles():
+
+  def setup_method(self, m):
+    self.test_dir = tempfile.mkdtemp('biomaj')
+
+  def teardown_method(self, m):
+    shutil.rmtree(self.test_dir)
+
+  def _write_gz(self, path, content):
+    import gzip
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wb') as f:
+      f.write(content)
+
+  def test_revert_pipeline_archives(self):
+    """
+    Archives extracted by download pipeline are restored and their files removed
+    """
+    bank = FakeWorkflowBank(self.test_dir)
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    self._write_gz(os.path.join(offline_dir, 'test.fa.gz'), b'>seq\nACGT\n')
+    with open(os.path.join(offline_dir, 'error.gz'), 'w') as f:
+      f.write('not an archive')
+    archives = []
+    rfile = {'name': 'test.fa.gz'}
+    assert (workflow._uncompress_file(rfile, archives))
+    assert (os.path.exists(os.path.join(offline_dir, 'test.fa')))
+    error_file = {'name': 'error.gz'}
+    assert (not workflow._uncompress_file(error_file, archives))
+    # Retried by wf_uncompress
+    assert (not workflow._uncompress_file(error_file, archives))
+    assert (len(archives) == 2)
+    workflow._revert_archives(archives)
+    assert (sorted(os.listdir(offline_dir)) == ['error.gz', 'test.fa.gz'])
+    assert ('extracted' not in rfile)
+
+  def test_uncompress_extra_formats(self):
+    """
+    xz and zstd files are only extracted if enabled, and kept if no decompressor is available
+    """
+    import lzma
+    bank = FakeWorkflowBank(self.test_dir)
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    with lzma.open(os.path.join(offline_dir, 'test.fa.xz'), 'wb') as f:
+      f.write(b'>seq\nACGT\n')
+    with open(os.path.join(offline_dir, 'test.fa.zst'), 'wb') as f:
+      f.write(b'\x28\xb5\x2f\xfd')
+    archives = []
+    assert (workflow._uncompress_file({'name': 'test.fa.xz'}, archives))
+    assert (archives == [])
+    assert (sorted(os.listdir(offline_dir)) == ['test.fa.xz', 'test.fa.zst'])
+    bank.config.set('uncompress.extra.formats', '1')
+    with patch('biomaj.extract.has_decompressor', return_value=False):
+      assert (workflow._uncompress_file({'name': 'test.fa.zst'}, archives))
+    assert (archives == [])
+    assert (workflow._uncompress_file({'name': 'test.fa.xz'}, archives))
+    assert (sorted(os.listdir(offline_dir)) == ['test.fa', 'test.fa.zst', 'tmp_test.fa.xz'])
+
+  def test_uncompress_failure_restores_archive(self):
+    """
+    Archives extracted before an extraction failure are restored intact from their staged hard link
+    """
+    bank = FakeWorkflowBank(self.test_dir)
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    self._write_gz(os.path.join(offline_dir, 'test.fa.gz'), b'>seq\nACGT\n')
+    with open(os.path.join(offline_dir, 'test.fa.gz'), 'rb') as f:
+      content = f.read()
+    with open(os.path.join(offline_dir, 'wrong.gz'), 'wb') as f:
+      f.write(content[:20])
+    workflow.downloaded_files = [{'name': 'test.fa.gz'}, {'name': 'wrong.gz'}]
+    assert (not workflow.wf_uncompress())
+    assert (sorted(os.listdir(offline_dir)) == ['test.fa.gz', 'wrong.gz'])
+    with open(os.path.join(offline_dir, 'test.fa.gz'), 'rb') as f:
+      assert (f.read() == content)
+    assert (os.stat(os.path.join(offline_dir, 'test.fa.gz')).st_nlink == 1)
+    assert (workflow.archives == [])
+
+  def test_uncompress_leftover_staged_link(self):
+    """
+    Staged links left by an interrupted run are replaced
+    """
+    bank = FakeWorkflowBank(self.test_dir)
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    self._write_gz(os.path.join(offline_dir, 'test1.fa.gz'), b'>seq1\nACGT\n')
+    self._write_gz(os.path.join(offline_dir, 'test2.fa.gz'), b'>seq2\nACGT\n')
+    os.link(os.path.join(offline_dir, 'test1.fa.gz'), os.path.join(offline_dir, 'tmp_test1.fa.gz'))
+    with open(os.path.join(offline_dir, 'tmp_test2.fa.gz'), 'w') as f:
+      f.write('stale')
+    workflow.downloaded_files = [{'name': 'test1.fa.gz'}, {'name': 'test2.fa.gz'}]
+    assert (workflow.wf_uncompress())
+    assert (sorted(os.listdir(offline_dir)) == ['test1.fa', 'test2.fa'])
+    with open(os.path.join(offline_dir, 'test2.fa'), 'rb') as f:
+      assert (f.read() == b'>seq2\nACGT\n')
+
+  def _write_tar(self, path, links=False):
+    import io
+    import tarfile
+    with tarfile.open(path, 'w:gz') as tar:
+      info = tarfile.TarInfo('sub/test.fa')
+      info.size = 10
+      tar.addfile(info, io.BytesIO(b'>seq\nACGT\n'))
+      info = tarfile.TarInfo('sub/test_hardlink.fa')
+      info.type = tarfile.LNKTYPE
+      info.linkname = 'sub/test.fa'
+      tar.addfile(info)
+      if links:
+        info = tarfile.TarInfo('sub/test_symlink.fa')
+        info.type = tarfile.SYMTYPE
+        info.linkname = 'test.fa'
+        tar.addfile(info)
+
+  def test_copy_manifest(self):
+    """
+    Only downloaded and extracted files matching local.files are moved to release directory
+    """
+    bank = FakeWorkflowBank(self.test_dir, {'uncompress.backend': 'stream', 'local.files': '^sub/.* ^test.txt$'})
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    self._write_tar(os.path.join(offline_dir, 'test.tar.gz'))
+    for name in ['test.txt', 'other.txt', 'unknown.txt']:
+      with open(os.path.join(offline_dir, name), 'w') as f:
+        f.write(name)
+    workflow.downloaded_files = [{'name': 'test.tar.gz'}, {'name': 'test.txt'}, {'name': 'other.txt'}]
+    assert (workflow.wf_uncompress())
+    assert (workflow.downloaded_files[0]['extracted'][1][0] == 'sub/test_hardlink.fa')
+    with patch('biomaj.workflow.Utils.copy_files_with_regexp') as walk:
+      assert (workflow.wf_copy())
+      assert (not walk.called)
+    files = sorted([local_file['name'] for local_file in bank.session.get('files')])
+    assert (files == ['sub/test.fa', 'sub/test_hardlink.fa', 'test.txt'])
+    flat_dir = os.path.join(bank.session.get_full_release_directory(), 'flat')
+    assert (os.path.samefile(os.path.join(flat_dir, 'sub', 'test.fa'), os.path.join(flat_dir, 'sub', 'test_hardlink.fa')))
+    assert (sorted(os.listdir(offline_dir)) == ['other.txt', 'sub', 'unknown.txt'])
+
+  def test_copy_manifest_links(self):
+    """
+    Hard and symbolic links extracted from archives are moved, symbolic links before their target
+    """
+    bank = FakeWorkflowBank(self.test_dir, {'uncompress.backend': 'stream'})
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    self._write_tar(os.path.join(offline_dir, 'test.tar.gz'), links=True)
+    workflow.downloaded_files = [{'name': 'test.tar.gz'}]
+    assert (workflow.wf_uncompress())
+    assert ([extracted[0] for extracted in workflow.downloaded_files[0]['extracted']] == ['sub/test.fa', 'sub/test_hardlink.fa', 'sub/test_symlink.fa'])
+    # Symbolic link first
+    workflow.downloaded_files[0]['extracted'].reverse()
+    with patch('biomaj.workflow.Utils.copy_files_with_regexp') as walk:
+      assert (workflow.wf_copy())
+      assert (not walk.called)
+    local_files = dict([(local_file['name'], local_file) for local_file in bank.session.get('files')])
+    assert (sorted(local_files.keys()) == ['sub/test.fa', 'sub/test_hardlink.fa', 'sub/test_symlink.fa'])
+    assert (local_files['sub/test_symlink.fa']['size'] == 10)
+    flat_dir = os.path.join(bank.session.get_full_release_directory(), 'flat')
+    assert (os.readlink(os.path.join(flat_dir, 'sub', 'test_symlink.fa')) == 'test.fa')
+    assert (os.listdir(offline_dir) == ['sub'])
+
+  def test_copy_dedup_dates(self):
+    """
+    Files linked to identical files of previous releases get their dates in session files
+    """
+    import hashlib
+    from biomaj.dedup import DedupStore
+    bank = FakeWorkflowBank(self.test_dir, {'copy.dedup': 'true'})
+    workflow = UpdateWorkflow(bank)
+    previous = os.path.join(self.test_dir, 'test', 'test_0', 'flat', 'test.txt')
+    os.makedirs(os.path.dirname(previous))
+    with open(previous, 'w') as f:
+      f.write('test')
+    os.utime(previous, (1577880000, 1577880000))
+    store = DedupStore(os.path.join(self.test_dir, 'cache', 'dedup_test'))
+    store.add(hashlib.sha256(b'test').hexdigest(), previous)
+    store.save()
+    with open(os.path.join(bank.session.get_offline_directory(), 'test.txt'), 'w') as f:
+      f.write('test')
+    workflow.downloaded_files = [{'name': 'test.txt'}]
+    assert (workflow.wf_copy())
+    flat_dir = os.path.join(bank.session.get_full_release_directory(), 'flat')
+    assert (os.path.samefile(previous, os.path.join(flat_dir, 'test.txt')))
+    local_file = bank.session.get('files')[0]
+    assert ((local_file['year'], local_file['month'], local_file['day']) == ('2020', '1', '1'))
+    assert (bank.session.get('stats')['dedup']['files'] == 1)
+
+  def test_copy_dependency(self):
+    """
+    Files of dependencies are copied, hard linked or symbolic linked
+    """
+    dep_bank = FakeWorkflowBank(self.test_dir, name='dep')
+    dep_dir = dep_bank.session.get_full_release_directory()
+    os.makedirs(os.path.join(dep_dir, 'flat', 'sub'))
+    for name in ['flat/test.fa', 'flat/sub/test2.fa', 'flat/test.txt']:
+      with open(os.path.join(dep_dir, name), 'w') as f:
+        f.write(name)
+    bank = FakeWorkflowBank(self.test_dir, {'dep.files.move': 'flat/.*\\.fa$ flat/sub/.*\\.fa$'})
+    bank.depends = [dep_bank]
+    workflow = UpdateWorkflow(bank)
+    bank_dep_dir = os.path.join(bank.session.get_full_release_directory(), 'dep')
+    for link in ['copy', 'hardlink', 'symlink']:
+      copy_engine = workflow._new_copy_engine(link == 'hardlink')
+      assert (workflow._copy_dependency('dep', link, copy_engine))
+      for name in ['flat/test.fa', 'flat/sub/test2.fa']:
+        path = os.path.join(bank_dep_dir, name)
+        with open(path) as f:
+          assert (f.read() == name)
+        assert (os.path.islink(path) == (link == 'symlink'))
+        assert (os.path.samefile(path, os.path.join(dep_dir, name)) == (link != 'copy'))
+        if link == 'symlink':
+          assert (os.readlink(path) == os.path.join(dep_dir, name))
+      assert (not os.path.exists(os.path.join(bank_dep_dir, 'flat', 'test.txt')))
+      if link != 'symlink':
+        assert (copy_engine.get_stats()['files'] == 2)
+    # Dependency not updated
+    bank.config.set('other.files.move', 'flat/.*')
+    assert (not workflow._copy_dependency('other', 'copy', copy_engine))
+
+  def test_uncompress_pool_broken(self):
+    """
+    Extraction process killed in a pool of processes fails extraction and reverts archives
+    """
+    bank = FakeWorkflowBank(self.test_dir)
+    workflow = UpdateWorkflow(bank)
+    offline_dir = bank.session.get_offline_directory()
+    files = []
+    for name in ['test1.fa.gz', 'test2.fa.gz']:
+      self._write_gz(os.path.join(offline_dir, name), b'>seq\nACGT\n')
+      files.append({'name': name})
+    archives = []
+    with patch('biomaj.extract.uncompress_archive', exit_process):
+      assert (not workflow._uncompress_files(files, archives, 2))
+    workflow._revert_archives(archives)
+    assert (sorted(os.listdir(offline_dir)) == ['test1.fa.gz', 'test2.fa.gz'])
+
+
+class TestBiomajLocalProcess():
+
+  def setup_method(self, m):
+    self.test_dir = tempfile.mkdtemp('biomaj')
+
+  def teardown_method(self, m):
+    shutil.rmtree(self.test_dir)
+
+  def test_threads_per_bank(self):
+    """
+    Number of process threads of a bank does not change other banks
+    """
+    bank1 = FakeWorkflowBank(self.test_dir, {'bank.num.threads': '4'}, name='bank1')
+    bank2 = FakeWorkflowBank(self.test_dir, name='bank2')
+    pfactory1 = PreProcessFactory(bank1)
+    pfactory2 = PreProcessFactory(bank2)
+    pfactory1.fill_tasks_in_threads(['META1', 'META2', 'META3', 'META4'])
+    pfactory2.fill_tasks_in_threads(['META1', 'META2', 'META3', 'META4'])
+    assert (len(pfactory1.threads_tasks) == 4)
+    assert (len(pfactory2.threads_tasks) == ProcessFactory.NB_THREAD)
+
+  def test_local_process_cwd(self):
+    """
+    Local processes run in process.dir, biomaj working directory is unchanged
+    """
+    process_dir = os.path.join(self.test_dir, 'process')
+    os.makedirs(process_dir)
+    cwd = os.getcwd()
+    for expand in [True, False]:
+      name = 'pwd_' + str(expand)
+      process = LocalProcess(name, 'pwd', None, cwd=process_dir, expand=expand, bank_env=dict(os.environ), log_dir=self.test_dir)
+      assert (process.run())
+      with open(os.path.join(self.test_dir, name + '.out')) as f:
+        assert (f.read().strip() == os.path.realpath(process_dir))
+    assert (os.getcwd() == cwd)